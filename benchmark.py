@@ -0,0 +1,254 @@
+# TC-PSPP benchmark suite
+# Generates a deterministic synthetic PrusaSlicer style multi tool GCode and times the processing stages
+# separately, the results are emitted as JSON (to track the regressions across versions)
+# - memory - memory of the parsed token list (traced Python allocations) per token, measured in a separate parse
+#
+# Usage: benchmark.py [--tools N] [--layers N] [--lines N] [--changes N] [--layer-heights H1,H2,...]
+#                     [--seed N] [--repeat N] [--sparse [--check]] [--workers N] [--memory] [--output report.json]
+# - check - the sparse output is compared with the output of the full token list (exit status 1 if they differ)
+import argparse, contextlib, gc, io, itertools, json, os, platform, random, sys, tempfile, time, tracemalloc
+
+FILAMENTS = ['PLA', 'PETG', 'ABS', 'TPU']
+
+# Slicer settings for the tools (the job config is built from them - conf.Config.from_environ)
+def slicer_env(tools):
+    return {
+        'SLIC3R_FIRST_LAYER_TEMPERATURE'    : ','.join(['215'] * tools),
+        'SLIC3R_TEMPERATURE'                : ','.join([str(205 + 5 * tool) for tool in range(tools)]),
+        'SLIC3R_DISABLE_FAN_FIRST_LAYERS'   : ','.join(['1'] * tools),
+        'SLIC3R_MAX_FAN_SPEED'              : ','.join(['100'] * tools),
+        'SLIC3R_NOZZLE_DIAMETER'            : ','.join(['0.4'] * tools),
+        'SLIC3R_EXTRUSION_MULTIPLIER'       : ','.join(['1'] * tools),
+        'SLIC3R_FILAMENT_DIAMETER'          : ','.join(['1.75'] * tools),
+        'SLIC3R_MIN_LAYER_HEIGHT'           : ','.join(['0.07'] * tools),
+        'SLIC3R_MAX_LAYER_HEIGHT'           : ','.join(['0.3'] * tools),
+        'SLIC3R_RETRACT_LIFT'               : ','.join(['0.4'] * tools),
+        'SLIC3R_FILAMENT_TYPE'              : ';'.join([FILAMENTS[tool % len(FILAMENTS)] for tool in range(tools)]),
+        'SLIC3R_USE_FIRMWARE_RETRACTION'    : '1',
+        'SLIC3R_RETRACT_LENGTH_TOOLCHANGE'  : ','.join(['0'] * tools),
+        'SLIC3R_WIPE_TOWER'                 : '0'
+        }
+
+# Generate the synthetic GCode
+# - tools - number of tools, layers - number of layers, lines - move lines per layer
+# - changes - tool changes per layer, layer_heights - heights the layers (after the first) are picked from
+# - same parameters and seed generate the same file
+def generate_gcode(gcode_out, tools = 3, layers = 20, lines = 200, changes = 2, layer_heights = (0.1, 0.15, 0.2), seed = 1):
+    rand = random.Random(seed)
+    write = gcode_out.write
+
+    # Start GCode
+    write("; generated by TC-PSPP benchmark\n\n")
+    write("M107\n;TYPE:Custom\nT-1\nG28\nG1 Z5 F5000\nM140 S60\n;; TC_TEMP_INITIALIZE\nG29\n")
+    write("M104 S215 T0\nM109 S215 T0\nG21\nG90\nM83\nM900 K0\n;\n")
+
+    current_tool = -1
+    def tool_change(next_tool):
+        write(";; TOOL_BLOCK_END:{prev}\nT{next}\nM120\nM98 P\"prime.g\"\nM121\n;; TOOL_BLOCK_START:{next}\n".format(prev = current_tool, next = next_tool))
+        return next_tool
+    current_tool = tool_change(0)
+
+    layer_z = 0.0
+    for layer_num in range(layers):
+        layer_height = 0.2 if layer_num == 0 else rand.choice(layer_heights)
+        layer_z = round(layer_z + layer_height, 3)
+        write(";; BEFORE_LAYER_CHANGE:{layer},{z:.3f}\nG1 Z{z:.3f} F7800.000\n;; AFTER_LAYER_CHANGE:{layer},{z:.3f}\n;Z:{z:.3f}\n".format(layer = layer_num, z = layer_z))
+        if layer_num == 2:
+            write("M106 S255\n")
+
+        # Tool blocks - travel (retracted) + perimeter moves
+        block_lines = max(1, lines // (changes + 1))
+        for block in range(changes + 1):
+            if block > 0:
+                current_tool = tool_change(rand.randrange(tools))
+            block_line = 0
+            while block_line < block_lines:
+                write("G10\nG1 X{x:.3f} Y{y:.3f} F9000.000\nG11\nG1 F1500\n".format(x = rand.uniform(50, 150), y = rand.uniform(50, 150)))
+                for move in range(8):
+                    write("G1 X{x:.3f} Y{y:.3f} E{e:.5f} ; perimeter\n".format(x = rand.uniform(50, 150), y = rand.uniform(50, 150), e = rand.uniform(0.01, 0.5)))
+                block_line += 12
+
+    # End GCode
+    write(";; BEFORE_LAYER_CHANGE:{layer},{z:.3f}\n;; TC_TEMP_SHUTDOWN\n".format(layer = layers, z = layer_z + 0.2))
+    write("G91\nG1 Z2 F1000\nG90\nM400\nT-1\nM400\nG1 X-20 Y-20\n")
+
+# Timed stages of a run
+class StageTimer:
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        t_start = time.perf_counter()
+        yield
+        self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - t_start
+
+# Run the processing stages on the file (same sequence as tcpspp)
+def run_stages(filename, filename_out, config, sparse, workers):
+    import gcode_analyzer, gcode_writer, prime_tower, thermal_control, pcf_control
+
+    timer = StageTimer()
+    # Controllers report to the analyzer log - keep the report clean
+    with timer.stage('parse'):
+        gcode = gcode_analyzer.GCodeAnalyzer(filename, workers = workers, sparse = sparse, config = config, log = io.StringIO())
+    tokens = len(gcode.tokens)
+
+    with timer.stage('validate'):
+        validator = gcode_analyzer.GCodeValidator()
+        validator.analyze_and_fix(gcode)
+    with timer.stage('analyze_state'):
+        gcode.analyze_state()
+
+    tower = prime_tower.PrimeTower()
+    with timer.stage('prime_tower.analyze_gcode'):
+        tower.analyze_gcode(gcode)
+    with timer.stage('prime_tower.optimize_layers'):
+        tower.optimize_layers()
+    with timer.stage('prime_tower.inject_gcode'):
+        tower.inject_gcode()
+
+    temp_controller = thermal_control.TemperatureController()
+    with timer.stage('thermal.analyze_gcode'):
+        temp_controller.analyze_gcode(gcode)
+    with timer.stage('thermal.inject_gcode'):
+        temp_controller.inject_gcode()
+
+    pcf_controller = pcf_control.PartCoolingFanController()
+    with timer.stage('pcf.analyze_gcode'):
+        pcf_controller.analyze_gcode(gcode)
+    with timer.stage('pcf.inject_gcode'):
+        pcf_controller.inject_gcode()
+
+    with timer.stage('validate_retracts'):
+        validator.analyze_retracts(gcode)
+
+    with timer.stage('write'):
+        with gcode_writer.GCodeWriter(filename_out) as gcode_out:
+            if sparse:
+                plan = gcode.injection_plan()
+                gcode.close()
+                gcode_writer.write_plan(filename, plan, gcode_out, newline = gcode.newline)
+            else:
+                gcode.write(gcode_out)
+        gcode.close()
+
+    return timer.stages, tokens, gcode.total_runtime
+
+# First line the outputs differ at - (line number, expected line, line) or None if they match
+def compare_outputs(filename_expected, filename):
+    with open(filename_expected, mode='rb') as expected_in, open(filename, mode='rb') as gcode_in:
+        for line_num, (expected, line) in enumerate(itertools.zip_longest(expected_in, gcode_in, fillvalue = b''), start = 1):
+            if expected != line:
+                return line_num, expected.decode('utf8').rstrip(), line.decode('utf8').rstrip()
+    return None
+
+# Memory of the parsed token list
+# (the source mmap is not a Python allocation - not traced)
+def measure_memory(filename, config, sparse):
+    import gcode_analyzer
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        traced_pre = tracemalloc.get_traced_memory()[0]
+        gcode = gcode_analyzer.GCodeAnalyzer(filename, sparse = sparse, config = config, log = io.StringIO())
+        gc.collect()
+        traced, traced_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    tokens = len(gcode.tokens)
+    gcode.close()
+
+    return {
+        'tokens' : tokens,
+        'token_list' : traced - traced_pre,
+        'token_list_peak' : traced_peak - traced_pre,
+        'bytes_per_token' : (traced - traced_pre) / tokens if tokens > 0 else 0.0 }
+
+def main():
+    parser = argparse.ArgumentParser(description = "TC-PSPP stage benchmark")
+    parser.add_argument('--tools', type = int, default = 3)
+    parser.add_argument('--layers', type = int, default = 200)
+    parser.add_argument('--lines', type = int, default = 2000, help = "move lines per layer")
+    parser.add_argument('--changes', type = int, default = 2, help = "tool changes per layer")
+    parser.add_argument('--layer-heights', default = '0.1,0.15,0.2', help = "layer heights to pick from (after the first layer)")
+    parser.add_argument('--seed', type = int, default = 1)
+    parser.add_argument('--repeat', type = int, default = 3, help = "runs per stage - the best is reported")
+    parser.add_argument('--sparse', action = 'store_true')
+    parser.add_argument('--check', action = 'store_true', help = "compare the sparse output with the full token list output")
+    parser.add_argument('--workers', type = int, default = 1)
+    parser.add_argument('--memory', action = 'store_true', help = "measure the memory of the parsed token list")
+    parser.add_argument('--output', help = "JSON report file (stdout if not set)")
+    args = parser.parse_args()
+
+    layer_heights = [float(height) for height in args.layer_heights.split(',')]
+
+    # Job config of the synthetic tools (the process environment is left alone)
+    # the stage reports (DEBUG/PERF_INFO) go to the per-run analyzer log
+    import conf
+    config = conf.Config.from_environ(slicer_env(args.tools))
+
+    stages = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        filename = os.path.join(work_dir, 'benchmark.gcode')
+        t_start = time.perf_counter()
+        with open(filename, mode='w') as gcode_out:
+            generate_gcode(gcode_out, args.tools, args.layers, args.lines, args.changes, layer_heights, args.seed)
+        generate_time = time.perf_counter() - t_start
+        file_size = os.path.getsize(filename)
+
+        for run in range(args.repeat):
+            run_times, tokens, total_runtime = run_stages(filename, os.path.join(work_dir, 'benchmark_out.gcode'), config, args.sparse, args.workers)
+            for name, elapsed in run_times.items():
+                stages[name] = min(stages.get(name, elapsed), elapsed)
+
+        check = None
+        if args.sparse and args.check:
+            filename_expected = os.path.join(work_dir, 'benchmark_expected.gcode')
+            run_stages(filename, filename_expected, config, False, args.workers)
+            diff = compare_outputs(filename_expected, os.path.join(work_dir, 'benchmark_out.gcode'))
+            check = { 'match' : diff is None }
+            if diff is not None:
+                check.update({ 'line' : diff[0], 'expected' : diff[1], 'output' : diff[2] })
+
+        memory = None
+        if args.memory:
+            memory = measure_memory(filename, config, args.sparse)
+
+    report = {
+        'params' : {
+            'tools' : args.tools,
+            'layers' : args.layers,
+            'lines' : args.lines,
+            'changes' : args.changes,
+            'layer_heights' : layer_heights,
+            'seed' : args.seed,
+            'repeat' : args.repeat,
+            'sparse' : args.sparse,
+            'workers' : args.workers },
+        'python' : platform.python_version(),
+        'platform' : platform.platform(),
+        'file_size' : file_size,
+        'tokens' : tokens,
+        'estimated_runtime' : total_runtime,
+        'generate' : generate_time,
+        'stages' : stages,
+        'total' : sum(stages.values()) }
+    if memory is not None:
+        report['memory'] = memory
+    if check is not None:
+        report['check'] = check
+
+    if args.output is not None:
+        with open(args.output, mode='w') as report_out:
+            json.dump(report, report_out, indent = 2)
+    else:
+        json.dump(report, sys.stdout, indent = 2)
+        print()
+
+    if check is not None and not check['match']:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
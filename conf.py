@@ -1,4 +1,4 @@
-import os, math
+import dataclasses, json, os, math
 
 # Configuration exception
 class ConfException(Exception):
@@ -9,22 +9,13 @@ class ConfException(Exception):
 DEBUG = False
 PERF_INFO = True
 GCODE_VERBOSE = True
-
-# Imported from Slic3r
-tool_temperature_layer0                  = [int(t) for t in os.environ['SLIC3R_FIRST_LAYER_TEMPERATURE'].split(',')]
-tool_temperature_layerN                  = [int(t) for t in os.environ['SLIC3R_TEMPERATURE'].split(',')]
-tool_pcfan_disable_first_layers          = [int(l) for l in os.environ['SLIC3R_DISABLE_FAN_FIRST_LAYERS'].split(',')]
-tool_pcfan_speed                         = [float(s) / 100.0 for s in os.environ['SLIC3R_MAX_FAN_SPEED'].split(',')]
-tool_nozzle_diameter                     = [float(d) for d in os.environ['SLIC3R_NOZZLE_DIAMETER'].split(',')]
-tool_extrusion_multiplier                = [float(m) for m in os.environ['SLIC3R_EXTRUSION_MULTIPLIER'].split(',')]
-tool_filament_diameter                   = [float(d) for d in os.environ['SLIC3R_FILAMENT_DIAMETER'].split(',')]
-    
-tool_min_layer_height                    = [float(h) for h in os.environ['SLIC3R_MIN_LAYER_HEIGHT'].split(',')]
-tool_max_layer_height                    = [float(h) for h in os.environ['SLIC3R_MAX_LAYER_HEIGHT'].split(',')]
-    
-retract_lift                             = [float(h) for h in os.environ['SLIC3R_RETRACT_LIFT'].split(',')]
-
-filament_type                            = [filament for filament in os.environ['SLIC3R_FILAMENT_TYPE'].split(';')]
+ANALYSIS_WORKERS = 1                    # Processes to parse/analyze the GCode with (files over 1MB per process)
+SPARSE_TOKENS = False                   # Keep only the non-move tokens in memory, stream the output from the input (two pass)
+PROFILE = False                         # Write the stage profile report next to the output (<output>.profile.json)
+PROFILE_MEMORY = False                  # Trace the peak memory per stage in the profile (tracemalloc - slow)
+PROFILE_CPROFILE = False                # Capture the top functions per stage in the profile (cProfile)
+RESULT_CACHE_DIR = None                 # Reuse the outputs of the same input/config/tool version from the cache directory (None - disabled)
+RESULT_CACHE_SIZE = 2 << 30             # Result cache size cap [bytes] (least recently used outputs evicted)
 
 # Settings to customize by user
 retract_lift_speed = 15000              # Retract lift speed in mm/mm
@@ -34,7 +25,7 @@ printer_corexy = True
 printer_motor_speed_xy                   = 14400   # XY motor speed in mm/min
 printer_motor_speed_z                    = 1200    # Z motor speed  in mm/min
 
-printer_extruder_speed                   = [7200] * len(retract_lift) # Cystomize in mm/min
+printer_extruder_speed_default           = 7200    # Cystomize in mm/min (per tool in the job config - printer_extruder_speed)
 
 # Prime tower settings
 prime_tower_x = 250.0                   # Prime tower position X
@@ -59,76 +50,264 @@ runtime_default     = 0                 # Default instruction time
 temp_idle_delta     = 30
 temp_heating_rate   = 0.6  # Heating rate estimate (in C/s)
 temp_cooling_rate   = 0.8  # Cooling rate estimate (in C/s)
-# Calculate for specific setup
-# For Core XY, 
-# Potentially the max speed on a single axis would be superposition of max speed of both motors
-# so max speed is between
-# - single_motor max speed when movement on diagonal
-# - sqrt(2.0) * single motor max speed when movement only on X or Y axis (both motors engaged)
-# For temp managment it's better to under-estimate the move time 
-# And have the idle tool heat up earlier then over-estimate the time taken and start heating up the tool to late
-move_speed_xy = math.sqrt(2.0) * printer_motor_speed_xy if printer_corexy else printer_motor_speed_xy
-move_speed_z = printer_motor_speed_z # Z move speed mm/min
-
-# Get max layer height for set of tools 
+
+# Settings to customize by user - defaults of the job configs
+USER_SETTINGS = [
+    'retract_lift_speed', 'printer_corexy', 'printer_motor_speed_xy', 'printer_motor_speed_z',
+    'prime_tower_x', 'prime_tower_y', 'prime_tower_r', 'prime_tower_print_speed', 'prime_tower_move_speed',
+    'prime_tower_band_width', 'prime_tower_band_num_faces', 'prime_tower_optimize_layers', 'brim_width', 'brim_height',
+    'runtime_tool_change', 'runtime_default', 'temp_idle_delta', 'temp_heating_rate', 'temp_cooling_rate']
+
+# Imported from Slic3r - job config field : (environment variable, value parser, separator)
+SLIC3R_SETTINGS = {
+    'tool_temperature_layer0'           : ('SLIC3R_FIRST_LAYER_TEMPERATURE', int, ','),
+    'tool_temperature_layerN'           : ('SLIC3R_TEMPERATURE', int, ','),
+    'tool_pcfan_disable_first_layers'   : ('SLIC3R_DISABLE_FAN_FIRST_LAYERS', int, ','),
+    'tool_pcfan_speed'                  : ('SLIC3R_MAX_FAN_SPEED', lambda s: float(s) / 100.0, ','),
+    'tool_nozzle_diameter'              : ('SLIC3R_NOZZLE_DIAMETER', float, ','),
+    'tool_extrusion_multiplier'         : ('SLIC3R_EXTRUSION_MULTIPLIER', float, ','),
+    'tool_filament_diameter'            : ('SLIC3R_FILAMENT_DIAMETER', float, ','),
+    'tool_min_layer_height'             : ('SLIC3R_MIN_LAYER_HEIGHT', float, ','),
+    'tool_max_layer_height'             : ('SLIC3R_MAX_LAYER_HEIGHT', float, ','),
+    'retract_lift'                      : ('SLIC3R_RETRACT_LIFT', float, ','),
+    'filament_type'                     : ('SLIC3R_FILAMENT_TYPE', str, ';') }
+
+# Job configuration
+# Immutable, built from the Slic3r environment, a JSON/TOML profile or a dict (Config.from_*)
+# and passed thru the pipeline (GCodeAnalyzer.config) - jobs with different configs can run side by side
+# - Slic3r settings are per tool tuples, the user settings default to the module settings above
+@dataclasses.dataclass(frozen = True)
+class Config:
+    # Slic3r settings
+    tool_temperature_layer0 : tuple
+    tool_temperature_layerN : tuple
+    tool_pcfan_disable_first_layers : tuple
+    tool_pcfan_speed : tuple
+    tool_nozzle_diameter : tuple
+    tool_extrusion_multiplier : tuple
+    tool_filament_diameter : tuple
+    tool_min_layer_height : tuple
+    tool_max_layer_height : tuple
+    retract_lift : tuple
+    filament_type : tuple
+
+    # User settings
+    retract_lift_speed : float
+    printer_corexy : bool
+    printer_motor_speed_xy : float
+    printer_motor_speed_z : float
+    printer_extruder_speed : tuple
+    prime_tower_x : float
+    prime_tower_y : float
+    prime_tower_r : float
+    prime_tower_print_speed : float
+    prime_tower_move_speed : float
+    prime_tower_band_width : int
+    prime_tower_band_num_faces : int
+    prime_tower_optimize_layers : bool
+    brim_width : int
+    brim_height : int
+    runtime_tool_change : float
+    runtime_default : float
+    temp_idle_delta : float
+    temp_heating_rate : float
+    temp_cooling_rate : float
+    gcode_verbose : bool
+
+    # Calculate for specific setup
+    # For Core XY, 
+    # Potentially the max speed on a single axis would be superposition of max speed of both motors
+    # so max speed is between
+    # - single_motor max speed when movement on diagonal
+    # - sqrt(2.0) * single motor max speed when movement only on X or Y axis (both motors engaged)
+    # For temp managment it's better to under-estimate the move time 
+    # And have the idle tool heat up earlier then over-estimate the time taken and start heating up the tool to late
+    move_speed_xy : float = dataclasses.field(init = False)
+    move_speed_z : float = dataclasses.field(init = False)     # Z move speed mm/min
+
+    def __post_init__(self):
+        object.__setattr__(self, 'move_speed_xy', math.sqrt(2.0) * self.printer_motor_speed_xy if self.printer_corexy else self.printer_motor_speed_xy)
+        object.__setattr__(self, 'move_speed_z', self.printer_motor_speed_z)
+        # Hashable (e.g. a key of the per-config state) - hash the fields once
+        object.__setattr__(self, 'cached_hash', hash(tuple(getattr(self, field.name) for field in dataclasses.fields(self))))
+
+    def __hash__(self):
+        return self.cached_hash
+
+    # Pickled by the settings - the hash is recomputed (string hashes differ between the processes)
+    def __reduce__(self):
+        return (Config, tuple(getattr(self, field.name) for field in dataclasses.fields(self) if field.init))
+
+    # Config from the Slic3r environment (os.environ or the settings captured from it)
+    # - overrides - settings by the field name
+    @staticmethod
+    def from_environ(environ = os.environ, **overrides):
+        settings = slic3r_environ(environ)
+        settings.update(overrides)
+        return Config.from_dict(settings)
+
+    # Config from the dict (e.g. parsed profile)
+    # - SLIC3R_* settings as captured from the environment (the ones not used are ignored)
+    # - settings by the field name, the per tool settings as lists (override the SLIC3R_* ones)
+    @staticmethod
+    def from_dict(data):
+        settings = defaults()
+        for field, (key, parse, separator) in SLIC3R_SETTINGS.items():
+            if key in data:
+                settings[field] = tuple(parse(value) for value in str(data[key]).split(separator))
+
+        fields = set(field.name for field in dataclasses.fields(Config) if field.init)
+        for name, value in data.items():
+            if name.startswith('SLIC3R_'):
+                continue
+            if name not in fields:
+                raise ConfException("Unknown setting '{name}'".format(name = name))
+            settings[name] = tuple(value) if isinstance(value, list) else value
+
+        missing = [SLIC3R_SETTINGS[field][0] for field in SLIC3R_SETTINGS if field not in settings]
+        if missing:
+            raise ConfException("Slic3r settings missing: {settings}".format(settings = ', '.join(missing)))
+        if 'printer_extruder_speed' not in settings:
+            settings['printer_extruder_speed'] = (printer_extruder_speed_default,) * len(settings['retract_lift'])
+
+        return Config(**settings)
+
+    # Config from the JSON or TOML (.toml) profile
+    @staticmethod
+    def from_file(filename):
+        if filename.endswith('.toml'):
+            # tomllib (Python 3.11+) or tomli - imported on use
+            try:
+                import tomllib
+            except ImportError:
+                try:
+                    import tomli as tomllib
+                except ImportError:
+                    raise ConfException("TOML profiles need Python 3.11+ (tomllib) or the tomli package")
+            with open(filename, mode='rb') as profile_in:
+                data = tomllib.load(profile_in)
+        else:
+            with open(filename, mode='r') as profile_in:
+                data = json.load(profile_in)
+        return Config.from_dict(data)
+
+    # Settings by the field name (JSON serializable, Config.from_dict reads it back)
+    def as_dict(self):
+        return {field.name : list(value) if isinstance(value, tuple) else value 
+                for field, value in ((field, getattr(self, field.name)) for field in dataclasses.fields(self) if field.init)}
+
+    # Copy of the config with the settings changed
+    def replace(self, **changes):
+        return dataclasses.replace(self, **changes)
+
+    # Get max layer height for set of tools 
+    def max_layer_height(self, tool_set):
+        layer_height = 999.0
+        for tool in tool_set:
+            if self.tool_max_layer_height[tool] < layer_height:
+                layer_height = self.tool_max_layer_height[tool]
+        # Check if the layer height is valid 
+        # i.e. higher then min layer height for the tool set 
+        for tool in tool_set:
+            if layer_height < self.tool_min_layer_height[tool]:
+                tools = ','.join(['T' + str(tool) for tool in tool_set]),
+                raise ConfException("max_layer_height for [{tools}] = {layer_height} lower then min_layer_height for tool T{tool}".format(
+                    tools = tools, layer_height = layer_height, tool = tool))
+          
+        return layer_height
+            
+    # Get min layer height for set of tools
+    def min_layer_height(self, tool_set):
+        layer_height = -999.0
+        for tool in tool_set:
+            if self.tool_min_layer_height[tool] > layer_height:
+                layer_height = self.tool_min_layer_height[tool]
+        # Check if the layer height is valid
+        # i.e. lower then max layer height for the tool set
+        for tool in tool_set:
+            if layer_height > self.tool_max_layer_height[tool]:
+                tools = ','.join(['T' + str(tool) for tool in tool_set]),
+                raise ConfException("min_layer_height for [{tools}] = {layer_height} higher then max_layer_height for tool T{tool}".format(
+                    tools = tools, layer_height = layer_height, tool = tool))
+                        
+        return layer_height
+
+    # Extrusion factors - extrusion cross section and filament area (x4) for the tool/layer height
+    def extrusion_factors(self, tool_id, layer_height):
+        A_ex = ((float(self.tool_nozzle_diameter[tool_id]) - layer_height) * layer_height + math.pi * ((layer_height / 2.0) ** 2))
+        A_fil = (math.pi * (float(self.tool_filament_diameter[tool_id]) ** 2) * float(self.tool_extrusion_multiplier[tool_id]))
+        return A_ex, A_fil
+
+    # Calculate extrusion length for a distance 
+    def calculate_E(self, tool_id, layer_height, distance):
+        A_ex, A_fil = self.extrusion_factors(tool_id, layer_height)
+        V_out = A_ex * distance 
+        E = (V_out * 4.0) / A_fil
+            
+        return round(E,5)
+
+    # Get tool temperature 
+    def tool_temperature(self, layer_num, tool_id):
+        if layer_num is None or layer_num == 0:
+            return self.tool_temperature_layer0[tool_id]
+        else:
+            return self.tool_temperature_layerN[tool_id]
+
+# User settings of the module (read when the config is built)
+def defaults():
+    settings = dict((name, globals()[name]) for name in USER_SETTINGS)
+    settings['gcode_verbose'] = GCODE_VERBOSE
+    return settings
+
+# Slic3r settings captured from the environment (to hand the job over to the spool daemon)
+def slic3r_environ(environ = os.environ):
+    return {key : value for key, value in environ.items() if key.startswith('SLIC3R_')}
+
+# Config of the process - loaded from the environment on the first use (importing conf doesn't need the Slic3r environment)
+current_config = None
+
+def current():
+    global current_config
+    if current_config is None:
+        current_config = Config.from_environ()
+    return current_config
+
+# Load the config from the Slic3r environment as the config of the process
+def load(environ = os.environ):
+    global current_config
+    current_config = Config.from_environ(environ)
+    return current_config
+
+# Settings of the process config as the module attributes (conf.tool_nozzle_diameter, conf.move_speed_xy...)
+def __getattr__(name):
+    if name in Config.__dataclass_fields__:
+        return getattr(current(), name)
+    raise AttributeError("module 'conf' has no attribute '{name}'".format(name = name))
+
+# Helpers of the process config
 def max_layer_height(tool_set):
-    layer_height = 999.0
-    for tool in tool_set:
-        if tool_max_layer_height[tool] < layer_height:
-            layer_height = tool_max_layer_height[tool]
-    # Check if the layer height is valid 
-    # i.e. higher then min layer height for the tool set 
-    for tool in tool_set:
-        if layer_height < tool_min_layer_height[tool]:
-            tools = ','.join(['T' + str(tool) for tool in tool_set]),
-            raise ConfException("max_layer_height for [{tools}] = {layer_height} lower then min_layer_height for tool T{tool}".format(
-                tools = tools, layer_height = layer_height, tool = tool))
-      
-    return layer_height
-        
-# Get min layer height for set of tools
+    return current().max_layer_height(tool_set)
+
 def min_layer_height(tool_set):
-    layer_height = -999.0
-    for tool in tool_set:
-        if tool_min_layer_height[tool] > layer_height:
-            layer_height = tool_min_layer_height[tool]
-    # Check if the layer height is valid
-    # i.e. lower then max layer height for the tool set
-    for tool in tool_set:
-        if layer_height > tool_max_layer_height[tool]:
-            tools = ','.join(['T' + str(tool) for tool in tool_set]),
-            raise ConfException("min_layer_height for [{tools}] = {layer_height} higher then max_layer_height for tool T{tool}".format(
-                tools = tools, layer_height = layer_height, tool = tool))
-                    
-    return layer_height
-
-# Calculate extrusion length for a distance 
-def calculate_E(tool_id, layer_height, distance):
-    A_ex = ((float(tool_nozzle_diameter[tool_id]) - layer_height) * layer_height + math.pi * ((layer_height / 2.0) ** 2))
-    V_out = A_ex * distance 
-    E = (V_out * 4.0) / (math.pi * (float(tool_filament_diameter[tool_id]) ** 2) * float(tool_extrusion_multiplier[tool_id]))
-        
-    return round(E,5)
+    return current().min_layer_height(tool_set)
 
+def extrusion_factors(tool_id, layer_height):
+    return current().extrusion_factors(tool_id, layer_height)
+
+def calculate_E(tool_id, layer_height, distance):
+    return current().calculate_E(tool_id, layer_height, distance)
 
-# Get tool temperature 
 def tool_temperature(layer_num, tool_id):
-    if layer_num is None or layer_num == 0:
-        return tool_temperature_layer0[tool_id]
-    else:
-        return tool_temperature_layerN[tool_id]
+    return current().tool_temperature(layer_num, tool_id)
 
 # Validate slic3r settings
-def validate_slc3r_config():
-    if int(os.environ['SLIC3R_USE_FIRMWARE_RETRACTION']) == 0:
+def validate_slc3r_config(environ = os.environ):
+    if int(environ['SLIC3R_USE_FIRMWARE_RETRACTION']) == 0:
         raise ConfException("Slic3r is not configured to use Firmware retractions")
 
     # Check tool change retractions
-    if max([int(retraction) for retraction in os.environ['SLIC3R_RETRACT_LENGTH_TOOLCHANGE'].split(',')]) > 0:
+    if max([int(retraction) for retraction in environ['SLIC3R_RETRACT_LENGTH_TOOLCHANGE'].split(',')]) > 0:
         raise ConfException("Slic3r has non 0 'Retraction when tool disabled - Length' setting, set it to 0 for all extruders.")
 
-    if int(os.environ['SLIC3R_WIPE_TOWER']) != 0:
+    if int(environ['SLIC3R_WIPE_TOWER']) != 0:
         raise ConfException("Slic3r wipe tower enabled, please disable")
-
-
-  
\ No newline at end of file
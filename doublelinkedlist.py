@@ -1,13 +1,39 @@
 # Iterable double linked list 
 # Insert operations are O(1)
+# - splicing a list into another and clearing the list are amortized O(1) - the nodes refer to their list through
+#   a membership shared by the nodes linked in together, splicing re-points the memberships of the spliced
+#   list instead of every node
+# - once a list has more memberships than nodes they are compacted (the nodes are moved to the membership
+#   of the list) - a list holds at most len + 1 memberships after a splice, each compaction is paid for by
+#   the splices since the previous one
+# - detaching a sub-range is O(k) - the nodes of the range are counted and moved to the membership of the new list
+# Optional observer gets notified about the modifications:
+# - observer.node_inserted(node) - after the node has been linked in
+# - observer.nodes_inserted(first, last) - after the range of nodes has been spliced in
+# - observer.node_removed(node) - before the node is unlinked
+
+# List membership of the nodes
+class Membership:
+    def __init__(self, dll):
+        self.dll = dll
 
 # Double linked list Node (as inheritable)
 class Node:
+    __slots__ = ('membership', 'prev', 'next')
+
     def __init__(self, prev = None, next = None):
-        self.dll = None
+        self.membership = None
         self.prev = prev
         self.next = next
 
+    # List the node is linked in (None if not linked)
+    @property
+    def dll(self):
+        membership = self.membership
+        if membership is None:
+            return None
+        return membership.dll
+
     # Node append item left
     def append_node_left(self, node):
         self.dll.append_node_left_of(self, node)
@@ -16,13 +42,19 @@ class Node:
     def append_node(self, node):
         self.dll.append_node_at(self,node)
 
-    # Append nodes list on the left
+    # Append nodes list on the left (spliced if a DLList)
     def append_nodes_left(self, iterable):
+        if isinstance(iterable, DLList):
+            self.dll.splice_left_of(self, iterable)
+            return
         for node in iterable:
             self.dll.append_node_left_of(self, node)
 
-    # Append nodes list on the right
+    # Append nodes list on the right (spliced if a DLList)
     def append_nodes_right(self, iterable):
+        if isinstance(iterable, DLList):
+            self.dll.splice_at(self, iterable)
+            return
         for node in reversed(iterable):
             self.dll.append_node_at(self, node)
 
@@ -62,8 +94,12 @@ class DLList:
         self.head = None
         self.tail = None
         self.len = 0
+        self.observer = None
+        # Membership of the nodes linked in, memberships of the spliced lists
+        self.membership = Membership(self)
+        self.memberships = [self.membership]
         if iterable is not None:
-            self.join_nodes(iterable)
+            self.append_nodes(iterable)
 
     # Container functions
     def __iter__(self):
@@ -78,7 +114,7 @@ class DLList:
 
     # Most generic append
     def append_node_at(self, node_at, node):
-        if node_at.dll != self:
+        if node_at.dll is not self:
             raise ValueError("attempting to append at node that is not part of the dllist")
         if node.dll is not None:
             node.dll.remove_node(node)
@@ -88,13 +124,15 @@ class DLList:
             self.tail = node
         node.prev = node_at
         node.next = node_at.next
-        node.dll = self
+        node.membership = self.membership
         node_at.next = node
         self.len += 1
+        if self.observer is not None:
+            self.observer.node_inserted(node)
         return node
 
     def append_node_left_of(self, node_at, node):
-        if node_at.dll != self:
+        if node_at.dll is not self:
             raise ValueError("attempting to append at node that is not part of the dllist")
         if node.dll is not None:
             node.dll.remove_node(node)
@@ -104,14 +142,18 @@ class DLList:
             self.head = node
         node.prev = node_at.prev
         node.next = node_at
-        node.dll = self
+        node.membership = self.membership
         node_at.prev = node
         self.len += 1
+        if self.observer is not None:
+            self.observer.node_inserted(node)
         return node
 
     def remove_node(self, node):
-        if node.dll != self:
+        if node.dll is not self:
             raise ValueError("attempting to remove node not in list")
+        if self.observer is not None:
+            self.observer.node_removed(node)
         if node.prev is not None:
             node.prev.next = node.next
         else:
@@ -120,7 +162,7 @@ class DLList:
             node.next.prev = node.prev
         else:
             self.tail = node.prev
-        node.dll = None
+        node.membership = None
         node.prev = None
         node.next = None
         self.len -= 1
@@ -134,8 +176,10 @@ class DLList:
             self.head = node
             node.next = None
             node.prev = None
-            node.dll = self
+            node.membership = self.membership
             self.len = 1
+            if self.observer is not None:
+                self.observer.node_inserted(node)
         else:
             self.append_node_at(self.tail, node)
         return node
@@ -148,32 +192,158 @@ class DLList:
             self.tail = node
             node.next = None
             node.prev = None
-            node.dll = self
+            node.membership = self.membership
             self.len = 1
+            if self.observer is not None:
+                self.observer.node_inserted(node)
         else:
             self.append_node_left_of(self.head, node)
         return node
 
-    # Generic    
+    # Generic (spliced if a DLList)
     def append_nodes(self, iterable):
+        if isinstance(iterable, DLList):
+            self.append_nodes_dllist(iterable)
+            return
+        membership = self.membership
         for node in iterable:
-            self.append_node(node)
-
-    # Optimized for dlllist
+            # Fresh node at the tail of an unobserved list (parsing) - link in place
+            if node.membership is None and self.tail is not None and self.observer is None:
+                node.prev = self.tail
+                node.next = None
+                node.membership = membership
+                self.tail.next = node
+                self.tail = node
+                self.len += 1
+            else:
+                self.append_node(node)
+
+    # Splice the list at the tail
     def append_nodes_dllist(self, dllist):
-        # Replace heads and tails
-        dllist.head.prev = self.tail
-        self.tail.next = dllist.head
-        self.tail = dllist.tail
-        for node in dllist:
-            node.dll = self
-        dllist.head = None
-        dllist.tail = None
-
-    # Clear
+        self.splice(self.tail, None, dllist)
+
+    # Splice the list right of the node
+    def splice_at(self, node_at, dllist):
+        if node_at.dll is not self:
+            raise ValueError("attempting to splice at node that is not part of the dllist")
+        self.splice(node_at, node_at.next, dllist)
+
+    # Splice the list left of the node
+    def splice_left_of(self, node_at, dllist):
+        if node_at.dll is not self:
+            raise ValueError("attempting to splice at node that is not part of the dllist")
+        self.splice(node_at.prev, node_at, dllist)
+
+    # Link all the nodes of the list in between the prev and next node (None - head/tail)
+    # the list is left empty
+    def splice(self, prev, next, dllist):
+        if dllist is self:
+            raise ValueError("attempting to splice the dllist into itself")
+        if dllist.head is None:
+            return
+        first = dllist.head
+        last = dllist.tail
+
+        # Observed list - removed node by node
+        if dllist.observer is not None:
+            for node in reversed(dllist):
+                dllist.observer.node_removed(node)
+
+        # Move the nodes - the memberships are re-pointed
+        for membership in dllist.memberships:
+            membership.dll = self
+        self.memberships.extend(dllist.memberships)
+        self.len += dllist.len
+        dllist.reset()
+
+        first.prev = prev
+        last.next = next
+        if prev is not None:
+            prev.next = first
+        else:
+            self.head = first
+        if next is not None:
+            next.prev = last
+        else:
+            self.tail = last
+
+        if len(self.memberships) > self.len:
+            self.compact()
+
+        if self.observer is not None:
+            self.observer.nodes_inserted(first, last)
+
+    # Move all the nodes to the membership of the list - O(n)
+    def compact(self):
+        membership = self.membership
+        for node in self:
+            node.membership = membership
+        for spliced in self.memberships:
+            if spliced is not membership:
+                spliced.dll = None
+        self.memberships = [membership]
+
+    # Detach the nodes from first to last (inclusive) into a new list
+    # O(k) - the nodes are counted and moved to the membership of the new list
+    def detach(self, first, last):
+        if first.dll is not self or last.dll is not self:
+            raise ValueError("attempting to detach nodes not in list")
+        dllist = DLList()
+        membership = dllist.membership
+        count = 0
+        node = first
+        while True:
+            node.membership = membership
+            count += 1
+            if node is last:
+                break
+            node = node.next
+            if node is None:
+                raise ValueError("attempting to detach nodes out of order")
+
+        # Notified while linked (last to first - each node has its linked predecessor)
+        if self.observer is not None:
+            node = last
+            while True:
+                self.observer.node_removed(node)
+                if node is first:
+                    break
+                node = node.prev
+
+        if first.prev is not None:
+            first.prev.next = last.next
+        else:
+            self.head = last.next
+        if last.next is not None:
+            last.next.prev = first.prev
+        else:
+            self.tail = first.prev
+        first.prev = None
+        last.next = None
+        self.len -= count
+
+        dllist.head = first
+        dllist.tail = last
+        dllist.len = count
+        return dllist
+
+    # Clear - the nodes keep their links to each other, but are no longer in the list
+    # O(memberships) - see compact
     def clear(self):
-        while self.head is not None:
-            self.remove_node(self.head)    
+        if self.observer is not None:
+            for node in reversed(self):
+                self.observer.node_removed(node)
+        for membership in self.memberships:
+            membership.dll = None
+        self.reset()
+
+    # Empty list with a new membership
+    def reset(self):
+        self.head = None
+        self.tail = None
+        self.len = 0
+        self.membership = Membership(self)
+        self.memberships = [self.membership]
 
 # To test
 if __name__ == "__main__":
@@ -224,4 +394,20 @@ if __name__ == "__main__":
     print("after delete of n == 3")
     for n in dll1:
         print('n : {val}'.format(val = n.value))
-    
\ No newline at end of file
+    
+
+    print(" - splice/detach test")
+    dll2 = DLList([ValueNode("a"), ValueNode("b"), ValueNode("c")])
+    b = dll2.head.next
+    dll1.head.append_nodes_right(dll2)
+    print("after splice of a, b, c at head (len {len}, spliced list len {len2})".format(len = len(dll1), len2 = len(dll2)))
+    for n in dll1:
+        print('n : {val}'.format(val = n.value))
+
+    dll3 = dll1.detach(b, dll1.tail)
+    print("after detach from b to the tail (len {len}, detached len {len3}, b in detached list {member})".format(len = len(dll1), len3 = len(dll3), member = b.dll is dll3))
+    for n in dll1:
+        print('n : {val}'.format(val = n.value))
+
+    dll1.clear()
+    print("after clear (len {len}, head in list {member})".format(len = len(dll1), member = n.dll is dll1))
@@ -1,7 +1,8 @@
 
 import doublelinkedlist
+import shard_analysis
 import conf
-import copy, math, time                                           # G11 unretract (Firmware)
+import array, bisect, heapq, io, math, mmap, sys, types, os                                           # G11 unretract (Firmware)
 
 # Parse exception
 class GCodeParseException(Exception):
@@ -17,33 +18,63 @@ class GCodeStateException(Exception):
     def __init__(self, message):
         self.message = message
 
+# Shared params of the GCodes without params (read only - replace the param dict to add params)
+EMPTY_PARAMS = types.MappingProxyType({})
+
 # Token 
 # Is a double linked list node (makes it easy to iterate
+# Tokens are slotted (no per instance __dict__) - the parsed token list holds millions of them
 class Token(doublelinkedlist.Node):
+    __slots__ = ('type', 'runtime_estimate', 'runtime', 'seq', 'state_trace', 'src_start', 'src_end')
+
     # Token types  
     GCODE                    = 0 # GCode token
     TOOLCHANGE               = 1 # Tool change token
     PARAMS                   = 2 # Params in Comment  ;;Label:p1,p2,p3
     COMMENT                  = 3 # Comment (no params)
+    MOVES                    = 4 # Folded run of moves (sparse token list)
         
     def __init__(self, type, runtime_estimate = 0):
         doublelinkedlist.Node.__init__(self)
         self.type = type
         self.runtime_estimate = runtime_estimate
-        self.state_pre = None
-        self.state_post = None
+        self.runtime = 0
         self.seq = None
+        self.state_trace = None
+        # Source bytes of the token in the parsed buffer [src_start, src_end) - None if injected/modified
+        self.src_start = None
+        self.src_end = None
+
+    # Token has been modified - serialize from the attributes instead of copying the source
+    def invalidate_source(self):
+        self.src_start = None
+        self.src_end = None
+
+    # State before/after the token - None if the token has not been analyzed
+    # Rebuilt on request from the state trace of the last analyze_state run
+    @property
+    def state_pre(self):
+        if self.state_trace is None:
+            return None
+        return self.state_trace.state_pre(self)
+
+    @property
+    def state_post(self):
+        if self.state_trace is None:
+            return None
+        return self.state_trace.state_post(self)
     
 # GCode token
 class GCode(Token):
+    __slots__ = ('gcode', 'param', 'comment')
+
     def __init__(self, gcode, param = None, comment = ""):
         Token.__init__(self, type = Token.GCODE)
         self.gcode = gcode
         self.param = param
         if self.param is None:
-            self.param = {}
+            self.param = EMPTY_PARAMS
         self.comment = comment
-        self.runtime = 0
             
     # Serialize into the str
     def __str__(self):
@@ -54,6 +85,8 @@ class GCode(Token):
    
 # Tool Change token
 class ToolChange(Token):
+    __slots__ = ('prev_tool', 'next_tool')
+
     def __init__(self, prev_tool, next_tool):
         Token.__init__(self, type = Token.TOOLCHANGE)
         self.prev_tool = prev_tool
@@ -65,6 +98,8 @@ class ToolChange(Token):
 
 # Comment - just text
 class Comment(Token):
+    __slots__ = ('text',)
+
     def __init__(self, text):
         Token.__init__(self, type = Token.COMMENT)
         self.text = text
@@ -75,6 +110,8 @@ class Comment(Token):
 
 # Comment Params
 class Params(Token):
+    __slots__ = ('label', 'param')
+
     def __init__(self, label, param = []):
         Token.__init__(self, type = Token.PARAMS)
         self.label = label
@@ -86,6 +123,69 @@ class Params(Token):
             label = self.label,
             params = ','.join([str(p) for p in self.param]))
 
+# Folded run of controlled moves (G1) - sparse token list
+# Keeps the source range of the moves and their effect on the state instead of the move tokens
+# - runtime_estimate is the runtime of the moves from the state they were parsed with
+# - written from the source only
+class MoveSpan(Token):
+    __slots__ = ('moves', 'x', 'y', 'z', 'feed_rate', 'e', 'e_last')
+
+    def __init__(self):
+        Token.__init__(self, type = Token.MOVES)
+        self.moves = 0
+        self.x = None
+        self.y = None
+        self.z = None
+        self.feed_rate = None
+        # E of the moves - total (relative E) and last (absolute E)
+        self.e = None
+        self.e_last = None
+
+    # Fold the move in - the state stack is updated with the move
+    def add_move(self, state_stack, token):
+        self.runtime_estimate += GCodeAnalyzer.apply_token(state_stack, token)
+        param = token.param
+        if 'X' in param:
+            self.x = float(param['X'])
+        if 'Y' in param:
+            self.y = float(param['Y'])
+        if 'Z' in param:
+            self.z = float(param['Z'])
+        if 'F' in param:
+            self.feed_rate = float(param['F'])
+        if 'E' in param:
+            self.e_last = float(param['E'])
+            self.e = self.e_last if self.e is None else self.e + self.e_last
+        if self.moves == 0:
+            self.src_start = token.src_start
+        self.src_end = token.src_end
+        self.moves += 1
+
+    # Split the span after the last move starting within the runtime from the start of the span
+    # - the moves are re-tokenized from the source, state_stack is the state before the span
+    # - the span keeps the moves up to the split (at least the first one)
+    # returns the span of the moves after the split (None if the span is not split)
+    def split(self, source, state_stack, runtime):
+        src_start = self.src_start
+        moves = tokenize_bytes(iter(io.BytesIO(source[src_start:self.src_end]).readline, b''))
+        self.runtime_estimate = 0
+        self.moves = 0
+        self.x = self.y = self.z = self.feed_rate = self.e = self.e_last = None
+        tail = None
+        for move in moves:
+            move.src_start += src_start
+            move.src_end += src_start
+            if tail is None and (self.moves == 0 or self.runtime_estimate <= runtime):
+                self.add_move(state_stack, move)
+            else:
+                if tail is None:
+                    tail = MoveSpan()
+                tail.add_move(state_stack, move)
+        return tail
+
+    def __str__(self):
+        raise GCodeSerializeException("Folded moves can only be written from the source")
+
 # params formats 
 valid_params_format = {
     'TC_TEMP_INITIALIZE'    : [],
@@ -96,16 +196,389 @@ valid_params_format = {
     'TOOL_BLOCK_END'        : [int]
     }
 
+# Line tokenizer
+# Keeps the tool tracking between the lines
+# Opcodes and comments are interned - the same few strings repeat over millions of lines
+class Tokenizer:
+
+    # G0/G1 moves - split straight from the bytes by tokenize_bytes
+    MOVE_PREFIXES = (b'G0 ', b'G1 ')
+    MOVE_GCODES = {b'G0': 'G0', b'G1': 'G1'}
+
+    def __init__(self):
+        self.current_tool_head = -1
+
+    # Tokenize a single line - None if the line has no token
+    def tokenize_line(self, line):
+        line = line.strip()
+
+        if len(line) == 0:
+            return None
+
+        # Check if comment
+        if line[0] == ';':
+            # Check if comment params - starts with ;;
+            if len(line) > 1 and line[1] == ';':
+                contents = line[2:]
+                # Check if has extra comment - strip
+                comment_pos = contents.find(';')
+                if comment_pos != -1:
+                    contents = contents[0:comment_pos].strip()
+                # Check if has params
+                label = None
+                params = []
+
+                params_sep = contents.find(':')
+                if params_sep != -1:
+                    label = contents[0:params_sep].strip()
+                    params = contents[params_sep+1:].split(',')
+                else:
+                    label = contents.strip()
+
+                # Check if the label in params
+                if label not in valid_params_format.keys():
+                    raise GCodeParseException("Param {label} not valid".format(label = label), line)
+                if len(params) != len(valid_params_format[label]):
+                    raise GCodeParseException("Param {label} has invalid number of arguments".format(label = label), line)
+
+                return Params(
+                    label = label,
+                    param = [valid_params_format[label][indx](params[indx]) for indx in range(0, len(params))])
+            # Check if normal comment - single ;
+            if len(line) > 1 and line[1] != ';':
+                text = line[1:]
+
+                return Comment(text = text)
+            # Empty comment - skip
+            if len(line) == 1:
+                return None
+
+        # Check if GCODE 
+        if line[0] in ['G', 'M']:
+            contents = line
+            comment = ""
+            # Check if has extra comment - strip
+            comment_pos = line.find(';')
+            if comment_pos != -1:
+                contents = line[0:comment_pos].strip()
+                comment = sys.intern(line[comment_pos+1:].strip())
+
+            # Split into params
+            args = contents.split()
+            gcode = sys.intern(args[0])
+            # # Check if omit the code
+            if len(args) == 1:
+                return GCode(
+                    gcode = gcode,
+                    comment = comment)
+            else:
+                return GCode(
+                    gcode = gcode,
+                    param = dict([(p[0], p[1:]) for p in args[1:]]),
+                    comment = comment)
+
+        # Check if Toolchange
+        if line[0] == 'T':
+            # Check if has extra comment - strip
+            contents = line
+            comment_pos = line.find(';')
+            if comment_pos != -1:
+                contents = line[0:comment_pos].strip()
+
+            previous_tool_head = self.current_tool_head
+            self.current_tool_head = int(contents[1:])
+
+            return ToolChange(
+                prev_tool = previous_tool_head,
+                next_tool = self.current_tool_head)
+
+        return None
+
+# Tokenize the GCode
+# Generator - yields the tokens one line at a time so the source can be consumed
+# incrementally (file, pipe, stdin) without holding all the lines in memory
+def tokenize(lines):
+    tokenizer = Tokenizer()
+
+    for line in lines:
+        token = tokenizer.tokenize_line(line)
+        if token is not None:
+            yield token
+
+# Tokenize the GCode from byte lines (mmap, binary file)
+# G0/G1 moves (most of the lines) are split straight from the bytes, the rest
+# (comments, params, tool changes, other codes) goes through the line tokenizer
+# - each token records its source range, including the skipped lines (empty...) before it
+def tokenize_bytes(lines):
+    tokenizer = Tokenizer()
+    move_prefixes = Tokenizer.MOVE_PREFIXES
+    move_gcodes = Tokenizer.MOVE_GCODES
+
+    src_start = 0
+    src_end = 0
+    for line in lines:
+        src_end += len(line)
+
+        if line.startswith(move_prefixes):
+            comment_pos = line.find(b';')
+            if comment_pos == -1:
+                args = line.decode('utf8').split()
+                comment = ""
+            else:
+                args = line[0:comment_pos].decode('utf8').split()
+                comment = sys.intern(line[comment_pos+1:].strip().decode('utf8'))
+            token = GCode(
+                gcode = move_gcodes[line[0:2]],
+                param = {p[0]: p[1:] for p in args[1:]},
+                comment = comment)
+        else:
+            token = tokenizer.tokenize_line(line.decode('utf8'))
+            if token is None:
+                continue
+
+        token.src_start = src_start
+        token.src_end = src_end
+        src_start = src_end
+        yield token
+
+# Fold the runs of moves into MoveSpan tokens, the other tokens pass thru
+# The tokens are analyzed while folding (span runtimes are from the state before the span)
+def fold_moves(tokens, config):
+    GCODE = Token.GCODE
+    state_stack = [GCodeAnalyzer.State(config = config)]
+    span = None
+    for token in tokens:
+        if token.type == GCODE and token.gcode == 'G1':
+            if span is None:
+                span = MoveSpan()
+            span.add_move(state_stack, token)
+            continue
+        if span is not None:
+            yield span
+            span = None
+        GCodeAnalyzer.apply_token(state_stack, token)
+        yield token
+    if span is not None:
+        yield span
+
+# Cumulative runtime index
+# Built over the tokens of the last analysis, answers the time queries in O(log N)
+# - tokens added after the analysis are not indexed (count as no runtime)
+# - tokens are located by the analysis seq
+class RuntimeIndex:
+
+    def __init__(self, tokens, state_trace = None):
+        self.state_trace = state_trace
+        self.tokens = []
+        self.seqs = array.array('l')
+        # runtime_acc[indx] - total runtime of the tokens before tokens[indx]
+        self.runtime_acc = array.array('d', [0.0])
+
+        total_runtime = 0.0
+        for token in tokens:
+            if token.state_trace is not state_trace:
+                continue
+            self.seqs.append(token.seq)
+            self.tokens.append(token)
+            total_runtime += token.runtime
+            self.runtime_acc.append(total_runtime)
+
+    # Position of the token in the index
+    def position(self, token):
+        if token.state_trace is self.state_trace:
+            return bisect.bisect_left(self.seqs, token.seq)
+        raise GCodeStateException("Token {token} is not in the runtime index".format(token = str(token)))
+
+    # Runtime of the tokens in between token_from and token_to (both excluded)
+    def elapsed(self, token_from, token_to):
+        return self.runtime_acc[self.position(token_to)] - self.runtime_acc[self.position(token_from) + 1]
+
+    # Latest token before token_to where the runtime from the token up to token_to is at least runtime
+    # - first token if there is not enough runtime before token_to
+    def token_before(self, token_to, runtime):
+        if runtime <= 0.0:
+            return token_to.prev
+        indx_to = self.position(token_to)
+        indx = bisect.bisect_right(self.runtime_acc, self.runtime_acc[indx_to] - runtime, 0, indx_to) - 1
+        return self.tokens[max(indx, 0)]
+
+    # Runtime of the tokens before the token
+    def runtime_before(self, token):
+        return self.runtime_acc[self.position(token)]
+
+# Tokens from first to last (both included) - None is the head/tail of the list
+def token_range(tokens, first = None, last = None):
+    token = tokens.head if first is None else first
+    while token is not None:
+        yield token
+        if last is not None and token == last:
+            break
+        token = token.next
+
+# Layer index
+# The layer change/tool change/tool block markers of the token list in the list order
+# - layers start at the BEFORE_LAYER_CHANGE params and end right before the next layer
+# - markers before the first layer (start GCode) are only in the markers list
+# - the index refers to the tokens, the unmarked tokens can be added/removed freely - adding or
+#   removing a marker drops the index (GCodeAnalyzer.layer_index rebuilds it)
+class LayerIndex:
+
+    # Marker params labels
+    LABELS = ('BEFORE_LAYER_CHANGE', 'AFTER_LAYER_CHANGE', 'TOOL_BLOCK_START', 'TOOL_BLOCK_END')
+
+    # Layer of the index
+    class Layer:
+        def __init__(self, layer_num, layer_z, start):
+            self.layer_num = layer_num
+            self.layer_z = layer_z
+            self.start = start              # BEFORE_LAYER_CHANGE
+            self.after = None               # AFTER_LAYER_CHANGE
+            self.next = None                # Next layer in the file
+            self.tool_changes = []          # Tool changes in the layer
+            self.tool_blocks = []           # TOOL_BLOCK_START/END in the layer
+
+        # Last token of the layer
+        @property
+        def end(self):
+            if self.next is not None:
+                return self.next.start.prev
+            return self.start.dll.tail
+
+    def __init__(self):
+        self.markers = []
+        self.layers = []
+        self.layer_by_num = {}
+
+    # Container functions - iterates over the layers
+    def __iter__(self):
+        return iter(self.layers)
+
+    def __len__(self):
+        return len(self.layers)
+
+    @staticmethod
+    def is_marker(token):
+        return token.type == Token.TOOLCHANGE or (token.type == Token.PARAMS and token.label in LayerIndex.LABELS)
+
+    # Layer by the layer number (None if not in the file)
+    def layer(self, layer_num):
+        return self.layer_by_num.get(layer_num)
+
+    # Add the marker - markers are added in the list order
+    def add_marker(self, token):
+        self.markers.append(token)
+        if token.type == Token.TOOLCHANGE:
+            if len(self.layers) > 0:
+                self.layers[-1].tool_changes.append(token)
+        elif token.label == 'BEFORE_LAYER_CHANGE':
+            layer = LayerIndex.Layer(token.param[0], token.param[1], token)
+            if len(self.layers) > 0:
+                self.layers[-1].next = layer
+            self.layers.append(layer)
+            if layer.layer_num not in self.layer_by_num:
+                self.layer_by_num[layer.layer_num] = layer
+        elif len(self.layers) > 0:
+            if token.label == 'AFTER_LAYER_CHANGE':
+                self.layers[-1].after = token
+            else:
+                self.layers[-1].tool_blocks.append(token)
+
+    # Pass thru the tokens while indexing the markers
+    def scan(self, tokens):
+        TOOLCHANGE = Token.TOOLCHANGE
+        PARAMS = Token.PARAMS
+        for token in tokens:
+            if (token.type == TOOLCHANGE or token.type == PARAMS) and LayerIndex.is_marker(token):
+                self.add_marker(token)
+            yield token
+
+    # Index of the token list
+    @staticmethod
+    def build(tokens):
+        layer_index = LayerIndex()
+        for token in layer_index.scan(tokens):
+            pass
+        return layer_index
+
+# Token index
+# Tokens of the token list by the token type, GCode opcode and params label
+# - keys are ('type', type), ('gcode', opcode), ('label', label)
+# - the moves (G0/G1) are most of the file and are not indexed, neither is the GCODE type
+# - each key keeps its tokens in the list order as long as the tokens are only appended/removed,
+#   tokens inserted afterwards mark the key as unordered (sorted on the next lookup)
+class TokenIndex:
+
+    # Opcodes not indexed
+    SKIP_GCODES = ('G0', 'G1')
+
+    def __init__(self):
+        self.entries = {}
+        self.unordered = set()
+
+    # Index keys of the token (folded moves are not indexed either)
+    @staticmethod
+    def keys(token):
+        if token.type == Token.MOVES:
+            return ()
+        if token.type == Token.GCODE:
+            if token.gcode in TokenIndex.SKIP_GCODES:
+                return ()
+            return (('gcode', token.gcode),)
+        if token.type == Token.PARAMS:
+            return (('type', Token.PARAMS), ('label', token.label))
+        return (('type', token.type),)
+
+    # Add the token
+    # - ordered - the token comes after the tokens already indexed under its keys
+    def add(self, token, ordered = True):
+        for key in TokenIndex.keys(token):
+            tokens = self.entries.get(key)
+            if tokens is None:
+                tokens = self.entries[key] = {}
+            elif not ordered:
+                self.unordered.add(key)
+            tokens[token] = None
+
+    def remove(self, token):
+        for key in TokenIndex.keys(token):
+            tokens = self.entries.get(key)
+            if tokens is not None:
+                tokens.pop(token, None)
+
+    # Pass thru the tokens while indexing them (and the layer markers)
+    def scan(self, tokens, layer_index = None):
+        GCODE = Token.GCODE
+        SKIP_GCODES = TokenIndex.SKIP_GCODES
+        for token in tokens:
+            if token.type != GCODE or token.gcode not in SKIP_GCODES:
+                self.add(token)
+                if layer_index is not None and LayerIndex.is_marker(token):
+                    layer_index.add_marker(token)
+            yield token
+
+    # Index of the token list
+    @staticmethod
+    def build(tokens):
+        token_index = TokenIndex()
+        for token in token_index.scan(tokens):
+            pass
+        return token_index
+
 # GCode analyzer
 # Used to iterate over the parsed token list and while collecting the state
 class GCodeAnalyzer:
 
+    # Number of tokens between the state snapshots
+    STATE_SNAPSHOT_INTERVAL = 64
+
     # GCode state
     class State:
 
         UNRETRACTED = 1
         RETRACTED = 2
 
+        __slots__ = ('x', 'y', 'z', 'layer_num', 'feed_rate', 'tool_selected', 'tool_extrusion', 'tool_retraction', 'e_relative', 'config')
+
         # Constructor
         def __init__(self, 
                      x = None, 
@@ -116,7 +589,8 @@ class GCodeAnalyzer:
                      tool_selected = None, 
                      tool_extrusion = None, 
                      tool_retraction = None,
-                     e_relative = True):
+                     e_relative = True,
+                     config = None):
             self.x = x
             self.y = y
             self.z = z
@@ -132,6 +606,8 @@ class GCodeAnalyzer:
             else:
                 self.tool_retraction = tool_retraction
             self.e_relative = e_relative
+            # Job config (runtime estimates)
+            self.config = config
 
         # Copy
         def copy(self):
@@ -144,39 +620,90 @@ class GCodeAnalyzer:
                 tool_selected = self.tool_selected,
                 tool_extrusion = self.tool_extrusion.copy(),
                 tool_retraction = self.tool_retraction.copy(),
-                e_relative = self.e_relative)
+                e_relative = self.e_relative,
+                config = self.config)
             return lhs
 
+        # Check if the states match - extrusion totals aside
+        # (with relative E the totals don't affect the states/runtimes that follow)
+        def matches(self, other):
+            return (self.x == other.x and 
+                    self.y == other.y and 
+                    self.z == other.z and 
+                    self.layer_num == other.layer_num and 
+                    self.feed_rate == other.feed_rate and 
+                    self.tool_selected == other.tool_selected and 
+                    self.tool_retraction == other.tool_retraction and 
+                    self.tool_extrusion.keys() == other.tool_extrusion.keys() and 
+                    self.e_relative and other.e_relative)
+
+        # Limit the feed rate to the max speed of the axis
+        @staticmethod
+        def limit_speed(feed_rate, max_speed):
+            if feed_rate is not None:
+                return min(feed_rate, max_speed)
+            else:
+                return max_speed
+
         # Get the move speed
         @property
         def move_speed_x(self):
-            if self.feed_rate is not None:
-                return min(self.feed_rate, conf.move_speed_xy) 
-            else:
-                return conf.move_speed_xy
+            return GCodeAnalyzer.State.limit_speed(self.feed_rate, self.config.move_speed_xy)
 
         @property
         def move_speed_y(self):
-            if self.feed_rate is not None:
-                return min(self.feed_rate, conf.move_speed_xy)
-            else:
-                return conf.move_speed_xy
+            return GCodeAnalyzer.State.limit_speed(self.feed_rate, self.config.move_speed_xy)
 
         @property
         def move_speed_z(self):
-            if self.feed_rate is not None:
-                return min(self.feed_rate, conf.move_speed_z)
-            else:
-                return conf.move_speed_z
+            return GCodeAnalyzer.State.limit_speed(self.feed_rate, self.config.move_speed_z)
 
         @property 
         def extrud_speed(self):
             if self.tool_selected is None:
                 return None
-            if self.feed_rate is not None:
-                return min(self.feed_rate, conf.printer_extruder_speed[self.tool_selected])
-            else:
-                return conf.extruder_speed[self.tool_selected]
+            return GCodeAnalyzer.State.limit_speed(self.feed_rate, self.config.printer_extruder_speed[self.tool_selected])
+
+        # Controlled move (G1) - updates the state in place
+        # Returns the runtime estimate of the move
+        # - move speed is averaged between the feed rate before and after the move
+        def move(self, x = None, y = None, z = None, e = None, f = None):
+            limit_speed = GCodeAnalyzer.State.limit_speed
+            config = self.config
+            runtime = 0.0
+
+            feed_rate_pre = self.feed_rate
+            if f is not None: 
+                self.feed_rate = float(f)
+            if x is not None:
+                x0 = self.x if self.x != None else 0.0
+                self.x = float(x)
+                x_time = abs(self.x - x0) * 120.0 / (limit_speed(feed_rate_pre, config.move_speed_xy) + limit_speed(self.feed_rate, config.move_speed_xy))
+                if x_time > runtime: runtime = x_time
+            if y is not None:
+                y0 = self.y if self.y != None else 0.0
+                self.y = float(y)
+                y_time = abs(self.y - y0) * 120.0 / (limit_speed(feed_rate_pre, config.move_speed_xy) + limit_speed(self.feed_rate, config.move_speed_xy))
+                if y_time > runtime: runtime = y_time
+            if z is not None:
+                z0 = self.z if self.z != None else 0.0
+                self.z = float(z)
+                z_time = abs(self.z - z0) * 120.0 / (limit_speed(feed_rate_pre, config.move_speed_z) + limit_speed(self.feed_rate, config.move_speed_z))
+                if z_time > runtime: runtime = z_time
+            if e is not None:
+                tool_id = self.tool_selected
+                e0 = self.tool_extrusion[tool_id]
+                if self.e_relative:
+                    e_delta = float(e)
+                    self.tool_extrusion[tool_id] = e0 + e_delta
+                else:
+                    e_delta = float(e) - e0
+                    self.tool_extrusion[tool_id] = float(e)
+                extruder_speed = config.printer_extruder_speed[tool_id]
+                e_time = abs(e_delta) * 120.0 / (limit_speed(feed_rate_pre, extruder_speed) + limit_speed(self.feed_rate, extruder_speed))
+                if e_time > runtime: runtime = e_time
+
+            return runtime
 
         # Setter/getter for retraction
         @property 
@@ -205,25 +732,332 @@ class GCodeAnalyzer:
         def e(self, val):
             self.tool_extrusion[self.tool_selected] = val
 
+    # Trace of the analyzed states
+    # Keeps a snapshot of the state stack every <interval> tokens, the state
+    # of any token is replayed from the closest snapshot before it
+    # - tokens added after the analysis are skipped (have no state)
+    # - last replayed position is cached, so walking the tokens in order is O(1) per token
+    class StateTrace:
+
+        def __init__(self, interval, config):
+            self.interval = interval
+            self.config = config
+            self.snapshots = []                 # (token, state stack after token, total runtime after token)
+            self.seqs = []                      # seq of the snapshot tokens
+            self.valid = True
+
+            # Last replayed token - (token, state before, state stack after)
+            self.cursor = None
+
+        def add_snapshot(self, seq, token, state_stack, total_runtime):
+            self.seqs.append(seq)
+            self.snapshots.append((token, [state.copy() for state in state_stack], total_runtime))
+
+        # Find the closest snapshot before the token still in the token list
+        # returns the snapshot index or -1
+        def find_snapshot(self, token):
+            snapshot_indx = bisect.bisect_right(self.seqs, token.seq) - 1
+            while snapshot_indx >= 0 and self.snapshots[snapshot_indx][0].dll is not token.dll:
+                snapshot_indx -= 1
+            return snapshot_indx
+
+        # Replay the state stack up to the token
+        # returns (state before, state stack after) 
+        def replay(self, token):
+            if not self.valid or token.dll is None:
+                return None, None
+
+            # Check if can continue from the last replayed token
+            cursor = self.cursor
+            if cursor is not None and cursor[0] is token:
+                return cursor[1], cursor[2]
+
+            snapshot_indx = self.find_snapshot(token)
+            snapshot_seq = self.seqs[snapshot_indx] if snapshot_indx >= 0 else -1
+            if cursor is not None and cursor[0].dll is token.dll and snapshot_seq <= cursor[0].seq < token.seq:
+                start, state_stack = cursor[0], cursor[2]
+            elif snapshot_indx >= 0:
+                start, snapshot_stack, _ = self.snapshots[snapshot_indx]
+                state_stack = [state.copy() for state in snapshot_stack]
+            else:
+                start = None
+
+            if start is None:
+                # All snapshots before the token removed - replay from the beginning
+                state_stack = [GCodeAnalyzer.State(config = self.config)]
+                node = token.dll.head
+            elif start is token:
+                node = None
+                state_pre = None
+            else:
+                node = start.next
+
+            while node is not None:
+                if node.state_trace is self:
+                    if node is token:
+                        state_pre = state_stack[-1].copy()
+                    GCodeAnalyzer.apply_token(state_stack, node)
+                    if node is token:
+                        break
+                node = node.next
+
+            self.cursor = (token, state_pre, state_stack)
+            return state_pre, state_stack
+
+        def state_pre(self, token):
+            state_pre, state_stack = self.replay(token)
+            if state_stack is None:
+                return None
+            # First token of the snapshot - state after the previous analyzed token
+            if state_pre is None:
+                node = token.prev
+                while node is not None and node.state_trace is not self:
+                    node = node.prev
+                if node is None:
+                    return GCodeAnalyzer.State(config = self.config)
+                return self.state_post(node)
+            return state_pre
+
+        def state_post(self, token):
+            state_pre, state_stack = self.replay(token)
+            if state_stack is None:
+                return None
+            return state_stack[-1].copy()
+
+        # Total runtime up to (and including) the token
+        def total_runtime(self, token):
+            snapshot_indx = self.find_snapshot(token)
+            if snapshot_indx >= 0:
+                node, _, total = self.snapshots[snapshot_indx]
+                node = node.next if node is not token else None
+            else:
+                node, total = token.dll.head, 0.0
+            while node is not None:
+                if node.state_trace is self:
+                    total += node.runtime
+                if node is token:
+                    break
+                node = node.next
+            return total
+
     # Initialize
-    def __init__(self, gcode_file = None):
+    # - workers - number of processes to parse and analyze the file with (shard_analysis)
+    # - sparse - fold the moves into MoveSpan tokens, only the other tokens are kept (needs the file path,
+    #   the output is streamed from the source - injection_plan)
+    # - config - job config (conf.Config), the config of the process (loaded from the environment) if not set
+    # - log - text stream the reports are printed to (stdout if None)
+    def __init__(self, gcode_file = None, workers = 1, sparse = False, config = None, log = None):
+        self.config = config if config is not None else conf.current()
+        self.log = log
+        self.workers = workers
+        self.sparse = sparse
+        self.state_trace = None
+
+        # Modified token ranges since the last analysis
+        # - anchors are the last unmodified tokens before each modified range
+        self.dirty_anchors = set()
+        self.dirty_head = False
+
+        # Tokens inserted/removed since parsing
+        self.tokens_inserted = 0
+        self.tokens_removed = 0
+
+        # Runtime index of the last analysis
+        self.cached_runtime_index = None
+
+        # Layer/token index of the token list
+        self.cached_layer_index = None
+        self.cached_token_index = None
+
+        # Source buffer of the parsed file (tokens refer to it), line ending for the new tokens
+        self.source_file = None
+        self.source = None
+        self.newline = b'\n'
+
+        self.total_runtime = 0
         if gcode_file is None:
-            self.tokens = doublelinkedlist.DLLList()
+            self.tokens = self.new_token_list()
         else:
             self.parse(gcode_file)
-        self.total_runtime = 0
 
         # cached list
         self.cached_tokens = []
         
+    # Apply the token to the state stack
+    # - top of the stack is updated in place
+    # - returns the runtime estimate of the token
+    @staticmethod
+    def apply_token(state_stack, token):
+        state = state_stack[-1]
+
+        # Tool change token
+        if token.type == Token.TOOLCHANGE:
+            if token.next_tool == -1:
+                state.tool_selected = None
+            else:
+                state.tool_selected = token.next_tool
+            
+                # Basically first time the tool is used
+                if token.next_tool not in state.tool_extrusion:
+                    state.tool_extrusion[token.next_tool] = 0.0
+            return state.config.runtime_tool_change
+        # GCode 
+        elif token.type == Token.GCODE:
+            # Add retraction
+            if token.gcode == 'G10': # Firmware retract
+                state.retraction = GCodeAnalyzer.State.RETRACTED
+                return state.config.runtime_default
+            elif token.gcode == 'G11': # Firmware unretract
+                state.retraction = GCodeAnalyzer.State.UNRETRACTED
+                return state.config.runtime_default
+            elif token.gcode == 'G1': # Controlled move
+                # TODO: For time being just treat X/Y/Z absolute
+                param = token.param
+                return state.move(
+                    x = param.get('X'), y = param.get('Y'), z = param.get('Z'), e = param.get('E'), f = param.get('F'))
+            elif token.gcode == 'M120': # Push state onto stack
+                # Push the copy of the current state onto the stack - experimental
+                state_stack.append(state.copy())
+            elif token.gcode == 'M121': # Pop state from the stack 
+                # Pop the copy of the current state from the stack - experimental
+                state_stack.pop()
+            return 0.0
+        # PARAM
+        elif token.type == Token.PARAMS:
+            # Track layer changes
+            if token.label == 'AFTER_LAYER_CHANGE':
+                state.layer_num = token.param[0]
+            return 0.0
+        # Folded moves
+        elif token.type == Token.MOVES:
+            if token.x is not None:
+                state.x = token.x
+            if token.y is not None:
+                state.y = token.y
+            if token.z is not None:
+                state.z = token.z
+            if token.feed_rate is not None:
+                state.feed_rate = token.feed_rate
+            if token.e is not None:
+                if state.e_relative:
+                    state.tool_extrusion[state.tool_selected] += token.e
+                else:
+                    state.tool_extrusion[state.tool_selected] = token.e_last
+            return token.runtime_estimate
+        else:
+            return state.config.runtime_default
+
     # Analyze the tokens - from beggining to end
     # State is after GCode execution
     # - also calculates the runtimes
+    # - the states are not stored per token, only a snapshot of the state stack every
+    #   STATE_SNAPSHOT_INTERVAL tokens - token.state_pre/state_post are replayed from the snapshots
+    # - results are cached, after the token list has been modified only the modified
+    #   ranges are re-analyzed
     def analyze_state(self):
+        if self.state_trace is None:
+            self.analyze_state_full()
+        elif self.dirty_head or len(self.dirty_anchors) > 0:
+            self.analyze_state_dirty()
+        else:
+            return self.tokens
+
+        self.cached_runtime_index = None
+        return self.tokens
+
+    # Cumulative runtime index of the last analysis
+    def runtime_index(self):
+        if self.state_trace is None:
+            self.analyze_state()
+        if self.cached_runtime_index is None:
+            self.cached_runtime_index = RuntimeIndex(self.tokens, self.state_trace)
+        return self.cached_runtime_index
+
+    # Layer index of the token list
+    # - built while parsing, rebuilt after the markers have been modified
+    def layer_index(self):
+        if self.cached_layer_index is None:
+            self.cached_layer_index = LayerIndex.build(self.tokens)
+        return self.cached_layer_index
+
+    # Token to inject the GCode after - runtime before token_to (see RuntimeIndex.token_before)
+    # - the move span the point falls into is split at the move, the point is the same as with the moves
+    #   not folded (sparse token list)
+    # - the moves split off follow the span unanalyzed (the split span is re-analyzed with the next analyze_state),
+    #   the next points in them are looked up from the span
+    def inject_point_before(self, token_to, runtime):
+        runtime_index = self.runtime_index()
+        span = runtime_index.token_before(token_to, runtime)
+        if span.type != Token.MOVES or runtime <= 0.0:
+            return span
+        runtime = runtime_index.runtime_before(token_to) - runtime - runtime_index.runtime_before(span)
+
+        # Span (or the moves split off it before) the point is in
+        trace = span.state_trace
+        state_stack = [span.state_pre.copy()]
+        node = span.next
+        while node is not None and node.state_trace is not trace:
+            if node.type == Token.MOVES:
+                if span.runtime_estimate > runtime:
+                    break
+                runtime -= span.runtime_estimate
+                GCodeAnalyzer.apply_token(state_stack, span)
+                span = node
+            node = node.next
+
+        tail = span.split(self.source, state_stack, runtime)
+        if tail is not None:
+            if span.state_trace is trace:
+                # Re-analyzed from the token before
+                span.runtime = span.runtime_estimate
+                self.mark_dirty(span.prev)
+            span.append_node(tail)
+        return span
+
+    # Runtime of the tokens before the layer
+    def layer_start_runtime(self, layer):
+        return self.runtime_index().runtime_before(layer.start)
+
+    # Token index of the token list
+    # - built while parsing, kept up to date with the token list modifications
+    def token_index(self):
+        if self.cached_token_index is None:
+            self.cached_token_index = TokenIndex.build(self.tokens)
+        return self.cached_token_index
+
+    # Indexed tokens in the list order
+    # - unordered keys are sorted by the analysis seq
+    def indexed_tokens(self, key):
+        token_index = self.token_index()
+        if key in token_index.unordered:
+            self.analyze_state()
+            token_index.entries[key] = dict.fromkeys(sorted(token_index.entries[key], key = lambda token: token.seq))
+            token_index.unordered.discard(key)
+        return list(token_index.entries.get(key, ()))
+
+    def tokens_by_type(self, type):
+        return self.indexed_tokens(('type', type))
+
+    def tokens_by_gcode(self, gcode):
+        return self.indexed_tokens(('gcode', gcode))
+
+    def tokens_by_label(self, label):
+        return self.indexed_tokens(('label', label))
+
+    # Analyze all the tokens
+    def analyze_state_full(self):
+        # Invalidate the states of the previous run
+        if self.state_trace is not None:
+            self.state_trace.valid = False
+        self.state_trace = GCodeAnalyzer.StateTrace(self.STATE_SNAPSHOT_INTERVAL, self.config)
+        self.dirty_anchors = set()
+        self.dirty_head = False
+        trace = self.state_trace
+
         # State stack - to handle M120 and M121
-        # For normal operation - replace the item on on top of the queue
+        # For normal operation - update the item on top of the stack
         # for M120 and M121 push and pop copy of the last item onto the stack
-        state_stack = [GCodeAnalyzer.State()]
+        state_stack = [GCodeAnalyzer.State(config = self.config)]
         seq = 0
 
         # Total runtime of GCode
@@ -231,90 +1065,156 @@ class GCodeAnalyzer:
 
         for token in self.tokens:
             token.seq = seq
-            seq += 1
-
-            # Accumulate the state - replace the top one with the copy
-            token.state_pre = state_stack[-1]
-            state_stack[-1] = state_stack[-1].copy()
-            token.state_post = state_stack[-1]
-
-            # Tool change token
-            if token.type == Token.TOOLCHANGE:
-                if token.next_tool == -1:
-                    token.state_post.tool_selected = None
-                else:
-                    token.state_post.tool_selected = token.next_tool
-                
-                    # Basically first time the tool is used
-                    if token.next_tool not in token.state_post.tool_extrusion:
-                        token.state_post.tool_extrusion[token.next_tool] = 0.0
-                token.runtime = conf.runtime_tool_change
-            # GCode 
-            elif token.type == Token.GCODE:
-                # Add retraction
-                if token.gcode == 'G10': # Firmware retract
-                    token.state_post.retraction = GCodeAnalyzer.State.RETRACTED
-                    token.runtime = conf.runtime_default
-                elif token.gcode == 'G11': # Firmware unretract
-                    token.state_post.retraction = GCodeAnalyzer.State.UNRETRACTED
-                    token.runtime = conf.runtime_default
-                elif token.gcode == 'G1': # Controlled move
-
-                    # Move times
-                    token.runtime = 0
-                    # TODO: For time being just treat X/Y/Z absolute
-                    state_pre = token.state_pre
-                    state_post = token.state_post
-
-                    if 'F' in token.param: state_post.feed_rate = float(token.param['F'])
-                    if 'X' in token.param: 
-                        state_post.x = float(token.param['X'])
-                        x0 = state_pre.x if state_pre.x != None else 0.0
-                        x_time = abs(state_post.x - x0) * 120.0 / (state_pre.move_speed_x + state_post.move_speed_x)
-                        if x_time > token.runtime: token.runtime = x_time
-                    if 'Y' in token.param: 
-                        state_post.y = float(token.param['Y'])
-                        y0 = state_pre.y if state_pre.y != None else 0.0
-                        y_time = abs(state_post.y - y0) * 120.0 / (state_pre.move_speed_y + state_post.move_speed_y)
-                        if y_time > token.runtime: token.runtime = y_time
-                    if 'Z' in token.param: 
-                        state_post.z = float(token.param['Z'])
-                        z0 = state_pre.z if state_pre.z != None else 0.0
-                        z_time = abs(state_post.z - z0) * 120.0 / (state_pre.move_speed_z + state_post.move_speed_z)
-                        if z_time > token.runtime: token.runtime = z_time
-                    if 'E' in token.param:
-                        tool_id = state_pre.tool_selected
-                        if state_pre.e_relative:
-                            state_post.tool_extrusion[tool_id] += float(token.param['E'])
-                        else: 
-                            state_post.tool_extrusion[tool_id] = float(token.param['E'])
-                        e0 = state_pre.tool_extrusion[tool_id]
-                        e1 = state_post.tool_extrusion[tool_id]
-                        e_time = abs(e1 - e0) * 120.0 / (state_pre.extrud_speed + state_post.extrud_speed)
-                        if e_time > token.runtime: token.runtime = e_time
-
-                elif token.gcode == 'M120': # Push state onto stack
-                    # Push the copy of the current state onto the stack - experimental
-                    state_stack.append(state_stack[-1].copy())
-                    token.runtime = 0.0
-                elif token.gcode == 'M121': # Pop state from the stack 
-                    # Pop the copy of the current state from the stack - experimental
-                    state_stack.pop()
-                    token.runtime = 0.0
-
-            # PARAM
-            elif token.type == Token.PARAMS:
-                # Track layer changes
-                if token.label == 'AFTER_LAYER_CHANGE':
-                    token.state_post.layer_num = token.param[0]
-                token.runtime = 0
-            else:
-                token.runtime = conf.runtime_default
+            token.state_trace = trace
+            token.runtime = GCodeAnalyzer.apply_token(state_stack, token)
 
             # Add the total runtime
             self.total_runtime += token.runtime
 
-        return self.tokens
+            # Snapshot of the state after the token
+            if seq % trace.interval == 0:
+                trace.add_snapshot(seq, token, state_stack, self.total_runtime)
+            seq += 1
+
+    # Re-analyze the modified token ranges
+    # - restarts at the first modified range with the state of the unmodified token before it
+    # - once the state after a token matches the previous snapshot of that token again (converged)
+    #   the tokens up to the next modified range only get renumbered and the snapshots re-used
+    def analyze_state_dirty(self):
+        trace = self.state_trace
+        old_snapshots = trace.snapshots
+        old_seqs = trace.seqs
+        dirty_anchors = self.dirty_anchors
+
+        # Find the first modified range
+        start = None
+        if not self.dirty_head:
+            for anchor in dirty_anchors:
+                if anchor.state_trace is trace and anchor.dll is self.tokens and (start is None or anchor.seq < start.seq):
+                    start = anchor
+            if start is None:
+                self.analyze_state_full()
+                return
+
+        if start is None:
+            state_stack = [GCodeAnalyzer.State(config = self.config)]
+            total_runtime = 0.0
+            seq = 0
+            node = self.tokens.head
+            snapshot_indx = 0
+        else:
+            state_pre, start_stack = trace.replay(start)
+            state_stack = [state.copy() for state in start_stack]
+            total_runtime = trace.total_runtime(start)
+            seq = start.seq + 1
+            node = start.next
+            snapshot_indx = bisect.bisect_right(old_seqs, start.seq)
+
+        # Keep the snapshots before the first modified range
+        trace.snapshots = old_snapshots[:snapshot_indx]
+        trace.seqs = old_seqs[:snapshot_indx]
+        trace.cursor = None
+        last_snapshot_seq = trace.seqs[-1] if snapshot_indx > 0 else -trace.interval
+        old_indx = snapshot_indx
+
+        converged = False
+        e_offset = None
+
+        while node is not None:
+            # Previous snapshot of the token
+            old_snapshot = None
+            if node.state_trace is trace:
+                while old_indx < len(old_seqs) and old_seqs[old_indx] < node.seq:
+                    old_indx += 1
+                if old_indx < len(old_seqs) and old_snapshots[old_indx][0] is node:
+                    old_snapshot = old_snapshots[old_indx]
+
+            if not converged:
+                node.state_trace = trace
+                node.runtime = GCodeAnalyzer.apply_token(state_stack, node)
+                total_runtime += node.runtime
+
+                if (old_snapshot is not None and node not in dirty_anchors and 
+                    len(state_stack) == 1 and len(old_snapshot[1]) == 1 and state_stack[0].matches(old_snapshot[1][0])):
+                    # Converged - extrusion totals of the snapshots that follow are offset
+                    converged = True
+                    e_offset = dict([(tool, state_stack[0].tool_extrusion[tool] - e) for tool, e in old_snapshot[1][0].tool_extrusion.items()])
+                    trace.add_snapshot(seq, node, state_stack, total_runtime)
+                    last_snapshot_seq = seq
+                elif seq - last_snapshot_seq >= trace.interval:
+                    trace.add_snapshot(seq, node, state_stack, total_runtime)
+                    last_snapshot_seq = seq
+            else:
+                total_runtime += node.runtime
+                if old_snapshot is not None:
+                    for state in old_snapshot[1]:
+                        for tool, offset in e_offset.items():
+                            if tool in state.tool_extrusion:
+                                state.tool_extrusion[tool] += offset
+                    trace.seqs.append(seq)
+                    trace.snapshots.append((node, old_snapshot[1], total_runtime))
+                    last_snapshot_seq = seq
+
+                # Modified range follows - restore the state after the token and re-analyze
+                if node in dirty_anchors:
+                    node.seq = seq
+                    state_pre, node_stack = trace.replay(node)
+                    state_stack = [state.copy() for state in node_stack]
+                    trace.cursor = None
+                    converged = False
+
+            node.seq = seq
+            seq += 1
+            node = node.next
+
+        self.total_runtime = total_runtime
+        self.dirty_anchors = set()
+        self.dirty_head = False
+
+    # DLList observer - token inserted into the token list
+    def node_inserted(self, node):
+        self.tokens_inserted += 1
+        if self.state_trace is not None:
+            self.mark_dirty(node.prev)
+        if self.cached_layer_index is not None and LayerIndex.is_marker(node):
+            self.cached_layer_index = None
+        if self.cached_token_index is not None:
+            self.cached_token_index.add(node, ordered = False)
+
+    # DLList observer - tokens spliced into the token list
+    def nodes_inserted(self, first, last):
+        if self.state_trace is not None:
+            self.mark_dirty(first.prev)
+        layer_index = self.cached_layer_index
+        token_index = self.cached_token_index
+        for node in token_range(self.tokens, first, last):
+            self.tokens_inserted += 1
+            if layer_index is not None and LayerIndex.is_marker(node):
+                self.cached_layer_index = layer_index = None
+            if token_index is not None:
+                token_index.add(node, ordered = False)
+
+    # DLList observer - token about to be removed from the token list
+    def node_removed(self, node):
+        self.tokens_removed += 1
+        if self.state_trace is not None:
+            self.mark_dirty(node.prev)
+            node.seq = None
+            node.state_trace = None
+        if self.cached_layer_index is not None and LayerIndex.is_marker(node):
+            self.cached_layer_index = None
+        if self.cached_token_index is not None:
+            self.cached_token_index.remove(node)
+
+    # Mark the range after the anchor as modified
+    # - anchor is moved to the closest analyzed token
+    def mark_dirty(self, anchor):
+        while anchor is not None and anchor.state_trace is not self.state_trace:
+            anchor = anchor.prev
+        if anchor is None:
+            self.dirty_head = True
+        else:
+            self.dirty_anchors.add(anchor)
 
     # Print total runtime
     @property
@@ -326,110 +1226,267 @@ class GCodeAnalyzer:
         return "{h}h{m}m{s}s".format(h = runtime_h, m = runtime_m, s = runtime_s)
 
     def print_total_runtime(self):
-        print("GCodeAnalyzer: Total runtime estimation: {runtime}".format(runtime = self.total_runtime_str))
+        print("GCodeAnalyzer: Total runtime estimation: {runtime}".format(runtime = self.total_runtime_str), file = self.log)
 
 
 
+    # Empty token list
+    def new_token_list(self):
+        return doublelinkedlist.DLList()
+
     # Parse the file and populate the tokens
+    # - gcode_file is either a path or any iterable of lines (open file, pipe, stdin)
     def parse(self, gcode_file):
-        self.tokens = doublelinkedlist.DLList()
+        self.close()
+        self.tokens = self.new_token_list()
+        self.state_trace = None
+        self.cached_runtime_index = None
+
+        # Index the tokens/layers while parsing
+        self.cached_layer_index = None
+        self.cached_token_index = None
+        layer_index = LayerIndex()
+        token_index = TokenIndex()
+
+        # Note: the cycle collector setting is process wide - left to the entry point owning the process
+        # (tcpspp.main holds it while processing)
+        analysis = None
+        try:
+            if isinstance(gcode_file, (str, bytes, os.PathLike)):
+                # Keep the file mapped - untouched tokens are written straight from it
+                self.source_file = open(gcode_file, mode='rb')
+                if os.fstat(self.source_file.fileno()).st_size > 0:
+                    self.source = mmap.mmap(self.source_file.fileno(), 0, access = mmap.ACCESS_READ)
+                    if self.source.readline().endswith(b'\r\n'):
+                        self.newline = b'\r\n'
+                    self.source.seek(0)
+                    tokens = tokenize_bytes(iter(self.source.readline, b''))
+                    if self.sparse:
+                        tokens = fold_moves(tokens, self.config)
+
+                    # Analyze the shards of the file in the worker processes while parsing
+                    if self.workers > 1 and not self.sparse:
+                        analysis = shard_analysis.ShardAnalysis(gcode_file, self.source, self.workers, self.STATE_SNAPSHOT_INTERVAL, self.config)
+                        if analysis.active:
+                            tokens = analysis.poll_tokens(tokens)
+
+                    tokens = token_index.scan(tokens, layer_index)
+
+                    self.tokens.append_nodes(tokens)
+
+                    if analysis is not None and analysis.active:
+                        analysis.finish(self)
+            elif self.sparse:
+                raise GCodeParseException("Sparse token list can only be parsed from a file path")
+            else:
+                tokens = tokenize(gcode_file)
+                tokens = token_index.scan(tokens, layer_index)
+                self.tokens.append_nodes(tokens)
+        finally:
+            if analysis is not None:
+                analysis.close()
+
+        self.cached_layer_index = layer_index
+        self.cached_token_index = token_index
+
+        # Track the modifications
+        self.tokens.observer = self
+
+    # Release the source file
+    def close(self):
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+        if self.source_file is not None:
+            self.source_file.close()
+            self.source_file = None
+
+    # Write the GCode into the binary file
+    # Tokens with a source are copied from the parsed buffer - consecutive ones as a single slice,
+    # the injected/modified tokens are serialized
+    # - first/last limit the output to a range of the tokens (e.g. from the start of a layer)
+    def write(self, gcode_out, first = None, last = None):
+        source = self.source
+        run_start = None
+        run_end = None
+
+        tokens = self.tokens
+        if first is not None or last is not None:
+            tokens = token_range(self.tokens, first, last)
+
+        for token in tokens:
+            src_start = token.src_start
+            if source is not None and src_start is not None:
+                if src_start == run_end:
+                    run_end = token.src_end
+                    continue
+                self.write_source(gcode_out, run_start, run_end)
+                run_start = src_start
+                run_end = token.src_end
+            else:
+                self.write_source(gcode_out, run_start, run_end)
+                run_start = None
+                run_end = None
+                gcode_out.write(str(token).encode('utf8') + self.newline)
+
+        self.write_source(gcode_out, run_start, run_end)
+
+    # Injection plan - the modifications of the token list against the parsed source
+    # list of (src_start, src_end, lines) in the source order, the source bytes [src_start, src_end)
+    # are replaced by the lines (removed/injected/modified tokens) - see gcode_writer.write_plan
+    def injection_plan(self):
+        source = self.source
+        if source is None:
+            raise GCodeSerializeException("Injection plan needs the parsed source file")
+
+        plan = []
+        lines = []
+        pos = 0
+        for token in self.tokens:
+            src_start = token.src_start
+            if src_start is not None and src_start >= pos:
+                if src_start != pos or len(lines) > 0:
+                    plan.append((pos, src_start, lines))
+                    lines = []
+                pos = token.src_end
+            elif src_start is not None:
+                # Moved before the source already copied - copied as a new line
+                line = source[src_start:token.src_end]
+                lines.append(line if line.endswith(b'\n') else line + self.newline)
+            else:
+                lines.append(str(token).encode('utf8') + self.newline)
 
-        # Read all the lines        
-        with open(gcode_file, mode='r', encoding='utf8') as gcode_in:
-            # Track the tool
-            current_tool_head = -1
+        if pos != len(source) or len(lines) > 0:
+            plan.append((pos, len(source), lines))
+        return plan
 
-            for line in gcode_in.readlines():
-                line = line.strip()
+    # Write the slice of the source buffer
+    def write_source(self, gcode_out, src_start, src_end):
+        if src_start is None:
+            return
+        gcode_out.write(self.source[src_start:src_end])
+        # Last line of the file without the line ending
+        if self.source[src_end-1:src_end] != b'\n':
+            gcode_out.write(self.newline)
 
-                if len(line) == 0:
-                    continue
 
-                # Check if comment
-                if line[0] == ';':
-                    # Check if comment params - starts with ;;
-                    if len(line) > 1 and line[1] == ';':
-                        contents = line[2:]
-                        # Check if has extra comment - strip
-                        comment_pos = contents.find(';')
-                        if comment_pos != -1:
-                            contents = contents[0:comment_pos].strip()
-                        # Check if has params
-                        label = None
-                        params = []
-
-                        params_sep = contents.find(':')
-                        if params_sep != -1:
-                            label = contents[0:params_sep].strip()
-                            params = contents[params_sep+1:].split(',')
-                        else:
-                            label = contents.strip()
-
-                        # Check if the label in params
-                        if label not in valid_params_format.keys():
-                            raise GCodeParseException("Param {label} not valid".format(label = label), line)
-                        if len(params) != len(valid_params_format[label]):
-                            raise GCodeParseException("Param {label} has invalid number of arguments".format(label = label), line)
-
-                        self.tokens.append_node(Params(
-                            label = label,
-                            param = [valid_params_format[label][indx](params[indx]) for indx in range(0, len(params))]))
-                        continue
-                    # Check if normal comment - single ;
-                    if len(line) > 1 and line[1] != ';':
-                        text = line[1:]
-
-                        self.tokens.append_node(Comment(text = text))
-                        continue
-                    # Empty comment - skip
-                    if len(line) == 1:
-                        continue
-
-                # Check if GCODE 
-                if line[0] in ['G', 'M']:
-                    contents = line
-                    comment = ""
-                    # Check if has extra comment - strip
-                    comment_pos = line.find(';')
-                    if comment_pos != -1:
-                        contents = line[0:comment_pos].strip()
-                        comment = line[comment_pos+1:].strip()
-
-                    # Split into params
-                    args = contents.split()
-                    gcode = args[0]
-                    # # Check if omit the code
-                    if len(args) == 1:
-                        self.tokens.append_node(GCode(
-                            gcode = gcode,
-                            comment = comment))
-                    else:
-                        self.tokens.append_node(GCode(
-                            gcode = gcode,
-                            param = dict([(p[0], p[1:]) for p in args[1:]]),
-                            comment = comment))
-                    continue
+# Pipeline exception
+class PipelineException(Exception):
+    def __init__(self, message):
+        self.message = message
 
-                # Check if Toolchange
-                if line[0] == 'T':
-                    # Check if has extra comment - strip
-                    contents = line
-                    comment_pos = line.find(';')
-                    if comment_pos != -1:
-                        contents = line[0:comment_pos].strip()
-                    
-                    previous_tool_head = current_tool_head
-                    current_tool_head = int(contents[1:])
-
-                    self.tokens.append_node(ToolChange(
-                        prev_tool = previous_tool_head,
-                        next_tool = current_tool_head))
-                    continue
+# Pipeline stage
+# Analysis part of a controller, runs in the single traversal of the Pipeline
+# - name - unique name of the stage
+# - requires - names of the stages the stage runs after (when they are in the pipeline)
+# - handlers - token index key (see TokenIndex) -> handler(token), None key gets every token
+#   (the moves are not indexed - G0/G1 handlers have to use the None key)
+class Stage:
+
+    name = None
+    requires = ()
+
+    def handlers(self):
+        return {}
+
+    # Before the traversal - the token list can still be modified
+    def begin(self, gcode_analyzer):
+        pass
+
+    # After the traversal
+    def end(self, gcode_analyzer):
+        pass
 
+# Stage pipeline
+# Runs the analysis of all the stages in a single traversal of the analyzed token list
+# - stages are ordered by their requirements, for each token the handlers are called in the stage order,
+#   begin/end are called in the stage order before/after the traversal
+# - only the tokens with a handler are visited (merged from the token index in the list order)
+#   unless a stage handles every token
+# - handlers can remove the token they are called with, the inserted tokens are not visited
+class Pipeline:
+
+    def __init__(self, stages = None):
+        self.stages = []
+        self.visited = 0
+        if stages is not None:
+            for stage in stages:
+                self.add_stage(stage)
+
+    def add_stage(self, stage):
+        if stage.name in [other.name for other in self.stages]:
+            raise PipelineException("Stage {name} added twice".format(name = stage.name))
+        self.stages.append(stage)
+
+    # Stages ordered by the requirements (in the order added otherwise)
+    def ordered_stages(self):
+        stages_by_name = dict([(stage.name, stage) for stage in self.stages])
+        ordered = []
+        visiting = []
+
+        def visit(stage):
+            if stage in ordered:
+                return
+            if stage in visiting:
+                raise PipelineException("Stage {name} requirements are circular".format(name = stage.name))
+            visiting.append(stage)
+            for name in stage.requires:
+                if name in stages_by_name:
+                    visit(stages_by_name[name])
+            visiting.pop()
+            ordered.append(stage)
+
+        for stage in self.stages:
+            visit(stage)
+        return ordered
+
+    # Tokens of the keys in the list order
+    @staticmethod
+    def visited_tokens(gcode_analyzer, keys):
+        if None in keys:
+            return iter(gcode_analyzer.tokens)
+        token_lists = [gcode_analyzer.indexed_tokens(key) for key in keys]
+        # Tokens under several keys (PARAMS type and label) come in a row - visit once
+        def unique(tokens):
+            last = None
+            for token in tokens:
+                if token is not last:
+                    yield token
+                last = token
+        return unique(heapq.merge(*token_lists, key = lambda token: token.seq))
+
+    def run(self, gcode_analyzer):
+        stages = self.ordered_stages()
+
+        # Handlers by the token key in the stage order
+        dispatch = {}
+        for stage_indx, stage in enumerate(stages):
+            for key, handler in stage.handlers().items():
+                dispatch.setdefault(key, []).append((stage_indx, handler))
+
+        for stage in stages:
+            stage.begin(gcode_analyzer)
+
+        gcode_analyzer.analyze_state()
+        all_handlers = dispatch.get(None, [])
+        for token in Pipeline.visited_tokens(gcode_analyzer, list(dispatch.keys())):
+            self.visited += 1
+            handlers = list(all_handlers)
+            for key in TokenIndex.keys(token):
+                handlers.extend(dispatch.get(key, ()))
+            if len(handlers) > 1:
+                handlers.sort(key = lambda handler: handler[0])
+            for stage_indx, handler in handlers:
+                handler(token)
+
+        for stage in stages:
+            stage.end(gcode_analyzer)
 
 # GCode validator
 # Used to fix the GCode coming out of Prusa
-class GCodeValidator:
+class GCodeValidator(Stage):
+
+    name = 'validator'
 
     gcodes_to_omit = ['M104', 'M109', 'M900']
 
@@ -437,6 +1494,10 @@ class GCodeValidator:
     def __init__(self):
         pass
 
+    # Stage - fix the GCode before the other stages see it
+    def begin(self, gcode_analyzer):
+        self.analyze_and_fix(gcode_analyzer)
+
     # analyze the gcode
     def analyze_and_fix(self, gcode_analyzer):
         
@@ -446,51 +1507,103 @@ class GCodeValidator:
         # location of TC_INIT
         first_layer_header = None
 
-        # Go over each token
-        for token in gcode_analyzer.tokens:
-
-            # gcodes to omit - delete
-            if token.type == Token.GCODE and token.gcode in GCodeValidator.gcodes_to_omit:
+        # gcodes to omit - delete
+        for gcode in GCodeValidator.gcodes_to_omit:
+            for token in gcode_analyzer.tokens_by_gcode(gcode):
                 if conf.DEBUG:
-                    print("(DEBUG) GCodeValidator: Deleting {token}".format(token = str(token)))
+                    print("(DEBUG) GCodeValidator: Deleting {token}".format(token = str(token)), file = gcode_analyzer.log)
                 gcode_analyzer.tokens.remove_node(token)
-                continue
-
-            # Token to fix 
-            if token.type == Token.GCODE and token.gcode == 'M106':
-                if conf.DEBUG:
-                    print("(DEBUG) GCodeValidator: Fixing M106 from 0..255 to 0-1.0 range")
-                token.param['S'] = float(token.param['S']) / 255.0
-                continue
 
-            # This is for case where file is using just one tool that is T0
-            # PS is assuming that default tool T0 is always enabled....
-            # 1) We need to record the location of first layer 
-            if token.type == Token.PARAMS and token.label == 'BEFORE_LAYER_CHANGE' and first_layer_header is None:
-                first_layer_header = token
-                continue
-
-            # 2) If found tool
-            if token.type == Token.TOOLCHANGE and token.next_tool != -1:
+        # Token to fix 
+        for token in gcode_analyzer.tokens_by_gcode('M106'):
+            if conf.DEBUG:
+                print("(DEBUG) GCodeValidator: Fixing M106 from 0..255 to 0-1.0 range", file = gcode_analyzer.log)
+            token.param['S'] = float(token.param['S']) / 255.0
+            token.invalidate_source()
+
+        # This is for case where file is using just one tool that is T0
+        # PS is assuming that default tool T0 is always enabled....
+        # 1) We need to record the location of first layer 
+        layer_headers = gcode_analyzer.tokens_by_label('BEFORE_LAYER_CHANGE')
+        if len(layer_headers) > 0:
+            first_layer_header = layer_headers[0]
+
+        # 2) If found tool
+        for token in gcode_analyzer.tokens_by_type(Token.TOOLCHANGE):
+            if token.next_tool != -1:
                 found_tool = True
+                break
 
         # Inject the tool change to T0
         if found_tool == False:
-            print("Warning! - GCodeValidator: Didn't found a tool change instruction, injecting T0 as a default tool...")
+            print("Warning! - GCodeValidator: Didn't found a tool change instruction, injecting T0 as a default tool...", file = gcode_analyzer.log)
             first_layer_header.append_node_left(ToolChange(-1, 0))
     
     # verify the retract sequence
-    def analyze_retracts(self, gcode_analyzer):
-        for token in gcode_analyzer.analyze_state():
-            if token.type == Token.GCODE and token.gcode == 'G10':
-                if token.state_pre.retraction == GCodeAnalyzer.State.RETRACTED:
-                    print("Error: Two subsequent retractions - error in generated GCode")
-                    return False
-
-            if token.type == Token.GCODE and token.gcode == 'G11':
-                if token.state_pre.retraction == GCodeAnalyzer.State.UNRETRACTED:
-                    print("Error: Two subsequent unretractions - error in generated GCode")
-                    return False
+    # - layers - fingerprinted layers of the written output (layer_fingerprint.write_layers)
+    # - layer_results - results of the fingerprinted layers of the previous run (layer_fingerprint.LayerResults),
+    #   the layers with a known fingerprint are not validated again, replaced with the results of this run
+    def analyze_retracts(self, gcode_analyzer, layers = None, layer_results = None):
+        gcode_analyzer.analyze_state()
+        if layers is not None:
+            return self.analyze_layer_retracts(gcode_analyzer, layers, layer_results)
+
+        # In the file order - the first error is reported
+        tokens = heapq.merge(gcode_analyzer.tokens_by_gcode('G10'), gcode_analyzer.tokens_by_gcode('G11'), key = lambda token: token.seq)
+        for token in tokens:
+            if GCodeValidator.retract_error(token, token.state_pre):
+                print(GCodeValidator.RETRACT_ERRORS[token.gcode], file = gcode_analyzer.log)
+                return False
+
+        return True
 
+    # Retract error messages by the GCode
+    RETRACT_ERRORS = {
+        'G10' : "Error: Two subsequent retractions - error in generated GCode",
+        'G11' : "Error: Two subsequent unretractions - error in generated GCode" }
+
+    # G10 when retracted, G11 when unretracted
+    @staticmethod
+    def retract_error(token, state_pre):
+        if token.gcode == 'G10':
+            return state_pre.retraction == GCodeAnalyzer.State.RETRACTED
+        return state_pre.retraction == GCodeAnalyzer.State.UNRETRACTED
+
+    # verify the retract sequence layer by layer
+    def analyze_layer_retracts(self, gcode_analyzer, layers, layer_results):
+        results = {}
+        error = None
+        for first, last, fingerprint in layers:
+            if fingerprint in layer_results.results:
+                layer_error = layer_results.results[fingerprint]
+                layer_results.reused += 1
+            else:
+                layer_error = self.layer_retracts(gcode_analyzer, first, last)
+            results[fingerprint] = layer_error
+            if error is None:
+                error = layer_error
+        layer_results.results = results
+
+        if error is not None:
+            print(GCodeValidator.RETRACT_ERRORS[error], file = gcode_analyzer.log)
+            return False
         return True
 
+    # Retract sequence of the layer - single pass from the state entering the layer
+    # returns the GCode of the first retract error in the layer (None if ok)
+    def layer_retracts(self, gcode_analyzer, first, last):
+        # State stack after the first token
+        state_pre = first.state_pre
+        state_stack = [state.copy() for state in gcode_analyzer.state_trace.replay(first)[1]]
+        node = first
+        while True:
+            if node.type == Token.GCODE and node.gcode in GCodeValidator.RETRACT_ERRORS and GCodeValidator.retract_error(node, state_pre):
+                return node.gcode
+            if node is last:
+                break
+            node = node.next
+            state_pre = state_stack[-1].copy()
+            GCodeAnalyzer.apply_token(state_stack, node)
+
+        return None
+
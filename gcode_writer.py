@@ -0,0 +1,121 @@
+# GCode writer
+# Writes the output GCode into a temporary file next to the target and moves it into place
+# once it is complete - an interrupted run never leaves a half-written file behind
+# - the writes are collected and written in large chunks
+# - the temporary file has a unique name (concurrent writers of the same target in one process don't collide)
+import os, uuid
+
+class GCodeWriter:
+
+    # Chunk size
+    BUFFER_SIZE = 1 << 20
+
+    def __init__(self, filename, buffer_size = BUFFER_SIZE):
+        self.filename = filename
+        self.buffer_size = buffer_size
+        self.tmp_filename = None
+        self.file = None
+        self.chunks = []
+        self.chunks_size = 0
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+        return False
+
+    # Create the temporary file (the default file mode - umask applied by the OS)
+    def open(self):
+        flags = os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, 'O_BINARY', 0)
+        while True:
+            tmp_filename = "{filename}.{unique}.tmp".format(filename = self.filename, unique = uuid.uuid4().hex)
+            try:
+                fd = os.open(tmp_filename, flags, 0o666)
+                break
+            except FileExistsError:
+                continue
+        self.tmp_filename = tmp_filename
+        self.file = os.fdopen(fd, mode='wb')
+
+    # Write the bytes
+    def write(self, data):
+        self.chunks.append(data)
+        self.chunks_size += len(data)
+        if self.chunks_size >= self.buffer_size:
+            self.flush()
+
+    def writelines(self, lines):
+        for data in lines:
+            self.write(data)
+
+    # Write out the collected chunks
+    def flush(self):
+        if self.chunks_size > 0:
+            self.file.write(b''.join(self.chunks))
+        self.chunks = []
+        self.chunks_size = 0
+
+    # Finish the file and move it into place
+    def commit(self):
+        self.flush()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+        # Keep the mode of the replaced file
+        try:
+            os.chmod(self.tmp_filename, os.stat(self.filename).st_mode & 0o7777)
+        except FileNotFoundError:
+            pass
+        os.replace(self.tmp_filename, self.filename)
+
+        # Persist the rename (POSIX only - directories can't be opened on Windows)
+        if hasattr(os, 'O_DIRECTORY'):
+            dir_fd = os.open(os.path.dirname(os.path.abspath(self.filename)), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    # Drop the temporary file
+    def abort(self):
+        self.chunks = []
+        self.chunks_size = 0
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.tmp_filename is not None and os.path.exists(self.tmp_filename):
+            os.remove(self.tmp_filename)
+
+# Stream the source file into the writer with the injection plan merged in
+# - plan is the list of (src_start, src_end, lines) in the source order (GCodeAnalyzer.injection_plan),
+#   the source bytes [src_start, src_end) are replaced by the lines
+# - the source is read in chunks, only the plan is kept in memory
+def write_plan(source_filename, plan, gcode_out, newline = b'\n', chunk_size = GCodeWriter.BUFFER_SIZE):
+    with open(source_filename, mode='rb') as gcode_in:
+        size = os.fstat(gcode_in.fileno()).st_size
+        pos = 0
+        for src_start, src_end, lines in plan:
+            copy_source(gcode_in, gcode_out, pos, src_start, newline, chunk_size)
+            gcode_out.writelines(lines)
+            pos = src_end
+        copy_source(gcode_in, gcode_out, pos, size, newline, chunk_size)
+
+# Copy the source bytes [start, end) - the last line of the file gets the line ending
+def copy_source(gcode_in, gcode_out, start, end, newline, chunk_size):
+    if start >= end:
+        return
+    gcode_in.seek(start)
+    while start < end:
+        data = gcode_in.read(min(chunk_size, end - start))
+        if len(data) == 0:
+            break
+        gcode_out.write(data)
+        start += len(data)
+    if not data.endswith(b'\n'):
+        gcode_out.write(newline)
@@ -0,0 +1,86 @@
+# Layer fingerprints
+# Incremental retract validation of the re-sliced files - most layers of a re-exported plate are the same as in the previous export
+# - layer - tokens from the AFTER_LAYER_CHANGE marker up to the next one (tokens before the first marker are the header layer)
+# - fingerprint - SHA-256 of the post-processed layer GCode as written (source bytes + injected/modified tokens) and
+#   the tool state entering the layer (selected tool, retracted tools per state stack level)
+# - the retract validation results are kept per fingerprint (layer results of the previous run of the file),
+#   the layers with a known fingerprint are not validated again
+# Only the validation is incremental - the pipeline still runs and the output is written in full.
+# The layers are fingerprinted while the output is written (write_layers) - a prime tower/thermal plan change spilling
+# into a neighbouring layer changes its fingerprint, so the changed layers and the plan around them are re-validated
+import gcode_analyzer
+import gcode_writer
+import result_cache
+
+import hashlib, json
+
+# Fingerprint version (bump when the fingerprinted content or the layer results change)
+FINGERPRINT_VERSION = 2
+
+# Writes into the output and the digest of the layer
+class DigestWriter:
+    def __init__(self, gcode_out, digest):
+        self.gcode_out = gcode_out
+        self.digest = digest
+
+    def write(self, data):
+        self.gcode_out.write(data)
+        self.digest.update(data)
+
+# Layers of the token list - (first, last) token of each layer
+def layer_ranges(gcode):
+    ranges = []
+    first = gcode.tokens.head
+    for layer in gcode.layer_index():
+        if layer.after is None or layer.after is first:
+            continue
+        if first is not None:
+            ranges.append((first, layer.after.prev))
+        first = layer.after
+    if first is not None:
+        ranges.append((first, gcode.tokens.tail))
+    return ranges
+
+# Tool state entering the layer - state stack after the first token of the layer
+# (the AFTER_LAYER_CHANGE marker doesn't change the tool state)
+def layer_context(gcode, first):
+    _, state_stack = gcode.state_trace.replay(first)
+    return [[state.tool_selected, sorted(tool for tool, retraction in state.tool_retraction.items() if retraction == gcode_analyzer.GCodeAnalyzer.State.RETRACTED)]
+            for state in state_stack]
+
+# Write the token list layer by layer (GCodeAnalyzer.write) fingerprinting the layers
+# returns the (first, last, fingerprint) of each layer
+def write_layers(gcode, gcode_out):
+    gcode.analyze_state()
+    layers = []
+    for first, last in layer_ranges(gcode):
+        digest = hashlib.sha256()
+        digest.update(json.dumps([FINGERPRINT_VERSION, result_cache.tool_version(), layer_context(gcode, first)]).encode('utf8'))
+        gcode.write(DigestWriter(gcode_out, digest), first, last)
+        layers.append((first, last, digest.hexdigest()))
+    return layers
+
+# Retract validation results of the fingerprinted layers
+# fingerprint -> GCode of the first retract error in the layer (None if ok)
+class LayerResults:
+
+    def __init__(self, results = None):
+        self.results = {} if results is None else results
+        self.reused = 0
+
+    # Layer results of the previous run (empty if missing/broken)
+    @staticmethod
+    def load(filename):
+        try:
+            with open(filename, mode='r') as results_in:
+                data = json.load(results_in)
+        except (OSError, ValueError):
+            return LayerResults()
+        if not isinstance(data, dict) or data.get('version') != FINGERPRINT_VERSION:
+            return LayerResults()
+        return LayerResults(data.get('layers', {}))
+
+    # Write the layer results (replaced atomically)
+    def save(self, filename):
+        with gcode_writer.GCodeWriter(filename) as results_out:
+            results_out.write(json.dumps({'version' : FINGERPRINT_VERSION, 'layers' : self.results}).encode('utf8'))
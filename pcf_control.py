@@ -4,40 +4,48 @@ import tool_change_plan
 import doublelinkedlist
 import time
 
-from gcode_analyzer import Token, GCodeAnalyzer
+from gcode_analyzer import Token, GCodeAnalyzer, Stage, Pipeline
 from tool_change_plan import ToolChangeException
 from conf import ConfException
 
 # Used to inject GCode for PCF control
-class PartCoolingFanController:
+class PartCoolingFanController(Stage):
+
+    name = 'pcf'
+    requires = ('validator',)
 
     def __init__(self):
         self.tool_change_seq = []
+        self.config = None
+        self.log = None
 
     # Analyze the GCode 
     # the tool change sequence (layer independant)
     def analyze_gcode(self, gcode_analyzer):
-        t_start = time.time()
+        Pipeline([self]).run(gcode_analyzer)
+
+    # Stage - only the tool changes are needed
+    def handlers(self):
+        return {('type', Token.TOOLCHANGE) : self.on_tool_change}
+
+    def begin(self, gcode_analyzer):
+        self.t_start = time.time()
+        self.config = gcode_analyzer.config
+        self.log = gcode_analyzer.log
 
         # Generates the list of tool_activations per tool
         if conf.DEBUG:
-            print("(DEBUG) PartFanController: Generating tool activation sequence per tool...")
-
-        # Current tool head
-        current_tool = None
+            print("(DEBUG) PartFanController: Generating tool activation sequence per tool...", file = self.log)
 
-        # Go over all of the tokens
-        for token in gcode_analyzer.tokens:
-            # Setup the tool changes
-            if token.type == Token.TOOLCHANGE:
-                if token.state_post.tool_selected != None:
-                    current_tool = token
-                    self.tool_change_seq.append(current_tool)
-                continue
+    # Setup the tool changes
+    def on_tool_change(self, token):
+        if token.state_post.tool_selected != None:
+            self.tool_change_seq.append(token)
 
+    def end(self, gcode_analyzer):
         t_end = time.time()
         if conf.PERF_INFO:
-            print("PCF-Controller: analysis done [elapsed: {elapsed:0.2f}s]".format(elapsed = t_end - t_start))
+            print("PCF-Controller: analysis done [elapsed: {elapsed:0.2f}s]".format(elapsed = t_end - self.t_start), file = self.log)
     
     # Inject the GCode
     def inject_gcode(self):
@@ -47,5 +55,5 @@ class PartCoolingFanController:
             tool_change.append_node_left(gcode_analyzer.GCode('M106', {'S' : 0}))
 
             layer_num = tool_change.state_post.layer_num
-            if layer_num is not None and layer_num > conf.tool_pcfan_disable_first_layers[tool_change.next_tool]:
-                tool_change.append_node(gcode_analyzer.GCode('M106', {'S' : conf.tool_pcfan_speed[tool_change.next_tool]}))
+            if layer_num is not None and layer_num > self.config.tool_pcfan_disable_first_layers[tool_change.next_tool]:
+                tool_change.append_node(gcode_analyzer.GCode('M106', {'S' : self.config.tool_pcfan_speed[tool_change.next_tool]}))
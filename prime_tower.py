@@ -1,12 +1,27 @@
 from tool_change_plan import LayerInfo, ToolChangeInfo
-from gcode_analyzer import Token
+from gcode_analyzer import Token, Stage, Pipeline
 import tool_change_plan
 import gcode_analyzer
 import doublelinkedlist
 import conf
-import copy, math, time
+import copy, functools, math, time
 from collections import deque
 
+# NumPy is optional - vectorized band generation
+# (imported on the first use - most of the import time otherwise)
+numpy = None
+numpy_loaded = False
+
+def load_numpy():
+    global numpy, numpy_loaded
+    if not numpy_loaded:
+        numpy_loaded = True
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    return numpy
+
 # Function to generate vertices for a circle 
 def circle_generate_vertices(cx, cy, radius, num_faces):
     vertices = []
@@ -18,6 +33,77 @@ def circle_generate_vertices(cx, cy, radius, num_faces):
         vertices.append([x, y])
     return vertices 
 
+# Circle vertices rotated by a number of faces (bands start at a different point each layer)
+# Cached - the same radiuses repeat on every layer of the tower
+@functools.lru_cache(maxsize = 256)
+def circle_band_vertices(cx, cy, radius, num_faces, rotation):
+    vertices = deque(circle_generate_vertices(cx, cy, radius, num_faces))
+    vertices.rotate(rotation % num_faces)
+    return tuple(tuple(v) for v in vertices)
+
+# Extrusion length of the segment (same as conf.Config.calculate_E)
+# - extrusion - (A_ex, A_fil) extrusion factors of the tool and layer height (conf.Config.extrusion_factors)
+def segment_E(extrusion, distance):
+    A_ex, A_fil = extrusion
+    return round((A_ex * distance * 4.0) / A_fil, 5)
+
+# Extrusion lengths of the shape segments (vertices as tuples)
+# Cached - the same shapes repeat for the layers with the same extrusion factors
+@functools.lru_cache(maxsize = 1024)
+def shape_segments_E(extrusion, vertices, closed):
+    segments_E = []
+    for v in range(1, len(vertices)):
+        distance = math.sqrt((vertices[v][0] - vertices[v-1][0])**2 + (vertices[v][1] - vertices[v-1][1])**2)
+        segments_E.append(segment_E(extrusion, distance))
+
+    if closed:
+        distance = math.sqrt((vertices[-1][0] - vertices[0][0])**2 + (vertices[-1][1] - vertices[0][1])**2)
+        segments_E.append(segment_E(extrusion, distance))
+    return tuple(segments_E)
+
+# Unit circle cos/sin of the faces
+# (math for both paths - NumPy trig can differ in the last bit)
+@functools.lru_cache(maxsize = 32)
+def unit_circle(num_faces):
+    alphas = [2 * math.pi * float(indx) / num_faces for indx in range(0, num_faces)]
+    return tuple(math.cos(alpha) for alpha in alphas), tuple(math.sin(alpha) for alpha in alphas)
+
+# Round the NumPy array the same way as round()
+# - numpy.round scales to an integer, the values near the tie are rounded by round()
+def round_array(values, ndigits):
+    scale = 10.0 ** ndigits
+    scaled = values * scale
+    rounded = numpy.round(scaled) / scale
+    for indx in zip(*numpy.nonzero(numpy.abs(scaled - numpy.floor(scaled) - 0.5) < 1e-6)):
+        rounded[indx] = round(float(values[indx]), ndigits)
+    return rounded
+
+# Closed circle shapes of the band - vertices and segment extrusion lengths for each radius
+# - rotation - in faces (0 .. num_faces - 1), extrusion - extrusion factors (see segment_E)
+# Vectorized with NumPy (all the circles at once) if available, cached per shape parameters
+@functools.lru_cache(maxsize = 256)
+def band_shapes(cx, cy, radiuses, num_faces, rotation, extrusion):
+    if load_numpy() is None:
+        shapes = []
+        for radius in radiuses:
+            vertices = circle_band_vertices(cx, cy, radius, num_faces, rotation)
+            shapes.append((vertices, shape_segments_E(extrusion, vertices, True)))
+        return tuple(shapes)
+
+    cos_alpha, sin_alpha = unit_circle(num_faces)
+    r = numpy.array(radiuses, dtype = float).reshape(-1, 1)
+    X = numpy.roll(round_array(r * numpy.array(cos_alpha) + cx, 3), rotation % num_faces, axis = 1)
+    Y = numpy.roll(round_array(r * numpy.array(sin_alpha) + cy, 3), rotation % num_faces, axis = 1)
+
+    # Segment from each vertex to the next one, the last one closes the circle
+    distance = numpy.sqrt((numpy.roll(X, -1, axis = 1) - X) ** 2 + (numpy.roll(Y, -1, axis = 1) - Y) ** 2)
+    A_ex, A_fil = extrusion
+    E = round_array((A_ex * distance * 4.0) / A_fil, 5)
+
+    return tuple(
+        (tuple(zip(X_row, Y_row)), tuple(E_row))
+        for X_row, Y_row, E_row in zip(X.tolist(), Y.tolist(), E.tolist()))
+
 # Function to Generate a Zig-Zag between two circles
 def zigzag_generate_vertices(cx, cy, r1, r2, num_faces):
     v1 = circle_generate_vertices(cx, cy, r1, num_faces)
@@ -47,7 +133,8 @@ class PrimeTowerLayerInfo(LayerInfo):
 
     # Create tokens for printing a shape
     # Moves to the first point 
-    def gcode_print_shape(self, vertices, tool_id, retract_on_move = True, closed = True):
+    # - segments_E - precalculated extrusion lengths of the segments
+    def gcode_print_shape(self, vertices, tool_id, retract_on_move = True, closed = True, segments_E = None):
         tokens = doublelinkedlist.DLList()
 
         if tool_id not in self.tools_active:
@@ -55,32 +142,33 @@ class PrimeTowerLayerInfo(LayerInfo):
                 tool_id = tool_id,
                 layer_num = self.layer_num))
         
+        if segments_E is None:
+            vertices = tuple(tuple(v) for v in vertices)
+            segments_E = shape_segments_E(self.prime_tower.config.extrusion_factors(tool_id, self.layer_height), vertices, closed)
+
         tokens.append_node(gcode_analyzer.GCode('G1', {'X' : vertices[0][0], 'Y' : vertices[0][1]}))
-        tokens.append_node(gcode_analyzer.GCode('G1', {'F' : conf.prime_tower_print_speed}))
+        tokens.append_node(gcode_analyzer.GCode('G1', {'F' : self.prime_tower.config.prime_tower_print_speed}))
         for v in range(1, len(vertices)):
-            distance = math.sqrt((vertices[v][0] - vertices[v-1][0])**2 + (vertices[v][1] - vertices[v-1][1])**2)
-            E = conf.calculate_E(tool_id, self.layer_height, distance)
-            tokens.append_node(gcode_analyzer.GCode('G1', {'X' : vertices[v][0], 'Y' : vertices[v][1], 'E' : E}))
+            tokens.append_node(gcode_analyzer.GCode('G1', {'X' : vertices[v][0], 'Y' : vertices[v][1], 'E' : segments_E[v-1]}))
 
         if closed:
-            distance = math.sqrt((vertices[-1][0] - vertices[0][0])**2 + (vertices[-1][1] - vertices[0][1])**2)
-            E = conf.calculate_E(tool_id, self.layer_height, distance)
-            tokens.append_node(gcode_analyzer.GCode('G1', {'X' : vertices[0][0], 'Y' : vertices[0][1], 'E' : E}))
+            tokens.append_node(gcode_analyzer.GCode('G1', {'X' : vertices[0][0], 'Y' : vertices[0][1], 'E' : segments_E[-1]}))
 
         return tokens
 
     # Create gcode for band for specific tool
     def gcode_pillar_band(self, tool_id):
+        config = self.prime_tower.config
         band_gcode = doublelinkedlist.DLList()
 
-        for radius in self.prime_tower.get_pillar_bands(self.layer_num, tool_id):
-            # Start each circle at a different point to avoid weakening the tower
-            circle_vertices = deque(circle_generate_vertices(conf.prime_tower_x, conf.prime_tower_y, radius, conf.prime_tower_band_num_faces))
-            circle_vertices.rotate(self.layer_num)
-
-            band_gcode.append_nodes(self.gcode_print_shape(circle_vertices, tool_id))
+        # Start each circle at a different point to avoid weakening the tower
+        shapes = band_shapes(config.prime_tower_x, config.prime_tower_y, tuple(self.prime_tower.get_pillar_bands(self.layer_num, tool_id)),
+                             config.prime_tower_band_num_faces, self.layer_num % config.prime_tower_band_num_faces,
+                             config.extrusion_factors(tool_id, self.layer_height))
+        for circle_vertices, segments_E in shapes:
+            band_gcode.append_nodes(self.gcode_print_shape(circle_vertices, tool_id, segments_E = segments_E))
 
-        if conf.GCODE_VERBOSE:
+        if config.gcode_verbose:
             band_gcode.head.comment = "TC-PSPP - T{tool} - Pillar - Start".format(tool = tool_id)
             band_gcode.tail.comment = "TC-PSPP - T{tool} - Pillar - End".format(tool = tool_id)
         
@@ -88,21 +176,23 @@ class PrimeTowerLayerInfo(LayerInfo):
 
     # Generate gcode for pillar bands for IDLE tools
     def gcode_pillar_idle_tool_bands(self, tool_id): 
+        config = self.prime_tower.config
         # Generate vertices
         tokens = doublelinkedlist.DLList()
 
         for idle_tool_id in self.tools_idle:
             gcode_band = doublelinkedlist.DLList()
-            for radius in self.prime_tower.get_pillar_bands(self.layer_num, idle_tool_id):
-                vertices = circle_generate_vertices(conf.prime_tower_x, conf.prime_tower_y, radius, conf.prime_tower_band_num_faces)
-                gcode_band.append_nodes(self.gcode_print_shape(vertices, tool_id))
+            shapes = band_shapes(config.prime_tower_x, config.prime_tower_y, tuple(self.prime_tower.get_pillar_bands(self.layer_num, idle_tool_id)),
+                                 config.prime_tower_band_num_faces, 0, config.extrusion_factors(tool_id, self.layer_height))
+            for vertices, segments_E in shapes:
+                gcode_band.append_nodes(self.gcode_print_shape(vertices, tool_id, segments_E = segments_E))
                         
             gcode_band.head.append_node(gcode_analyzer.GCode('G11'))
             gcode_band.head.append_node_left(gcode_analyzer.GCode('G10'))
 
             tokens.append_nodes(gcode_band)
 
-        if conf.GCODE_VERBOSE:
+        if config.gcode_verbose:
             tokens.head.comment = "TC-PSPP - Prime tower idle tool infill for layer #{layer} - start".format(layer = self.layer_num)
             tokens.tail.comment = "TC-PSPP - Prime tower idle tool infill for layer #{layer} - end".format(layer = self.layer_num)
 
@@ -126,7 +216,7 @@ class PrimeTowerLayerInfo(LayerInfo):
         # - if was retracted, just add unretraction after first move from gcode
         if inject_point.state_post.retraction == gcode_analyzer.GCodeAnalyzer.State.RETRACTED:
             gcode.head.append_node(gcode_analyzer.GCode('G11', comment = 'move-in detract'))
-        gcode.head.append_node_left(gcode_analyzer.GCode('G1', { 'F' : conf.prime_tower_move_speed }))
+        gcode.head.append_node_left(gcode_analyzer.GCode('G1', { 'F' : self.prime_tower.config.prime_tower_move_speed }))
 
         return gcode
 
@@ -144,7 +234,7 @@ class PrimeTowerLayerInfo(LayerInfo):
         if inject_point.type != Token.PARAMS or inject_point.label != 'BEFORE_LAYER_CHANGE':
             gcode.append_node(gcode_analyzer.GCode('G10', comment = 'move-out retract'))
             if inject_point.state_post.x != None and inject_point.state_post.y != None:
-                gcode.append_node(gcode_analyzer.GCode('G1', { 'F' : conf.prime_tower_move_speed }))
+                gcode.append_node(gcode_analyzer.GCode('G1', { 'F' : self.prime_tower.config.prime_tower_move_speed }))
                 if inject_point.state_post.z < self.layer_z:
                     gcode.append_node(gcode_analyzer.GCode('G1', { 'X' : inject_point.state_post.x, 'Y' : inject_point.state_post.y }))
                     gcode.append_node(gcode_analyzer.GCode('G1', { 'Z' : inject_point.state_post.z }))
@@ -155,7 +245,7 @@ class PrimeTowerLayerInfo(LayerInfo):
                     gcode.append_node(gcode_analyzer.GCode('G1', { 'X' : inject_point.state_post.x, 'Y' : inject_point.state_post.y }))
                 gcode.append_node(gcode_analyzer.GCode('G1', { 'F' : inject_point.state_post.feed_rate}))
             else:
-                print("Warning : X/Y position state not present, if this error apears more then once the GCode is malformed")
+                print("Warning : X/Y position state not present, if this error apears more then once the GCode is malformed", file = self.prime_tower.log)
 
             # Retract before 
             # - if  tool was unretracted before entry point - unretract after the move
@@ -175,7 +265,7 @@ class PrimeTowerLayerInfo(LayerInfo):
         # Check if we need to continue constructing the tower
         if len(self.tools_active) == 1 and len(self.tools_idle) == 0:
             if conf.DEBUG:
-                print("(DEBUG) One tool ACTIVE and no more IDLE tools - can stop generating prime tower")
+                print("(DEBUG) One tool ACTIVE and no more IDLE tools - can stop generating prime tower", file = self.prime_tower.log)
             return 
 
         tool_indx = 0
@@ -199,14 +289,14 @@ class PrimeTowerLayerInfo(LayerInfo):
             # Generate BAND
             gcode_band = self.gcode_pillar_band(tool_id = tool_change.tool_id)
             if conf.DEBUG:
-                print("(DEBUG) Generated prime tower band for layer #{layer_num} for T{tool}".format(layer_num = self.layer_num, tool = tool_change.tool_id))
+                print("(DEBUG) Generated prime tower band for layer #{layer_num} for T{tool}".format(layer_num = self.layer_num, tool = tool_change.tool_id), file = self.prime_tower.log)
 
             gcode_idle = None
             if not filled_idle_gaps and len(self.tools_idle) != 0:
                 gcode_idle = self.gcode_pillar_idle_tool_bands(tool_change.tool_id)
                 filled_idle_gaps = True
                 if conf.DEBUG:
-                    print("(DEBUG) Generated prime tower idle tools infill for layer #{layer_num} with T{tool}".format(layer_num = self.layer_num, tool = tool_change.tool_id))
+                    print("(DEBUG) Generated prime tower idle tools infill for layer #{layer_num} with T{tool}".format(layer_num = self.layer_num, tool = tool_change.tool_id), file = self.prime_tower.log)
 
             # Finally inject 
             gcode = gcode_band
@@ -225,16 +315,21 @@ class PrimeTowerLayerInfo(LayerInfo):
 
             inject_point.append_nodes_right(gcode)
             if conf.DEBUG:
-                print("(DEBUG) Generated prime tower band for layer #{layer} for T{tool}".format(layer = self.layer_num, tool = tool_change.tool_id))
+                print("(DEBUG) Generated prime tower band for layer #{layer} for T{tool}".format(layer = self.layer_num, tool = tool_change.tool_id), file = self.prime_tower.log)
 
             tool_indx += 1
 
 ###########################################################################################################
 # Prime Tower 
 # Contains all the information related to prime tower generation
-class PrimeTower:
+class PrimeTower(Stage):
+
+    name = 'prime_tower'
+    requires = ('validator',)
 
     def __init__(self, layers = None):
+        self.config = None
+        self.log = None
         if layers is not None:
             self.generate_layers(layers)
        
@@ -247,33 +342,33 @@ class PrimeTower:
         layer0_tools = [tool.tool_id for tool in self.layers[0].tools_sequence] + sorted(self.layers[0].tools_idle)
 
         # - BRIM
-        current_r = conf.prime_tower_r
+        current_r = self.config.prime_tower_r
         for tool in layer0_tools:
             self.brim_radiuses[tool] = []
 
-            for indx in range(0, conf.brim_width):
-                current_r += conf.tool_nozzle_diameter[tool] / 2.0
+            for indx in range(0, self.config.brim_width):
+                current_r += self.config.tool_nozzle_diameter[tool] / 2.0
                 self.brim_radiuses[tool].append(current_r)
-                current_r += conf.tool_nozzle_diameter[tool] / 2.0
-        current_r = conf.prime_tower_r
-        while current_r > 1.5 * conf.tool_nozzle_diameter[0]:
-            current_r -= conf.tool_nozzle_diameter[0] / 2.0
+                current_r += self.config.tool_nozzle_diameter[tool] / 2.0
+        current_r = self.config.prime_tower_r
+        while current_r > 1.5 * self.config.tool_nozzle_diameter[0]:
+            current_r -= self.config.tool_nozzle_diameter[0] / 2.0
             self.brim_radiuses[tool].insert(0, current_r)
-            current_r -= conf.tool_nozzle_diameter[0] / 2.0
+            current_r -= self.config.tool_nozzle_diameter[0] / 2.0
 
         # - BAND
-        current_r = conf.prime_tower_r
+        current_r = self.config.prime_tower_r
         for tool in layer0_tools:
             self.band_radiuses[tool] = []
 
-            for indx in range(0, conf.prime_tower_band_width):
-                current_r += conf.tool_nozzle_diameter[tool] / 2.0
+            for indx in range(0, self.config.prime_tower_band_width):
+                current_r += self.config.tool_nozzle_diameter[tool] / 2.0
                 self.band_radiuses[tool].append(current_r)
-                current_r += conf.tool_nozzle_diameter[tool] / 2.0
+                current_r += self.config.tool_nozzle_diameter[tool] / 2.0
 
     # Get the bands for specific layer
     def get_pillar_bands(self, layer_num, tool_id):
-        if layer_num < conf.brim_height:
+        if layer_num < self.config.brim_height:
             return self.brim_radiuses[tool_id]
         else:
             return self.band_radiuses[tool_id]
@@ -316,89 +411,100 @@ class PrimeTower:
 
     # Generate the layers for prime tower printing
     def analyze_gcode(self, gcode_analyzer):
+        Pipeline([self]).run(gcode_analyzer)
+        return True
+
+    # Stage - only the layer/tool change markers are needed
+    def handlers(self):
+        return {
+            ('label', 'AFTER_LAYER_CHANGE') : self.on_after_layer_change,
+            ('label', 'BEFORE_LAYER_CHANGE') : self.on_before_layer_change,
+            ('type', Token.TOOLCHANGE) : self.on_tool_change,
+            ('label', 'TOOL_BLOCK_START') : self.on_tool_block_start,
+            ('label', 'TOOL_BLOCK_END') : self.on_tool_block_end }
+
+    def begin(self, gcode_analyzer):
+        self.config = gcode_analyzer.config
+        self.log = gcode_analyzer.log
         self.layers = [PrimeTowerLayerInfo(prime_tower = self)]
 
-        t_start = time.time()
+        self.t_start = time.time()
 
         # Active tool
-        current_tool = None            # Tool Change Info
-        layer_info = self.layers[-1]   # Layer Info
-        for token in gcode_analyzer.analyze_state():
-            # Check if AFTER_LAYER_CHANGE label
-            if token.type == Token.PARAMS and token.label == 'AFTER_LAYER_CHANGE':
-                current_layer, current_layer_z = token.param[0], token.param[1]
-                previous_layer_z = 0.0
-                # This is because will put first tool before the AFTER_LAYER_CHANGE-BEFORE_LAYER_CHANGE block
-                if current_layer != 0:
-                    previous_layer_z = layer_info.layer_z
-                    layer_info = PrimeTowerLayerInfo(prime_tower = self)
-                    self.layers.append(layer_info)
-             
-                # Update the value
-                layer_info.layer_num = current_layer
-                layer_info.layer_z = current_layer_z
-                layer_info.layer_height = current_layer_z - previous_layer_z
-             
-                # Update the values
-                layer_info.layer_start = token
-
-                # If current tool is not none 
-                if current_tool is not None:
-                    self.layers[-1].tools_sequence = [current_tool]
-                else:
-                    self.layers[-1].tools_sequence = []
-
-                continue
-
-            # Check if BEFORE_LAYER_CHANGE label
-            if token.type == Token.PARAMS and token.label == 'BEFORE_LAYER_CHANGE':
-                next_layer, next_layer_z = token.param[0], token.param[1]
-                # Mark the last layer end as the token before BEFORE_LAYER_CHANGE
-                layer_info.layer_end = token
-
-                # Validate the height
-                toolset = [tool_change_info.tool_id for tool_change_info in layer_info.tools_sequence]
-                toolset_min_layer_height = conf.min_layer_height(toolset)
-                toolset_max_layer_height = conf.max_layer_height(toolset)
-
-                # Layer height higher then max for the toolset (shouldn't happen!)
-                if layer_info.layer_height > toolset_max_layer_height:
-                    raise PrimeTowerException("Input layer #{layer_num} height {layer_height:0.4f} higher then max allowed for the toolset {tools}".format(
-                        layer_num = layer_info.layer_num,
-                        layer_height = layer_info.layer_height, 
-                        tools = ','.join(['T' + str(tool_id) for tool_id in toolset])))
-                continue
-
-            # Check if Tool change
-            if token.type == Token.TOOLCHANGE:
-                if token.next_tool != -1:
-                    current_tool = ToolChangeInfo(tool_change = token)
-                    if conf.DEBUG:
-                        print("(DEBUG) PrimeTower - Added tool T{tool_id} to layer #{layer_num}".format(tool_id = token.next_tool, layer_num = self.layers[-1].layer_num))
-
-                    layer_info.tool_change_seq.append(current_tool)
-                    layer_info.tools_sequence.append(current_tool)
-                continue
-
-            # Beginning to Tool block
-            if token.type == Token.PARAMS and token.label == 'TOOL_BLOCK_START':
-                tool_id = token.param[0]
-                if tool_id != -1:
-                    if tool_id != current_tool.tool_id:
-                        raise ToolChangeException("Tool id {tool_id} from TOOL_BLOCK_START doesn't match last active tool in layer".format(tool_id = tool_id))
-                    current_tool.block_start = token
-                continue
-
-            # End of Tool block
-            if token.type == Token.PARAMS and token.label == 'TOOL_BLOCK_END':
-                tool_id = token.param[0]
-                if tool_id != -1:
-                    if tool_id != current_tool.tool_id:
-                        raise ToolChangeException("Tool id {tool_id} from TOOL_BLOCK_END doesn't match last active tool in layer".format(tool_id = tool_id))
-                    current_tool.block_end = token
-                continue
-            
-
+        self.current_tool = None            # Tool Change Info
+        self.layer_info = self.layers[-1]   # Layer Info
+
+    # Check if AFTER_LAYER_CHANGE label
+    def on_after_layer_change(self, token):
+        layer_info = self.layer_info
+        current_layer, current_layer_z = token.param[0], token.param[1]
+        previous_layer_z = 0.0
+        # This is because will put first tool before the AFTER_LAYER_CHANGE-BEFORE_LAYER_CHANGE block
+        if current_layer != 0:
+            previous_layer_z = layer_info.layer_z
+            layer_info = self.layer_info = PrimeTowerLayerInfo(prime_tower = self)
+            self.layers.append(layer_info)
+     
+        # Update the value
+        layer_info.layer_num = current_layer
+        layer_info.layer_z = current_layer_z
+        layer_info.layer_height = current_layer_z - previous_layer_z
+     
+        # Update the values
+        layer_info.layer_start = token
+
+        # If current tool is not none 
+        if self.current_tool is not None:
+            self.layers[-1].tools_sequence = [self.current_tool]
+        else:
+            self.layers[-1].tools_sequence = []
+
+    # Check if BEFORE_LAYER_CHANGE label
+    def on_before_layer_change(self, token):
+        layer_info = self.layer_info
+        next_layer, next_layer_z = token.param[0], token.param[1]
+        # Mark the last layer end as the token before BEFORE_LAYER_CHANGE
+        layer_info.layer_end = token
+
+        # Validate the height
+        toolset = [tool_change_info.tool_id for tool_change_info in layer_info.tools_sequence]
+        toolset_min_layer_height = self.config.min_layer_height(toolset)
+        toolset_max_layer_height = self.config.max_layer_height(toolset)
+
+        # Layer height higher then max for the toolset (shouldn't happen!)
+        if layer_info.layer_height > toolset_max_layer_height:
+            raise PrimeTowerException("Input layer #{layer_num} height {layer_height:0.4f} higher then max allowed for the toolset {tools}".format(
+                layer_num = layer_info.layer_num,
+                layer_height = layer_info.layer_height, 
+                tools = ','.join(['T' + str(tool_id) for tool_id in toolset])))
+
+    # Check if Tool change
+    def on_tool_change(self, token):
+        if token.next_tool != -1:
+            self.current_tool = ToolChangeInfo(tool_change = token)
+            if conf.DEBUG:
+                print("(DEBUG) PrimeTower - Added tool T{tool_id} to layer #{layer_num}".format(tool_id = token.next_tool, layer_num = self.layers[-1].layer_num), file = self.log)
+
+            self.layer_info.tool_change_seq.append(self.current_tool)
+            self.layer_info.tools_sequence.append(self.current_tool)
+
+    # Beginning to Tool block
+    def on_tool_block_start(self, token):
+        tool_id = token.param[0]
+        if tool_id != -1:
+            if tool_id != self.current_tool.tool_id:
+                raise ToolChangeException("Tool id {tool_id} from TOOL_BLOCK_START doesn't match last active tool in layer".format(tool_id = tool_id))
+            self.current_tool.block_start = token
+
+    # End of Tool block
+    def on_tool_block_end(self, token):
+        tool_id = token.param[0]
+        if tool_id != -1:
+            if tool_id != self.current_tool.tool_id:
+                raise ToolChangeException("Tool id {tool_id} from TOOL_BLOCK_END doesn't match last active tool in layer".format(tool_id = tool_id))
+            self.current_tool.block_end = token
+
+    def end(self, gcode_analyzer):
         # Generate the active/idle/disabled list
         #-----------------------------------------------------------
         self.analyze_tool_status()
@@ -408,9 +514,7 @@ class PrimeTower:
 
         t_end = time.time()
         if conf.PERF_INFO:
-            print("PrimeTower: analysis done [elapsed: {elapsed:0.2f}s]".format(elapsed = t_end - t_start))
-
-        return True
+            print("PrimeTower: analysis done [elapsed: {elapsed:0.2f}s]".format(elapsed = t_end - self.t_start), file = self.log)
 
     # Optimize the layers of prime tower
     # Squish the layers of prime tower following the rules:
@@ -439,8 +543,8 @@ class PrimeTower:
                 optimized_active_tools = copy.copy(optimized_layers[optimized_layer_indx].tools_active)
                 optimized_active_tools.update(next_layer_tool_change_ids)
 
-                min_layer_height = conf.min_layer_height(optimized_active_tools)
-                max_layer_height = conf.max_layer_height(optimized_active_tools)
+                min_layer_height = self.config.min_layer_height(optimized_active_tools)
+                max_layer_height = self.config.max_layer_height(optimized_active_tools)
 
                 # 2) new layer height within margins
                 if min_layer_height <= optimized_layer_height <= max_layer_height:
@@ -449,8 +553,8 @@ class PrimeTower:
                             height = optimized_layer_height, 
                             min = min_layer_height, 
                             max = max_layer_height,
-                            tools = ','.join([str(tool) for tool in optimized_active_tools])))
-                        print("(DEBUG) Prime tower layer #{layer_num} can be combined with previous layer, squashing...".format(layer_num = layer_info.layer_num))
+                            tools = ','.join([str(tool) for tool in optimized_active_tools])), file = self.log)
+                        print("(DEBUG) Prime tower layer #{layer_num} can be combined with previous layer, squashing...".format(layer_num = layer_info.layer_num), file = self.log)
 
                     # Update the old layer
                     optimized_layers[optimized_layer_indx].tool_change_seq += layer_info.tool_change_seq
@@ -492,6 +596,6 @@ class PrimeTower:
                 num_layers_by_height[layer.layer_height] += 1
 
         # Print info
-        print("Prime Tower Info :")
-        print(" - num layers : {layers_num}".format(layers_num = len(self.layers)))
+        print("Prime Tower Info :", file = self.log)
+        print(" - num layers : {layers_num}".format(layers_num = len(self.layers)), file = self.log)
         
@@ -0,0 +1,149 @@
+# Result cache
+# Content addressed on-disk cache of the post-processed outputs
+# - key: SHA-256 of the input GCode bytes, the job config (+ the output affecting modes) and the tool version
+#   (source of the pipeline modules - any change of the code invalidates the entries)
+# - entry: <cache_dir>/<key[:2]>/<key>.gcode (output) + <key>.json (output name parts, report of the run)
+# - size capped, the least recently used entries are evicted (metadata mtime is the last use)
+# - layer results of the last run per input file: <cache_dir>/layers/<SHA-256 of the input path>.json
+#   (see layer_fingerprint) - counted in the size cap, evicted with the entries (mtime is the last run)
+# Entries are written atomically, a broken/evicted entry read by another process counts as a miss
+import conf
+import gcode_writer
+
+import functools, hashlib, json, os, time
+
+# Modules the output depends on
+PIPELINE_MODULES = ['conf', 'doublelinkedlist', 'gcode_analyzer', 'gcode_writer', 'layer_fingerprint', 'pcf_control', 'prime_tower',
+                    'shard_analysis', 'tcpspp', 'thermal_control', 'tool_change_plan']
+
+# Cache format version (bump when the entry layout changes)
+CACHE_FORMAT = 1
+
+# Layer results directory
+LAYERS_DIR = 'layers'
+
+# Chunk size to hash/copy the files with
+CHUNK_SIZE = 1 << 20
+
+# Tool version - hash of the source of the pipeline modules
+@functools.lru_cache(maxsize = 1)
+def tool_version():
+    digest = hashlib.sha256()
+    for name in PIPELINE_MODULES:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name + '.py'), mode='rb') as source_in:
+            digest.update(source_in.read())
+    return digest.hexdigest()
+
+# Result cache of the config (None if disabled - conf.RESULT_CACHE_DIR not set)
+def default_cache():
+    if conf.RESULT_CACHE_DIR is None:
+        return None
+    return ResultCache(conf.RESULT_CACHE_DIR, conf.RESULT_CACHE_SIZE)
+
+class ResultCache:
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def entry_files(self, key):
+        entry_dir = os.path.join(self.cache_dir, key[:2])
+        return os.path.join(entry_dir, key + '.gcode'), os.path.join(entry_dir, key + '.json')
+
+    # Layer results of the last run of the input file (re-exported plates keep the file path)
+    def layer_results_file(self, filename):
+        name = hashlib.sha256(os.path.abspath(filename).encode('utf8')).hexdigest()
+        return os.path.join(self.cache_dir, LAYERS_DIR, name + '.json')
+
+    def put_layer_results(self, filename, layer_results):
+        results_path = self.layer_results_file(filename)
+        os.makedirs(os.path.dirname(results_path), exist_ok = True)
+        layer_results.save(results_path)
+
+    # Key of the input file processed with the config
+    def key(self, filename, config):
+        digest = hashlib.sha256()
+        digest.update(json.dumps({
+            'format' : CACHE_FORMAT,
+            'version' : tool_version(),
+            'config' : config.as_dict(),
+            'sparse' : conf.SPARSE_TOKENS }, sort_keys = True).encode('utf8'))
+        with open(filename, mode='rb') as gcode_in:
+            for chunk in iter(lambda: gcode_in.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    # Metadata of the cached entry (None if not cached) - marks the entry as used
+    def get(self, key):
+        output_path, meta_path = self.entry_files(key)
+        try:
+            with open(meta_path, mode='r') as meta_in:
+                meta = json.load(meta_in)
+            if os.path.getsize(output_path) != meta['output_size']:
+                return None
+            os.utime(meta_path)
+        except (OSError, ValueError, KeyError):
+            return None
+        return meta
+
+    # Copy the cached output to the file (replaced atomically)
+    # returns False if the entry is gone
+    def restore(self, key, filename_out):
+        output_path, _ = self.entry_files(key)
+        try:
+            with open(output_path, mode='rb') as cached_in:
+                with gcode_writer.GCodeWriter(filename_out) as gcode_out:
+                    for chunk in iter(lambda: cached_in.read(CHUNK_SIZE), b''):
+                        gcode_out.write(chunk)
+        except FileNotFoundError:
+            return False
+        return True
+
+    # Store the output with its metadata (output name parts, report) - evicts over the size cap
+    def put(self, key, filename_out, meta):
+        output_path, meta_path = self.entry_files(key)
+        os.makedirs(os.path.dirname(output_path), exist_ok = True)
+
+        with open(filename_out, mode='rb') as output_in:
+            with gcode_writer.GCodeWriter(output_path) as cached_out:
+                for chunk in iter(lambda: output_in.read(CHUNK_SIZE), b''):
+                    cached_out.write(chunk)
+
+        meta = dict(meta, key = key, output_size = os.path.getsize(output_path), created = time.time())
+        with gcode_writer.GCodeWriter(meta_path) as meta_out:
+            meta_out.write(json.dumps(meta, indent = 2).encode('utf8'))
+
+        self.evict()
+
+    # Evict the least recently used entries and layer results over the size cap
+    def evict(self):
+        entries = []
+        total_size = 0
+        for entry_dir, dirs, files in os.walk(self.cache_dir):
+            layers = os.path.basename(entry_dir) == LAYERS_DIR
+            for name in files:
+                if not name.endswith('.json'):
+                    continue
+                meta_path = os.path.join(entry_dir, name)
+                # Metadata first - the entry stops being a hit before the output goes
+                paths = (meta_path,) if layers else (meta_path, meta_path[:-len('.json')] + '.gcode')
+                try:
+                    size = sum(os.path.getsize(path) for path in paths)
+                    last_used = os.path.getmtime(meta_path)
+                except OSError:
+                    continue
+                entries.append((last_used, size, paths))
+                total_size += size
+
+        entries.sort()
+        for last_used, size, paths in entries:
+            if total_size <= self.max_size:
+                break
+            if conf.DEBUG:
+                print("(DEBUG) ResultCache: Evicting {entry}".format(entry = os.path.basename(paths[-1])))
+            for path in paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total_size -= size
@@ -0,0 +1,246 @@
+# Parallel parse and analysis
+# The file is split into shards at the layer changes, each shard is tokenized and analyzed
+# by a worker process while the main process parses the file into the token list
+# - round 1: each worker summarizes the effect of its shard on the state (independent of the state before it),
+#            the state before each shard is composed from the summaries of the shards before it
+# - round 2: each worker analyzes its shard from the state before it (runtimes + state snapshots)
+# The results are attached to the parsed token list as if analyzed by GCodeAnalyzer.analyze_state
+import gcode_analyzer
+import conf
+
+import concurrent.futures
+import mmap, re
+from array import array
+
+# Shards smaller than this are not worth a worker
+MIN_SHARD_SIZE = 1 << 20
+
+# Shard boundaries - start of the layer change params
+LAYER_CHANGE = re.compile(rb'^[ \t]*;;[ \t]*BEFORE_LAYER_CHANGE', re.MULTILINE)
+
+# Shard exception - shards can't be analyzed independently
+class ShardException(Exception):
+    def __init__(self, message):
+        self.message = message
+
+# Split the buffer into up to <shards> shards at the layer changes
+# returns the list of (start, end) offsets
+def shard_offsets(buffer, shards):
+    size = len(buffer)
+    shards = min(shards, size // MIN_SHARD_SIZE)
+
+    offsets = [0]
+    for indx in range(1, shards):
+        match = LAYER_CHANGE.search(buffer, max(offsets[-1] + 1, size * indx // shards))
+        if match is None:
+            break
+        offsets.append(match.start())
+    offsets.append(size)
+
+    return list(zip(offsets[:-1], offsets[1:]))
+
+# Byte lines of the shard
+def shard_lines(buffer, start, end):
+    buffer.seek(start)
+    while buffer.tell() < end:
+        yield buffer.readline()
+
+# Shard summary
+# Effect of the shard on the state - mirrors GCodeAnalyzer.apply_token
+# - state fields not set in the shard are None (kept from the state before the shard)
+# - retraction/extrusion of the tool selected before the shard are kept under ENTRY_TOOL
+class ShardSummary:
+
+    # Tool selected before the shard (-1 is no tool)
+    ENTRY_TOOL = -2
+
+    def __init__(self):
+        self.tokens = 0
+        self.stack = [gcode_analyzer.GCodeAnalyzer.State(tool_selected = ShardSummary.ENTRY_TOOL)]
+
+    def apply_token(self, token):
+        Token = gcode_analyzer.Token
+        State = gcode_analyzer.GCodeAnalyzer.State
+        state = self.stack[-1]
+        self.tokens += 1
+
+        if token.type == Token.TOOLCHANGE:
+            state.tool_selected = token.next_tool
+            if token.next_tool != -1 and token.next_tool not in state.tool_extrusion:
+                state.tool_extrusion[token.next_tool] = 0.0
+        elif token.type == Token.GCODE:
+            if token.gcode == 'G10' or token.gcode == 'G11':
+                if state.tool_selected != -1:
+                    state.tool_retraction[state.tool_selected] = State.RETRACTED if token.gcode == 'G10' else State.UNRETRACTED
+            elif token.gcode == 'G1':
+                param = token.param
+                if 'X' in param:
+                    state.x = float(param['X'])
+                if 'Y' in param:
+                    state.y = float(param['Y'])
+                if 'Z' in param:
+                    state.z = float(param['Z'])
+                if 'F' in param:
+                    state.feed_rate = float(param['F'])
+                if 'E' in param and state.tool_selected != -1:
+                    state.tool_extrusion[state.tool_selected] = state.tool_extrusion.get(state.tool_selected, 0.0) + float(param['E'])
+            elif token.gcode == 'M120':
+                self.stack.append(state.copy())
+            elif token.gcode == 'M121':
+                if len(self.stack) == 1:
+                    raise ShardException("M121 pops the state pushed before the shard")
+                self.stack.pop()
+        elif token.type == Token.PARAMS:
+            if token.label == 'AFTER_LAYER_CHANGE':
+                state.layer_num = token.param[0]
+
+    # State stack after the shard for the state stack before it
+    def apply(self, state_stack):
+        if len(self.stack) != 1:
+            raise ShardException("M120 push not popped by the end of the shard")
+        summary = self.stack[0]
+        state = state_stack[-1].copy()
+
+        for attr in ('x', 'y', 'z', 'feed_rate', 'layer_num'):
+            if getattr(summary, attr) is not None:
+                setattr(state, attr, getattr(summary, attr))
+
+        # Tool before the shard first, then the tools selected in the shard
+        entry_tool = state.tool_selected
+        tools = sorted(set(summary.tool_extrusion) | set(summary.tool_retraction), key = lambda tool: tool != ShardSummary.ENTRY_TOOL)
+        for tool in tools:
+            tool_id = entry_tool if tool == ShardSummary.ENTRY_TOOL else tool
+            if tool_id is None:
+                raise ShardException("Extrusion/retraction with no tool selected")
+            if tool in summary.tool_extrusion:
+                state.tool_extrusion[tool_id] = state.tool_extrusion.get(tool_id, 0.0) + summary.tool_extrusion[tool]
+            if tool in summary.tool_retraction:
+                state.tool_retraction[tool_id] = summary.tool_retraction[tool]
+
+        if summary.tool_selected != ShardSummary.ENTRY_TOOL:
+            state.tool_selected = summary.tool_selected if summary.tool_selected != -1 else None
+
+        return state_stack[:-1] + [state]
+
+# Worker - round 1, summarize the shard
+def summarize_shard(filename, start, end):
+    with open(filename, mode='rb') as gcode_in:
+        with mmap.mmap(gcode_in.fileno(), 0, access = mmap.ACCESS_READ) as buffer:
+            summary = ShardSummary()
+            for token in gcode_analyzer.tokenize_bytes(shard_lines(buffer, start, end)):
+                summary.apply_token(token)
+            return summary
+
+# Worker - round 2, analyze the shard from the state before it
+# returns the runtimes and the state snapshots (token index in the shard, state stack)
+def analyze_shard(filename, start, end, seq, state_stack, interval):
+    runtimes = array('d')
+    snapshots = []
+
+    with open(filename, mode='rb') as gcode_in:
+        with mmap.mmap(gcode_in.fileno(), 0, access = mmap.ACCESS_READ) as buffer:
+            for token in gcode_analyzer.tokenize_bytes(shard_lines(buffer, start, end)):
+                runtimes.append(gcode_analyzer.GCodeAnalyzer.apply_token(state_stack, token))
+                if seq % interval == 0:
+                    snapshots.append((len(runtimes) - 1, [state.copy() for state in state_stack]))
+                seq += 1
+
+    return runtimes, snapshots
+
+# Parallel analysis of the file being parsed
+class ShardAnalysis:
+
+    # Tokens parsed between checking on the workers
+    POLL_INTERVAL = 4096
+
+    def __init__(self, filename, buffer, workers, interval, config):
+        self.filename = filename
+        self.interval = interval
+        self.config = config
+        self.shards = shard_offsets(buffer, workers)
+        self.executor = None
+        self.summaries = None
+        self.results = None
+        self.error = None
+
+        if len(self.shards) > 1:
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers = len(self.shards))
+            self.summaries = [self.executor.submit(summarize_shard, filename, start, end) for start, end in self.shards]
+
+    @property
+    def active(self):
+        return self.executor is not None
+
+    # Start round 2 once all the summaries are in
+    def poll(self):
+        if self.results is None and self.error is None and all(summary.done() for summary in self.summaries):
+            try:
+                self.submit_shards()
+            except Exception as err:
+                self.error = err
+
+    def submit_shards(self):
+        state_stack = [gcode_analyzer.GCodeAnalyzer.State(config = self.config)]
+        seq = 0
+        self.results = []
+        for (start, end), summary in zip(self.shards, self.summaries):
+            summary = summary.result()
+            self.results.append(self.executor.submit(analyze_shard, self.filename, start, end, seq, state_stack, self.interval))
+            state_stack = summary.apply(state_stack)
+            seq += summary.tokens
+
+    # Pass thru the tokens while checking on the workers
+    def poll_tokens(self, tokens):
+        for indx, token in enumerate(tokens):
+            if indx % ShardAnalysis.POLL_INTERVAL == 0:
+                self.poll()
+            yield token
+
+    # Wait for the workers and attach the results to the parsed tokens
+    # returns False if the shards could not be analyzed (the tokens are left not analyzed)
+    def finish(self, analyzer):
+        try:
+            if self.error is not None:
+                raise self.error
+            if self.results is None:
+                self.submit_shards()
+            results = [result.result() for result in self.results]
+        except Exception as err:
+            if conf.DEBUG:
+                print("(DEBUG) ShardAnalysis: Falling back to serial analysis - {error}".format(error = getattr(err, 'message', repr(err))), file = analyzer.log)
+            return False
+        finally:
+            self.close()
+
+        if sum(len(runtimes) for runtimes, _ in results) != len(analyzer.tokens):
+            print("Warning : ShardAnalysis: Shard tokens don't match the parsed tokens, falling back to serial analysis", file = analyzer.log)
+            return False
+
+        trace = gcode_analyzer.GCodeAnalyzer.StateTrace(self.interval, self.config)
+        total_runtime = 0.0
+        seq = 0
+        node = analyzer.tokens.head
+        for runtimes, snapshots in results:
+            snapshots = iter(snapshots)
+            snapshot = next(snapshots, None)
+            for indx, runtime in enumerate(runtimes):
+                node.seq = seq
+                node.state_trace = trace
+                node.runtime = runtime
+                total_runtime += runtime
+                if snapshot is not None and snapshot[0] == indx:
+                    trace.seqs.append(seq)
+                    trace.snapshots.append((node, snapshot[1], total_runtime))
+                    snapshot = next(snapshots, None)
+                seq += 1
+                node = node.next
+
+        analyzer.state_trace = trace
+        analyzer.total_runtime = total_runtime
+        return True
+
+    # Stop the workers
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures = True)
+            self.executor = None
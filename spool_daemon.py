@@ -0,0 +1,332 @@
+# TC-PSPP spool daemon
+# Long running service processing the GCode files handed over by the Slic3r post-processing hook
+# - Slic3r post-processing script: tcpspp.py --spool <spool_dir>
+# - daemon: spool_daemon.py <spool_dir> [--workers N] [--poll seconds]
+#
+# Spool directory layout
+# - <spool_dir>/<job>.gcode, <job>.env.json - submitted job, the Slic3r settings sidecar is written last (marks the job complete)
+# - <spool_dir>/work   - jobs being processed (moved back to the spool on the daemon start)
+#   <job>.started - written by the worker running the job, <job>.crashes - worker crashes of the job so far
+# - <spool_dir>/done   - output GCode, <job>.report.json (stage profile) and <job>.log
+# - <spool_dir>/failed - input GCode and settings of the failed jobs, <job>.report.json (error) and <job>.log
+# The jobs run on a pool of warm worker processes - the modules are imported once, the prime tower shape
+# caches are kept across the jobs
+# A worker crash breaks the pool - the jobs not started yet go back to the spool, the crash counts against the job
+# only if it was the only one running (the jobs running together are re-run one at a time to find the crashing one)
+import conf
+import gcode_writer
+import result_cache
+import stage_profiler
+import tcpspp
+
+import argparse, concurrent.futures, json, os, shutil, signal, threading, time, traceback
+
+# Slic3r settings sidecar of the job
+SETTINGS_SUFFIX = '.env.json'
+# Job markers in the work directory
+STARTED_SUFFIX = '.started'
+CRASHES_SUFFIX = '.crashes'
+
+# Worker crashes of a job before it is moved to failed
+MAX_CRASHES = 3
+
+WORK_DIR = 'work'
+DONE_DIR = 'done'
+FAILED_DIR = 'failed'
+
+# Spool exception
+class SpoolException(Exception):
+    def __init__(self, message):
+        self.message = message
+
+# Create the spool directories
+def spool_dirs(spool_dir):
+    for name in (WORK_DIR, DONE_DIR, FAILED_DIR):
+        os.makedirs(os.path.join(spool_dir, name), exist_ok = True)
+
+def job_files(directory, job):
+    return os.path.join(directory, job + '.gcode'), os.path.join(directory, job + SETTINGS_SUFFIX)
+
+# Move the job files (with the crash count) - the settings sidecar last, the job is complete once it's there
+def move_job(from_dir, to_dir, job):
+    for suffix in ('.gcode', CRASHES_SUFFIX, SETTINGS_SUFFIX):
+        path = os.path.join(from_dir, job + suffix)
+        if os.path.exists(path):
+            os.replace(path, os.path.join(to_dir, job + suffix))
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+# Worker crashes of the job so far
+def job_crashes(directory, job):
+    try:
+        with open(os.path.join(directory, job + CRASHES_SUFFIX), mode='r') as crashes_in:
+            return int(crashes_in.read())
+    except (OSError, ValueError):
+        return 0
+
+# Write the JSON file (replaced atomically)
+def write_json(filename, data):
+    with gcode_writer.GCodeWriter(filename) as json_out:
+        json_out.write(json.dumps(data, indent = 2).encode('utf8'))
+
+# Submit the GCode file with the Slic3r settings to the spool
+# - keep - copy the file (moved otherwise)
+# returns the job name
+def submit(spool_dir, filename, environ, keep = False):
+    if not filename.endswith('.gcode'):
+        raise SpoolException("Not a GCode file: {filename}".format(filename = filename))
+    spool_dirs(spool_dir)
+
+    # Unique job name (the same model can be exported again before the previous job is done)
+    name = os.path.basename(filename)[:-len('.gcode')]
+    job = name
+    suffix = 0
+    while any(os.path.exists(path) for directory in (spool_dir, os.path.join(spool_dir, WORK_DIR)) for path in job_files(directory, job)):
+        suffix += 1
+        job = "{name}_{suffix}".format(name = name, suffix = suffix)
+
+    gcode_path, settings_path = job_files(spool_dir, job)
+    tmp_path = os.path.join(spool_dir, ".{job}.gcode.{pid}.tmp".format(job = job, pid = os.getpid()))
+    if keep:
+        shutil.copyfile(filename, tmp_path)
+    else:
+        shutil.move(filename, tmp_path)
+    os.replace(tmp_path, gcode_path)
+    write_json(settings_path, environ)
+
+    return job
+
+# Claim the submitted jobs (oldest first) - moves them to the work directory
+def claim_jobs(spool_dir, limit):
+    settings = []
+    with os.scandir(spool_dir) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith(SETTINGS_SUFFIX):
+                settings.append((entry.stat().st_mtime, entry.name[:-len(SETTINGS_SUFFIX)]))
+
+    jobs = []
+    work_dir = os.path.join(spool_dir, WORK_DIR)
+    for _, job in sorted(settings)[:limit]:
+        gcode_path, settings_path = job_files(spool_dir, job)
+        if not os.path.exists(gcode_path):
+            print("Warning : Spool: Job {job} has no GCode file, skipped".format(job = job))
+            continue
+        move_job(spool_dir, work_dir, job)
+        jobs.append(job)
+    return jobs
+
+# Move the jobs back to the spool (all the jobs left in the work directory if None)
+def recover_jobs(spool_dir, jobs = None):
+    work_dir = os.path.join(spool_dir, WORK_DIR)
+    if jobs is None:
+        jobs = [name[:-len(SETTINGS_SUFFIX)] for name in os.listdir(work_dir) if name.endswith(SETTINGS_SUFFIX)]
+    recovered = []
+    for job in jobs:
+        # Finished before the pool broke
+        if not os.path.exists(job_files(work_dir, job)[1]):
+            continue
+        remove_file(os.path.join(work_dir, job + STARTED_SUFFIX))
+        move_job(work_dir, spool_dir, job)
+        recovered.append(job)
+    return recovered
+
+# Move the job crashing the workers to failed
+def fail_crashed_job(spool_dir, job, crashes):
+    work_dir = os.path.join(spool_dir, WORK_DIR)
+    failed_dir = os.path.join(spool_dir, FAILED_DIR)
+    remove_file(os.path.join(work_dir, job + STARTED_SUFFIX))
+    remove_file(os.path.join(work_dir, job + CRASHES_SUFFIX))
+    move_job(work_dir, failed_dir, job)
+    log_path = os.path.join(work_dir, job + '.log')
+    if os.path.exists(log_path):
+        os.replace(log_path, os.path.join(failed_dir, job + '.log'))
+    write_json(os.path.join(failed_dir, job + '.report.json'), {
+        'job' : job, 'input' : job + '.gcode', 'status' : 'failed',
+        'error' : "Worker crashed {crashes} times".format(crashes = crashes) })
+
+# Worker initializer - Ctrl+C reaches the whole process group, the daemon stops the workers itself
+# (the jobs in flight are finished)
+def ignore_interrupts():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+# Worker - process the job
+# returns (job, output filename or None if failed, elapsed time)
+def process_job(spool_dir, job):
+    work_dir = os.path.join(spool_dir, WORK_DIR)
+    done_dir = os.path.join(spool_dir, DONE_DIR)
+    failed_dir = os.path.join(spool_dir, FAILED_DIR)
+    gcode_path, settings_path = job_files(work_dir, job)
+    log_path = os.path.join(work_dir, job + '.log')
+    started_path = os.path.join(work_dir, job + STARTED_SUFFIX)
+    with open(started_path, mode='w') as started_out:
+        started_out.write(str(os.getpid()))
+
+    t_start = time.time()
+    filename_out = None
+    error = None
+    with open(log_path, mode='w') as log, stage_profiler.StageProfiler(trace_memory = conf.PROFILE_MEMORY, cprofile = conf.PROFILE_CPROFILE) as profiler:
+        try:
+            with open(settings_path, mode='r') as settings_in:
+                config = conf.Config.from_dict(json.load(settings_in))
+            filename_out = tcpspp.process_file(gcode_path, profiler, output_dir = done_dir, config = config, cache = result_cache.default_cache(), log = log)
+        except Exception as err:
+            error = getattr(err, 'message', repr(err))
+            traceback.print_exc(file = log)
+    elapsed = time.time() - t_start
+
+    report = { 'job' : job, 'input' : os.path.basename(gcode_path), 'elapsed' : elapsed }
+    if error is None:
+        os.remove(gcode_path)
+        os.remove(settings_path)
+        target_dir = done_dir
+        report.update({'status' : 'done', 'output' : filename_out})
+    else:
+        os.replace(gcode_path, os.path.join(failed_dir, os.path.basename(gcode_path)))
+        os.replace(settings_path, os.path.join(failed_dir, os.path.basename(settings_path)))
+        target_dir = failed_dir
+        report.update({'status' : 'failed', 'error' : error})
+    report.update(profiler.report())
+
+    os.replace(log_path, os.path.join(target_dir, job + '.log'))
+    write_json(os.path.join(target_dir, job + '.report.json'), report)
+    remove_file(os.path.join(work_dir, job + CRASHES_SUFFIX))
+    os.remove(started_path)
+    return job, filename_out, elapsed
+
+class SpoolDaemon:
+
+    # Jobs queued per worker (the rest wait in the spool)
+    JOBS_PER_WORKER = 2
+
+    def __init__(self, spool_dir, workers = 1, poll_interval = 1.0):
+        self.spool_dir = spool_dir
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.stopped = threading.Event()
+        self.executor = None
+        self.pending = {}
+        # Jobs running when a worker crashed - re-run one at a time
+        self.suspects = []
+        self.jobs_done = 0
+        self.jobs_failed = 0
+
+    def stop(self, *args):
+        self.stopped.set()
+
+    def start_workers(self):
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers = self.workers, initializer = ignore_interrupts)
+
+    # Collect the finished jobs
+    def collect(self, futures):
+        for future in futures:
+            job = self.pending[future]
+            try:
+                job, filename_out, elapsed = future.result()
+            except concurrent.futures.process.BrokenProcessPool:
+                raise
+            except Exception as err:
+                del self.pending[future]
+                self.jobs_failed += 1
+                print("[Error] Job {job}: {error}".format(job = job, error = getattr(err, 'message', repr(err))))
+                continue
+            del self.pending[future]
+            if filename_out is not None:
+                self.jobs_done += 1
+                print("[Ok] Job {job} -> {output} [elapsed: {elapsed:0.2f}s]".format(job = job, output = filename_out, elapsed = elapsed))
+            else:
+                self.jobs_failed += 1
+                print("[Error] Job {job} failed, see {log}".format(job = job, log = os.path.join(self.spool_dir, FAILED_DIR, job + '.log')))
+
+    # Worker died - restart the pool
+    # The jobs not started go back to the spool. A crash with a single job running is the job's own, the jobs
+    # running together are suspects and get re-run one at a time.
+    def workers_broken(self):
+        print("Warning : Spool: Worker pool broken, restarting the workers")
+        self.executor.shutdown(cancel_futures = True)
+        jobs = list(self.pending.values())
+        self.pending = {}
+
+        work_dir = os.path.join(self.spool_dir, WORK_DIR)
+        started = [job for job in jobs if os.path.exists(os.path.join(work_dir, job + STARTED_SUFFIX))]
+        recover_jobs(self.spool_dir, [job for job in jobs if job not in started])
+        if len(started) == 1:
+            job = started[0]
+            crashes = job_crashes(work_dir, job) + 1
+            if crashes >= MAX_CRASHES:
+                fail_crashed_job(self.spool_dir, job, crashes)
+                self.jobs_failed += 1
+                print("[Error] Job {job} crashed the worker {crashes} times, moved to {failed}".format(job = job, crashes = crashes, failed = os.path.join(self.spool_dir, FAILED_DIR)))
+            else:
+                with gcode_writer.GCodeWriter(os.path.join(work_dir, job + CRASHES_SUFFIX)) as crashes_out:
+                    crashes_out.write(str(crashes).encode('utf8'))
+                self.suspects.insert(0, job)
+        else:
+            self.suspects.extend(started)
+        self.start_workers()
+
+    def run(self):
+        spool_dirs(self.spool_dir)
+        recovered = recover_jobs(self.spool_dir)
+        if recovered:
+            print("TC-PSPP daemon: Resubmitted {jobs} interrupted job(s)".format(jobs = len(recovered)))
+
+        print("TC-PSPP daemon: Watching {spool_dir} with {workers} worker(s)".format(spool_dir = self.spool_dir, workers = self.workers))
+        self.start_workers()
+        try:
+            while not self.stopped.is_set():
+                capacity = self.workers * SpoolDaemon.JOBS_PER_WORKER - len(self.pending)
+                if self.suspects:
+                    # Suspects run alone (claimed already)
+                    if not self.pending:
+                        job = self.suspects.pop(0)
+                        remove_file(os.path.join(self.spool_dir, WORK_DIR, job + STARTED_SUFFIX))
+                        self.pending[self.executor.submit(process_job, self.spool_dir, job)] = job
+                elif capacity > 0:
+                    for job in claim_jobs(self.spool_dir, capacity):
+                        if conf.DEBUG:
+                            print("(DEBUG) Spool: Claimed job {job}".format(job = job))
+                        self.pending[self.executor.submit(process_job, self.spool_dir, job)] = job
+
+                if not self.pending:
+                    self.stopped.wait(self.poll_interval)
+                    continue
+
+                done, _ = concurrent.futures.wait(self.pending, timeout = self.poll_interval, return_when = concurrent.futures.FIRST_COMPLETED)
+                try:
+                    self.collect(done)
+                except concurrent.futures.process.BrokenProcessPool:
+                    self.workers_broken()
+        finally:
+            # Finish the jobs in flight
+            self.executor.shutdown(wait = True)
+            for future in list(self.pending):
+                try:
+                    self.collect([future])
+                except concurrent.futures.process.BrokenProcessPool:
+                    pass
+            # Worker died on the way out - the unfinished jobs stay in the work directory, resubmitted on the next start
+            work_dir = os.path.join(self.spool_dir, WORK_DIR)
+            left = [job for job in self.pending.values() if os.path.exists(job_files(work_dir, job)[1])]
+            if left:
+                print("Warning : Spool: Worker pool broken, {jobs} job(s) left in {work_dir}".format(jobs = len(left), work_dir = work_dir))
+
+        print("TC-PSPP daemon: Stopped [done: {done}, failed: {failed}]".format(done = self.jobs_done, failed = self.jobs_failed))
+
+def main():
+    parser = argparse.ArgumentParser(description = "TC-PSPP spool daemon")
+    parser.add_argument('spool_dir')
+    parser.add_argument('--workers', type = int, default = os.cpu_count() or 1)
+    parser.add_argument('--poll', type = float, default = 1.0, help = "spool poll interval in seconds")
+    args = parser.parse_args()
+
+    daemon = SpoolDaemon(args.spool_dir, workers = args.workers, poll_interval = args.poll)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    daemon.run()
+
+if __name__ == "__main__":
+    main()
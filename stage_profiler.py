@@ -0,0 +1,112 @@
+# Stage profiler
+# Records the processing stages of tcpspp into a machine readable report
+# - wall/CPU time, net change of the live memory blocks (blocks allocated minus freed by the stage - not an allocation count)
+# - tokens in the token list at the stage start, tokens inserted/removed by the stage
+# - optional peak traced memory (tracemalloc - slows down the run, stopped when the profiled run ends - close)
+# - optional cProfile capture (top functions by the cumulative time)
+import gcode_writer
+
+import contextlib, cProfile, json, pstats, sys, time, tracemalloc
+
+# resource is POSIX only
+try:
+    import resource
+except ImportError:
+    resource = None
+
+class StageProfiler:
+
+    # Functions kept from the cProfile capture
+    TOP_FUNCTIONS = 25
+
+    def __init__(self, trace_memory = False, cprofile = False):
+        self.trace_memory = trace_memory
+        self.cprofile = cprofile
+        self.stages = []
+        self.t_start = time.time()
+        # Memory tracing started by the profiler
+        self.tracing = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    # End of the profiled run - stop the memory tracing started by the profiler
+    def close(self):
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+
+    # Profile the stage - yields the stage record (extra values can be added)
+    # - gcode - analyzer the stage works on (None if it doesn't exist yet)
+    @contextlib.contextmanager
+    def stage(self, name, gcode = None):
+        record = {'name' : name}
+        self.stages.append(record)
+
+        if gcode is not None:
+            record['tokens'] = len(gcode.tokens)
+            inserted_pre, removed_pre = gcode.tokens_inserted, gcode.tokens_removed
+        blocks_pre = sys.getallocatedblocks()
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.tracing = True
+            tracemalloc.reset_peak()
+            traced_pre = tracemalloc.get_traced_memory()[0]
+        profile = cProfile.Profile() if self.cprofile else None
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield record
+        finally:
+            if profile is not None:
+                profile.disable()
+            record['wall_time'] = time.perf_counter() - wall_start
+            record['cpu_time'] = time.process_time() - cpu_start
+            record['net_live_blocks'] = sys.getallocatedblocks() - blocks_pre
+            if gcode is not None:
+                record['tokens_inserted'] = gcode.tokens_inserted - inserted_pre
+                record['tokens_removed'] = gcode.tokens_removed - removed_pre
+            if self.trace_memory:
+                traced, traced_peak = tracemalloc.get_traced_memory()
+                record['traced_memory'] = traced - traced_pre
+                record['traced_memory_peak'] = traced_peak - traced_pre
+            if profile is not None:
+                record['profile'] = StageProfiler.top_functions(profile)
+
+    # Top functions of the capture by the cumulative time
+    @staticmethod
+    def top_functions(profile):
+        stats = pstats.Stats(profile).stats
+        functions = sorted(stats.items(), key = lambda item: item[1][3], reverse = True)[:StageProfiler.TOP_FUNCTIONS]
+        return [{
+            'function' : "{file}:{line}({name})".format(file = file, line = line, name = name),
+            'calls' : calls,
+            'primitive_calls' : primitive_calls,
+            'tottime' : tottime,
+            'cumtime' : cumtime } for (file, line, name), (primitive_calls, calls, tottime, cumtime, callers) in functions]
+
+    def report(self):
+        report = {
+            'started' : self.t_start,
+            'stages' : self.stages,
+            'wall_time' : sum([stage['wall_time'] for stage in self.stages if 'wall_time' in stage]),
+            'cpu_time' : sum([stage['cpu_time'] for stage in self.stages if 'cpu_time' in stage]) }
+        if resource is not None:
+            # ru_maxrss is in kB on Linux, bytes on macOS
+            report['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return report
+
+    # Write the JSON report (replaced atomically)
+    def write_report(self, filename, **info):
+        report = dict(info)
+        report.update(self.report())
+        with gcode_writer.GCodeWriter(filename) as report_out:
+            report_out.write(json.dumps(report, indent = 2).encode('utf8'))
@@ -2,80 +2,265 @@
 # Written by Marcin Kudzia 
 # https://github.com/mkudzia84
 
-import sys, os, time, math, traceback
+import gc, io, sys, os, time, math, traceback
 from collections import deque 
 
 import conf
 import gcode_analyzer
+import gcode_writer
+import layer_fingerprint
+import stage_profiler
 import tool_change_plan
 import prime_tower
 import thermal_control
 import pcf_control
+import result_cache
    
 # Build tool_filament name
-def tool_filament_names(layer_info):
-    return '_'.join(["T{tool_id}-{filament}".format(tool_id = tool, filament = conf.filament_type[tool]) for tool in (layer_info.tools_active | layer_info.tools_idle)])
+def tool_filament_names(layer_info, config):
+    return '_'.join(["T{tool_id}-{filament}".format(tool_id = tool, filament = config.filament_type[tool]) for tool in (layer_info.tools_active | layer_info.tools_idle)])
 
-def main():
-    if len(sys.argv) < 2:
-        print("Usage: tcpspp.py [filename.gcode]")
-        return
-        
-    t_start = time.time()
+# Output file name - input name with the tools/filaments and the runtime estimate
+def output_filename(filename, tool_filaments, runtime_str):
+    return filename[0:filename.rfind('.gcode')] + '_' + tool_filaments + '_' + runtime_str + '.gcode'
 
-    filename = sys.argv[1]
+# Output file path for the input file (next to it if the output directory is not set)
+def output_path(filename, output_dir, tool_filaments, runtime_str):
+    filename_out = output_filename(filename, tool_filaments, runtime_str)
+    if output_dir is not None:
+        filename_out = os.path.join(output_dir, os.path.basename(filename_out))
+    return filename_out
 
-    print("-----------------------------------------")
-    print(" TC-PSPP : Parsing the file              ")
-    gcode = gcode_analyzer.GCodeAnalyzer(filename)
+# Lines of the binary stream (the tokenizer takes text lines)
+def decode_lines(stream):
+    for line in stream:
+        yield line.decode('utf8')
 
-    print("Validating the GCode...")
-    validator = gcode_analyzer.GCodeValidator()
-    validator.analyze_and_fix(gcode)
+# Run the pipeline on the GCode with the job config - parse, analysis, injection and validation
+# - gcode_in - path, or iterable of text lines (the sparse mode needs the path)
+# - log - text stream the reports are printed to (stdout if None)
+# - validate - validate the retract sequence (None result if not - validated while writing, see process_file)
+# returns the analyzer with the GCode injected, the prime tower and the retract validation result
+def run_pipeline(gcode_in, profiler, config, log = None, validate = True):
+    is_path = isinstance(gcode_in, (str, bytes, os.PathLike))
 
-    print("-----------------------------------------")
-    print(" TC-PSPP : Generating Prime Tower layout ")
-    
+    print("-----------------------------------------", file = log)
+    print(" TC-PSPP : Parsing the file              ", file = log)
+    with profiler.stage('parse') as stage:
+        gcode = gcode_analyzer.GCodeAnalyzer(gcode_in, workers = conf.ANALYSIS_WORKERS, sparse = conf.SPARSE_TOKENS and is_path, config = config, log = log)
+        stage['tokens'] = len(gcode.tokens)
+
+    # Analysis stages - validator, prime tower, thermal and PCF control run in a single traversal
+    print("Validating and analyzing the GCode...", file = log)
+    validator = gcode_analyzer.GCodeValidator()
     tower = prime_tower.PrimeTower()
-    tower.analyze_gcode(gcode)
+    temp_controller = thermal_control.TemperatureController()
+    pcf_controller = pcf_control.PartCoolingFanController()
+    with profiler.stage('analysis', gcode) as stage:
+        pipeline = gcode_analyzer.Pipeline([validator, tower, temp_controller, pcf_controller])
+        pipeline.run(gcode)
+        stage['tokens_visited'] = pipeline.visited
+
+    print("-----------------------------------------", file = log)
+    print(" TC-PSPP : Generating Prime Tower layout ", file = log)
     tower.print_report()
 
-    print(" - Optimizing prime tower layout")
-    tower.optimize_layers()
+    print(" - Optimizing prime tower layout", file = log)
+    with profiler.stage('prime_tower.optimize_layers', gcode):
+        tower.optimize_layers()
     tower.print_report()
     
-    print(" - Injecting Prime Tower GCode")
-    tower.inject_gcode()
-
-    print(" TC-PSPS : Optimizing toolhead thermals")
-    temp_controller = thermal_control.TemperatureController()
-    temp_controller.analyze_gcode(gcode)
+    print(" - Injecting Prime Tower GCode", file = log)
+    with profiler.stage('prime_tower.inject_gcode', gcode):
+        tower.inject_gcode()
 
-    print(" - Injecting Thermal Mangment GCode")
-    temp_controller.inject_gcode()
+    print(" TC-PSPS : Optimizing toolhead thermals", file = log)
+    print(" - Injecting Thermal Mangment GCode", file = log)
+    with profiler.stage('thermal.inject_gcode', gcode):
+        temp_controller.inject_gcode()
 
-    print(" - Injecting PCF control GCode")
-    pcf_controller = pcf_control.PartCoolingFanController()
-    pcf_controller.analyze_gcode(gcode)
-    pcf_controller.inject_gcode()
+    print(" - Injecting PCF control GCode", file = log)
+    with profiler.stage('pcf.inject_gcode', gcode):
+        pcf_controller.inject_gcode()
 
     gcode.print_total_runtime()
 
-    # Run validation
-    print("Validating...")
-    if validator.analyze_retracts(gcode):
-        print("[Ok] Retract/unretract sequence")
+    retracts_ok = validate_retracts(gcode, validator, profiler, log) if validate else None
+    return gcode, tower, retracts_ok
+
+# Validate the retract sequence
+# - layers, layer_results - fingerprinted layers of the output and the results of the previous run
+#   (see GCodeValidator.analyze_retracts)
+def validate_retracts(gcode, validator, profiler, log, layers = None, layer_results = None):
+    print("Validating...", file = log)
+    with profiler.stage('validate_retracts', gcode) as stage:
+        retracts_ok = validator.analyze_retracts(gcode, layers, layer_results)
+        if layer_results is not None:
+            stage['layers'] = len(layer_results.results)
+            stage['layers_reused'] = layer_results.reused
+    print_retracts(retracts_ok, log)
+    return retracts_ok
+
+def print_retracts(retracts_ok, log):
+    if retracts_ok:
+        print("[Ok] Retract/unretract sequence", file = log)
     else:
-        print("[Error] Retract/unretract sequence")
+        print("[Error] Retract/unretract sequence", file = log)
+
+# Write the processed GCode into the binary stream
+# - gcode_in - the parsed path or stream (sparse mode streams the output from the path)
+# - fingerprint - fingerprint the layers while writing (not in the sparse mode)
+# returns the fingerprinted layers (layer_fingerprint.write_layers) if fingerprinted
+def write_output(gcode, gcode_in, gcode_out, profiler, fingerprint = False):
+    layers = None
+    with profiler.stage('write', gcode):
+        if gcode.sparse:
+            # Second pass - stream the input with the injected GCode merged in
+            plan = gcode.injection_plan()
+            gcode.close()
+            gcode_writer.write_plan(gcode_in, plan, gcode_out, newline = gcode.newline)
+        elif fingerprint:
+            layers = layer_fingerprint.write_layers(gcode, gcode_out)
+        else:
+            gcode.write(gcode_out)
+    gcode.close()
+    return layers
+
+# Process the GCode file
+# - output_dir - directory to write the output to (next to the input if not set)
+# - config - job config, the config of the process (loaded from the environment) if not set
+# - cache - result cache to reuse/store the output with (not cached if None)
+# - log - text stream the reports are printed to (stdout if None)
+# returns the output filename
+def process_file(filename, profiler, output_dir = None, config = None, cache = None, log = None):
+    if config is None:
+        config = conf.current()
+
+    if cache is not None:
+        with profiler.stage('cache.lookup') as stage:
+            key = cache.key(filename, config)
+            entry = cache.get(key)
+            stage['hit'] = entry is not None
+            if entry is not None:
+                stage['cached_wall_time'] = entry['report']['wall_time']
+        if entry is not None:
+            filename_out = output_path(filename, output_dir, entry['tool_filament_names'], entry['total_runtime_str'])
+            with profiler.stage('cache.restore'):
+                restored = cache.restore(key, filename_out)
+            if restored:
+                print("-----------------------------------------", file = log)
+                print(" TC-PSPP : Cached result                 ", file = log)
+                # Validated when stored (not recorded by the older entries)
+                if entry.get('retracts_ok') is not None:
+                    print_retracts(entry['retracts_ok'], log)
+                print(" Writing to {filename}".format(filename = filename_out), file = log)
+                return filename_out
+
+    # Layers unchanged since the previous run of the file are not validated again
+    # - fingerprinted while writing, validated after the output is written
+    incremental = cache is not None and not conf.SPARSE_TOKENS
+
+    gcode, tower, retracts_ok = run_pipeline(filename, profiler, config, log, validate = not incremental)
+
+    print("-----------------------------------------", file = log)
+    print(" TC-PSPP : Writing modified file...      ", file = log)
+    tool_filaments = tool_filament_names(tower.layers[0], config)
+    filename_out = output_path(filename, output_dir, tool_filaments, gcode.total_runtime_str)
+    print(" Writing to {filename}".format(filename = filename_out), file = log)
+
+    with gcode_writer.GCodeWriter(filename_out) as gcode_out:
+        layers = write_output(gcode, filename, gcode_out, profiler, fingerprint = incremental)
+
+    layer_results = None
+    if incremental:
+        layer_results = layer_fingerprint.LayerResults.load(cache.layer_results_file(filename))
+        retracts_ok = validate_retracts(gcode, gcode_analyzer.GCodeValidator(), profiler, log, layers, layer_results)
+
+    if cache is not None:
+        with profiler.stage('cache.store'):
+            if layer_results is not None:
+                cache.put_layer_results(filename, layer_results)
+            cache.put(key, filename_out, {
+                'tool_filament_names' : tool_filaments,
+                'total_runtime' : gcode.total_runtime,
+                'total_runtime_str' : gcode.total_runtime_str,
+                'retracts_ok' : retracts_ok,
+                'report' : profiler.report() })
+
+    return filename_out
+
+# Result of the in-process run
+class ProcessResult:
+    def __init__(self, gcode, tower, retracts_ok, profiler, log):
+        layer_info = tower.layers[0]
+        self.total_runtime = gcode.total_runtime                    # Runtime estimate [s]
+        self.total_runtime_str = gcode.total_runtime_str
+        self.tools = list(layer_info.tools_active | layer_info.tools_idle)
+        self.filaments = {tool : gcode.config.filament_type[tool] for tool in self.tools}
+        self.tool_filament_names = tool_filament_names(layer_info, gcode.config)  # T{tool}-{filament} summary (as in the output file name)
+        self.retracts_ok = retracts_ok
+        self.tokens = len(gcode.tokens)
+        self.stages = profiler.report()['stages']                   # Stage timings (see stage_profiler)
+        self.log = log                                              # Reports printed by the stages
+
+    # Output file name for the input file name (as written by tcpspp)
+    def output_filename(self, filename):
+        return output_filename(filename, self.tool_filament_names, self.total_runtime_str)
+
+# Process the GCode in-process (library entry point)
+# - gcode_in - path, or text/binary stream of the GCode
+# - gcode_out - binary stream to write the output to
+# - config - job config (conf.Config) or a dict to build it from (conf.Config.from_dict - SLIC3R_* settings
+#   and/or the settings by name), the config of the process (loaded from the environment) if not set
+# Nothing is printed (the reports are kept in the result log), no files are created or removed
+# returns ProcessResult
+def process(gcode_in, gcode_out, config = None, trace_memory = False, cprofile = False):
+    if config is None:
+        config = conf.current()
+    elif not isinstance(config, conf.Config):
+        config = conf.Config.from_dict(config)
+
+    lines = gcode_in
+    if isinstance(gcode_in, (io.RawIOBase, io.BufferedIOBase)):
+        lines = decode_lines(gcode_in)
+
+    log = io.StringIO()
+    with stage_profiler.StageProfiler(trace_memory = trace_memory, cprofile = cprofile) as profiler:
+        gcode, tower, retracts_ok = run_pipeline(lines, profiler, config, log = log)
+        write_output(gcode, gcode_in, gcode_out, profiler)
+
+    return ProcessResult(gcode, tower, retracts_ok, profiler, log.getvalue())
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: tcpspp.py [--spool spool_dir] [filename.gcode]")
+        return
+
+    # Hand the file over to the spool daemon (returns right away)
+    if sys.argv[1] == '--spool':
+        if len(sys.argv) < 4:
+            print("Usage: tcpspp.py [--spool spool_dir] [filename.gcode]")
+            return
+        import spool_daemon
+        job = spool_daemon.submit(sys.argv[2], sys.argv[3], conf.slic3r_environ(), keep = conf.DEBUG)
+        print("TC-PSPP: Spooled {filename} as {job}".format(filename = sys.argv[3], job = job))
+        return
+
+    t_start = time.time()
+
+    # Single file run owning the process - hold the cycle collector, the token list is built from new
+    # objects only and the collector would rescan it over and over (the process exits after the run)
+    gc.disable()
+
+    filename = sys.argv[1]
+    config = conf.current()
 
-    print("-----------------------------------------")
-    print(" TC-PSPP : Writing modified file...      ")
-    filename_out = filename[0:filename.rfind('.gcode')] + '_' + tool_filament_names(tower.layers[0]) + '_' + gcode.total_runtime_str + '.gcode'
-    print(" Writing to {filename}".format(filename = filename_out))
+    # Stage profile (written next to the output with conf.PROFILE)
+    with stage_profiler.StageProfiler(trace_memory = conf.PROFILE_MEMORY, cprofile = conf.PROFILE_CPROFILE) as profiler:
+        filename_out = process_file(filename, profiler, config = config, cache = result_cache.default_cache())
 
-    with open(filename_out, mode='w', encoding='utf8') as gcode_out:
-        for token in gcode.tokens:
-            gcode_out.write(str(token) + '\n')
+    if conf.PROFILE:
+        profiler.write_report(filename_out + '.profile.json', input = filename, output = filename_out)
 
     if conf.DEBUG == False:
         print(" Removing old file {filename}".format(filename = filename))
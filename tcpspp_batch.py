@@ -0,0 +1,149 @@
+# TC-PSPP batch processing
+# Post-processes many GCode files concurrently (e.g. re-processing a backlog after changing the printer settings)
+# with the Slic3r settings taken from the environment or a JSON/TOML profile (conf.Config.from_file)
+# - failures are isolated per file, the input files are kept
+# - a worker crash breaks the pool - the files not started are resubmitted on a new pool, the crash fails the file
+#   if it was the only one running (the files running together are re-run one at a time)
+#
+# Usage: tcpspp_batch.py [--workers N] [--output-dir DIR] [--config profile.json] files/globs...
+import conf
+import result_cache
+import stage_profiler
+import tcpspp
+
+import argparse, concurrent.futures, glob, io, os, sys, tempfile, time, traceback
+
+# Files matching the arguments (globs expanded - not done by the Windows shell), in the argument order
+def expand_files(patterns):
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        for filename in matches:
+            if filename not in files:
+                files.append(filename)
+    return files
+
+# Worker - process the file
+# - started_path - marker written while the file is processed
+# returns the file result (error set if failed)
+def process_file(filename, output_dir, config, started_path = None):
+    if started_path is not None:
+        with open(started_path, mode='w') as started_out:
+            started_out.write(str(os.getpid()))
+    result = { 'input' : filename, 'size' : 0, 'output' : None, 'error' : None }
+    profiler = stage_profiler.StageProfiler()
+    t_start = time.perf_counter()
+    # Controllers report on stdout - kept for the failed files only
+    log = io.StringIO()
+    try:
+        result['size'] = os.path.getsize(filename)
+        result['output'] = tcpspp.process_file(filename, profiler, output_dir = output_dir, config = config, cache = result_cache.default_cache(), log = log)
+    except Exception as err:
+        result['error'] = getattr(err, 'message', repr(err))
+        result['log'] = log.getvalue() + traceback.format_exc()
+    result['elapsed'] = time.perf_counter() - t_start
+    result['cpu_time'] = profiler.report()['cpu_time']
+    if started_path is not None:
+        os.remove(started_path)
+    return result
+
+def print_result(result):
+    if result['error'] is None:
+        print("[Ok] {input} -> {output} [elapsed: {elapsed:0.2f}s]".format(**result))
+    else:
+        print("[Error] {input}: {error}".format(**result))
+        if conf.DEBUG and 'log' in result:
+            print(result['log'])
+
+# Process the files on the worker pools
+# returns the file results (in the completion order)
+def process_files(files, workers, output_dir, config):
+    results = []
+    pending = list(files)
+    # Files running when a worker crashed - re-run one at a time
+    suspects = []
+    with tempfile.TemporaryDirectory() as marker_dir:
+        started_paths = {filename : os.path.join(marker_dir, "{index}.started".format(index = index)) for index, filename in enumerate(files)}
+        while pending or suspects:
+            if suspects:
+                batch = [suspects.pop(0)]
+            else:
+                batch = pending
+                pending = []
+            with concurrent.futures.ProcessPoolExecutor(max_workers = min(workers, len(batch))) as executor:
+                futures = {executor.submit(process_file, filename, output_dir, config, started_paths[filename]) : filename for filename in batch}
+                finished = set()
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        result = future.result()
+                    except concurrent.futures.process.BrokenProcessPool as err:
+                        # Worker died - the crash is the file's own if it was the only one running
+                        for other, filename in futures.items():
+                            if filename not in finished and other.done() and not other.cancelled() and other.exception() is None:
+                                finished.add(filename)
+                                results.append(other.result())
+                                print_result(other.result())
+                        unfinished = [filename for filename in batch if filename not in finished]
+                        started = [filename for filename in unfinished if os.path.exists(started_paths[filename])]
+                        for filename in started:
+                            os.remove(started_paths[filename])
+                        if len(started) == 1:
+                            result = { 'input' : started[0], 'size' : 0, 'output' : None, 'error' : "Worker crashed: " + repr(err), 'elapsed' : 0.0, 'cpu_time' : 0.0 }
+                            results.append(result)
+                            print_result(result)
+                        else:
+                            suspects.extend(started)
+                        pending = [filename for filename in unfinished if filename not in started] + pending
+                        break
+                    except Exception as err:
+                        result = { 'input' : futures[future], 'size' : 0, 'output' : None, 'error' : repr(err), 'elapsed' : 0.0, 'cpu_time' : 0.0 }
+                    finished.add(futures[future])
+                    results.append(result)
+                    print_result(result)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description = "TC-PSPP batch processing")
+    parser.add_argument('files', nargs = '+', help = "GCode files or globs")
+    parser.add_argument('--workers', type = int, default = os.cpu_count() or 1)
+    parser.add_argument('--output-dir', help = "directory to write the outputs to (next to the inputs if not set)")
+    parser.add_argument('--config', help = "JSON/TOML profile (the Slic3r settings from the environment if not set)")
+    args = parser.parse_args()
+
+    config = conf.Config.from_file(args.config) if args.config is not None else conf.current()
+
+    files = expand_files(args.files)
+    if not files:
+        print("TC-PSPP: No files to process")
+        return 1
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok = True)
+
+    workers = max(1, min(args.workers, len(files)))
+    print("TC-PSPP: Processing {files} file(s) with {workers} worker(s)".format(files = len(files), workers = workers))
+
+    t_start = time.perf_counter()
+    results = process_files(files, workers, args.output_dir, config)
+    elapsed = time.perf_counter() - t_start
+
+    processed = [result for result in results if result['error'] is None]
+    failed = [result for result in results if result['error'] is not None]
+    size = sum(result['size'] for result in processed)
+    print("-----------------------------------------")
+    print(" TC-PSPP : Batch summary                 ")
+    print(" Files: {ok} processed, {failed} failed".format(ok = len(processed), failed = len(failed)))
+    for result in failed:
+        print("  [Error] {input}: {error}".format(**result))
+    print(" Elapsed: {elapsed:0.2f}s (processing {cpu:0.2f}s CPU)".format(elapsed = elapsed, cpu = sum(result['cpu_time'] for result in results)))
+    if elapsed > 0:
+        print(" Throughput: {files:0.2f} files/s, {mb:0.2f} MB/s".format(files = len(processed) / elapsed, mb = size / (1 << 20) / elapsed))
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main())
+    except conf.ConfException as conf_err:
+        print("Configuration Error:")
+        print(conf_err.message)
+        sys.exit(2)
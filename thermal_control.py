@@ -5,7 +5,7 @@ import doublelinkedlist
 
 import time
 
-from gcode_analyzer import Token, GCodeAnalyzer
+from gcode_analyzer import Token, GCodeAnalyzer, Stage, Pipeline
 from tool_change_plan import ToolChangeInfo
 from conf import ConfException
 
@@ -62,71 +62,90 @@ class ThermalControlException(Exception):
 #      - else insert idle temp at TC_TEMP_INITALIZE
 
 # Contains information about sequence of tool changes 
-class TemperatureController:
+class TemperatureController(Stage):
+
+    name = 'thermal'
+    requires = ('validator',)
 
     def __init__(self):
         self.tool_activation_seq = {}
         self.temp_header = None
         self.temp_footer = None
+        self.gcode_analyzer = None
+        self.config = None
+        self.log = None
+        self.runtime_index = None
 
     # Analyze the layer information and generate 
     # the tool change sequence (layer independant)
     def analyze_gcode(self, gcode_analyzer):
-        t_start = time.time()
+        Pipeline([self]).run(gcode_analyzer)
+
+    # Stage - visit only the tokens needed
+    def handlers(self):
+        return {
+            ('label', 'TC_TEMP_INITIALIZE') : self.on_temp_initialize,
+            ('label', 'TC_TEMP_SHUTDOWN') : self.on_temp_shutdown,
+            ('gcode', 'M109') : self.on_temp_wait,
+            ('type', Token.TOOLCHANGE) : self.on_tool_change,
+            ('label', 'TOOL_BLOCK_START') : self.on_tool_block_start,
+            ('label', 'TOOL_BLOCK_END') : self.on_tool_block_end }
+
+    def begin(self, gcode_analyzer):
+        self.t_start = time.time()
+        self.gcode_analyzer = gcode_analyzer
+        self.config = gcode_analyzer.config
+        self.log = gcode_analyzer.log
 
         # Generates the list of tool_activations per tool
         if conf.DEBUG:
-            print("(DEBUG) TempController: Generating tool activation sequence per tool...")
+            print("(DEBUG) TempController: Generating tool activation sequence per tool...", file = self.log)
 
         # Go over the tokens to generate the Tool Change Info 
         # Calculate the runtimes in the process
-        print("TempController - Estimating the gcode runtimes")
+        print("TempController - Estimating the gcode runtimes", file = self.log)
 
         # Current tool head
-        current_tool = None
-
-        # Go over all of the tokens
-        for token in gcode_analyzer.analyze_state():
-            # Find the location of ;; TC_TEMP_INITIALIZE
-            if token.type == Token.PARAMS and token.label == 'TC_TEMP_INITIALIZE':
-                self.temp_header = token
-
-            # Find the location of ;; TC_TEMP_SHUTDOWN
-            if token.type == Token.PARAMS and token.label == 'TC_TEMP_SHUTDOWN':
-                self.temp_footer = token
-
-            # Remove the existing tokens for temp managment
-            if token.type == Token.GCODE and token.gcode == 'M109':
-                print("TempController: Removed an existing M109 gcode")
-                gcode_analyzer.tokens.remove_node(token)
-
-            # Setup the tool changes
-            if token.type == Token.TOOLCHANGE:
-                if token.state_post.tool_selected != None:
-                    current_tool = ToolChangeInfo(tool_change = token)
-                    if current_tool.tool_id not in self.tool_activation_seq:
-                        self.tool_activation_seq[current_tool.tool_id] = []
-                    self.tool_activation_seq[current_tool.tool_id].append(current_tool)
-                continue
-
-            # Beginning to Tool block
-            if token.type == Token.PARAMS and token.label == 'TOOL_BLOCK_START':
-                tool_id = token.param[0]
-                if tool_id != -1:
-                    if tool_id != current_tool.tool_id:
-                        raise ToolChangeException("Tool id {tool_id} from TOOL_BLOCK_START doesn't match last active tool in layer".format(tool_id = tool_id))
-                    current_tool.block_start = token
-                continue
-
-            # End of Tool block
-            if token.type == Token.PARAMS and token.label == 'TOOL_BLOCK_END':
-                tool_id = token.param[0]
-                if tool_id != -1:
-                    if tool_id != current_tool.tool_id:
-                        raise ToolChangeException("Tool id {tool_id} from TOOL_BLOCK_END doesn't match last active tool in layer".format(tool_id = tool_id))
-                    current_tool.block_end = token
-                continue
-
+        self.current_tool = None
+
+    # Find the location of ;; TC_TEMP_INITIALIZE
+    def on_temp_initialize(self, token):
+        self.temp_header = token
+
+    # Find the location of ;; TC_TEMP_SHUTDOWN
+    def on_temp_shutdown(self, token):
+        self.temp_footer = token
+
+    # Remove the existing tokens for temp managment
+    def on_temp_wait(self, token):
+        print("TempController: Removed an existing M109 gcode", file = self.log)
+        self.gcode_analyzer.tokens.remove_node(token)
+
+    # Setup the tool changes
+    def on_tool_change(self, token):
+        if token.state_post.tool_selected != None:
+            self.current_tool = ToolChangeInfo(tool_change = token)
+            if self.current_tool.tool_id not in self.tool_activation_seq:
+                self.tool_activation_seq[self.current_tool.tool_id] = []
+            self.tool_activation_seq[self.current_tool.tool_id].append(self.current_tool)
+
+    # Beginning to Tool block
+    def on_tool_block_start(self, token):
+        tool_id = token.param[0]
+        if tool_id != -1:
+            if tool_id != self.current_tool.tool_id:
+                raise ToolChangeException("Tool id {tool_id} from TOOL_BLOCK_START doesn't match last active tool in layer".format(tool_id = tool_id))
+            self.current_tool.block_start = token
+
+    # End of Tool block
+    def on_tool_block_end(self, token):
+        tool_id = token.param[0]
+        if tool_id != -1:
+            if tool_id != self.current_tool.tool_id:
+                raise ToolChangeException("Tool id {tool_id} from TOOL_BLOCK_END doesn't match last active tool in layer".format(tool_id = tool_id))
+            self.current_tool.block_end = token
+
+    def end(self, gcode_analyzer):
         if self.temp_header is None:
             raise ConfException("TempController: Did not found TC_TEMP_INITIALIZE parameter in the GCode, slicer has not been configured correctly...")
         if self.temp_footer is None:
@@ -134,7 +153,7 @@ class TemperatureController:
 
         t_end = time.time()
         if conf.PERF_INFO:
-            print("TempController: analysis done [elapsed: {elapsed:0.2f}s]".format(elapsed = t_end - t_start))
+            print("TempController: analysis done [elapsed: {elapsed:0.2f}s]".format(elapsed = t_end - self.t_start), file = self.log)
 
     # Prep tool layer intialization
     def gcode_prep_header(self):
@@ -146,44 +165,34 @@ class TemperatureController:
         for tool_id, activation_seq in self.tool_activation_seq.items():
             tool_info = activation_seq[0]
 
-            time_delta = 0.0
-            token = self.temp_header.next
-            while token != tool_info.tool_change:
-                time_delta += token.runtime
-                token = token.next
+            time_delta = self.runtime_index.elapsed(self.temp_header, tool_info.tool_change)
 
             if conf.DEBUG:
-                print("(DEBUG) TempController: INIT -> T{tool} - runtime estimate: {delta:0.2f}".format(tool = tool_id, delta = time_delta))
+                print("(DEBUG) TempController: INIT -> T{tool} - runtime estimate: {delta:0.2f}".format(tool = tool_id, delta = time_delta), file = self.log)
 
-            tool_temp = conf.tool_temperature(tool_info.tool_change.state_pre.layer_num, tool_id)
+            tool_temp = self.config.tool_temperature(tool_info.tool_change.state_pre.layer_num, tool_id)
             # Check if should set idle temp or tool temp at INIT point
             # temp_idle = tool_temp - temp_idle_delta
-            time_temp_idle2tool = float(conf.temp_idle_delta) / float(conf.temp_heating_rate)
+            time_temp_idle2tool = float(self.config.temp_idle_delta) / float(self.config.temp_heating_rate)
 
             if time_temp_idle2tool < time_delta:
                 # Find the inject point 
-                acc_time = 0.0
-                inject_point = tool_info.tool_change.prev
-                while inject_point is not None:
-                    acc_time += inject_point.runtime
-                    if acc_time >= time_temp_idle2tool:
-                        break
-                    inject_point = inject_point.prev
+                inject_point = self.gcode_analyzer.inject_point_before(tool_info.tool_change, time_temp_idle2tool)
 
                 if conf.DEBUG:
-                    print("(DEBUG) TempController: Inject point for T{tool} is before \"{token}\" - time diff: {delta:0.2f}s".format(tool = tool_id, token = str(inject_point), delta = acc_time))
+                    self.print_inject_point("T{tool}".format(tool = tool_id), inject_point, tool_info.tool_change)
 
                 # Insert idle temp in TC_INIT
                 # Insert ramp up at inject point
                 # Insert temp wait before tool change
-                gcode_init.append_node(gcode_analyzer.GCode('M104', {'S' : tool_temp - conf.temp_idle_delta, 'T' : tool_id}))
+                gcode_init.append_node(gcode_analyzer.GCode('M104', {'S' : tool_temp - self.config.temp_idle_delta, 'T' : tool_id}))
                 gcode_wait.append_node(gcode_analyzer.GCode('M116', {'P' : tool_id, 'S' : 5}))
 
                 inject_point.append_node(gcode_analyzer.GCode('M104', {'S' : tool_temp, 'T' : tool_id}))
                 tool_info.tool_change.append_node_left(gcode_analyzer.GCode('M116', {'P' : tool_id, 'S' : 5}))
             else:
                 if conf.DEBUG:
-                    print("(DEBUG) TempController: Inject point for T{tool} at TC_INIT".format(tool = tool_id))
+                    print("(DEBUG) TempController: Inject point for T{tool} at TC_INIT".format(tool = tool_id), file = self.log)
 
                 # Insert target temp at TC_INIT
                 # Insert temp wait at TC_INIT
@@ -205,32 +214,28 @@ class TemperatureController:
                 tool_next_info = activation_seq[activation_indx]
 
                 # Calculate the time delta between the deactivation and the activation
-                time_delta = 0.0
-                token = tool_prev_info.block_end.next
-                while token != tool_next_info.tool_change:
-                    time_delta += token.runtime
-                    token = token.next
+                time_delta = self.runtime_index.elapsed(tool_prev_info.block_end, tool_next_info.tool_change)
 
                 if conf.DEBUG:
-                    print("(DEBUG) TempController: T{tool} block_end -> T{tool} activation - runtime estimate: {delta:0.2f}s".format(tool = tool_id, delta = time_delta))
+                    print("(DEBUG) TempController: T{tool} block_end -> T{tool} activation - runtime estimate: {delta:0.2f}s".format(tool = tool_id, delta = time_delta), file = self.log)
 
                 # Get the temps
-                prev_temp = conf.tool_temperature(tool_prev_info.block_end.state_post.layer_num, tool_id)
-                next_temp = conf.tool_temperature(tool_next_info.tool_change.state_pre.layer_num, tool_id)
+                prev_temp = self.config.tool_temperature(tool_prev_info.block_end.state_post.layer_num, tool_id)
+                next_temp = self.config.tool_temperature(tool_next_info.tool_change.state_pre.layer_num, tool_id)
 
                 # Idle temp - avg of the two minus the delta
-                idle_temp = (prev_temp + next_temp) / 2.0 - conf.temp_idle_delta
+                idle_temp = (prev_temp + next_temp) / 2.0 - self.config.temp_idle_delta
                 
                 # Cooldown time
-                time_cooling = (prev_temp - idle_temp) / conf.temp_cooling_rate
-                time_heating = (next_temp - idle_temp) / conf.temp_heating_rate
+                time_cooling = (prev_temp - idle_temp) / self.config.temp_cooling_rate
+                time_heating = (next_temp - idle_temp) / self.config.temp_heating_rate
 
                 time_idling = time_delta - (time_cooling + time_heating)
                 if time_idling <= 0.0:
                     # No idle time - check if there is temp difference between the two
                     if prev_temp < next_temp:
                         time_cooling = 0
-                        time_heating = (next_temp - prev_temp) / conf.temp_heating_rate
+                        time_heating = (next_temp - prev_temp) / self.config.temp_heating_rate
                         if time_heating >= time_delta:
                             # Heating will take longer the difference - ramp up immedietly
                             idle_temp = next_temp
@@ -239,7 +244,7 @@ class TemperatureController:
                             idle_temp = prev_temp
                     elif prev_temp > next_temp:
                         idle_temp = next_temp
-                        time_cooling = (prev_temp - next_temp) / conf.temp_cooling_rate
+                        time_cooling = (prev_temp - next_temp) / self.config.temp_cooling_rate
                         time_heating = 0
                         # Temp lower, immedietly try to ramp down temp
                         idle_temp = next_temp
@@ -253,22 +258,15 @@ class TemperatureController:
                 # Statistics
                 if conf.DEBUG:
                     print("(DEBUG) TempController: T{tool} {T_prev}C->{T_idle}C cooling time: {t_cooling:0.2f}s, idle time: {t_idling:0.2f}, {T_idle}C->{T_next}C heating time: {t_heating:0.2f}".format(
-                        tool = tool_id, T_prev = prev_temp, T_next = next_temp, T_idle = idle_temp, t_cooling = time_cooling, t_idling = time_idling, t_heating = time_heating))
+                        tool = tool_id, T_prev = prev_temp, T_next = next_temp, T_idle = idle_temp, t_cooling = time_cooling, t_idling = time_idling, t_heating = time_heating), file = self.log)
 
                 # Use the new heating time
                 if time_heating > 0.0:
                     # Find the injection point for next temp
-                    acc_time = 0.0
-                    inject_point = tool_next_info.tool_change.prev
-                    while inject_point is not None:
-                        acc_time += inject_point.runtime
-                        if acc_time >= time_heating:
-                            break
-                        inject_point = inject_point.prev
+                    inject_point = self.gcode_analyzer.inject_point_before(tool_next_info.tool_change, time_heating)
 
                     if conf.DEBUG:
-                        print("(DEBUG) TempController: Inject point for T{tool} temp ramp-up is before \"{token}\" - time diff: {delta:0.2f}s".format(
-                            tool = tool_id, token = str(inject_point), delta = acc_time))
+                        self.print_inject_point("T{tool} temp ramp-up".format(tool = tool_id), inject_point, tool_next_info.tool_change)
                     inject_point.append_node(gcode_analyzer.GCode('M104', {'S' : next_temp, 'T' : tool_id}))
 
                 # Inject the idle temp
@@ -283,7 +281,7 @@ class TemperatureController:
 
             if tool_info.block_end is not None:
                 print("TempController: Disabling T{tool} at layer {layer}".format(
-                    tool = tool_id, layer = tool_info.block_end.state_post.layer_num))
+                    tool = tool_id, layer = tool_info.block_end.state_post.layer_num), file = self.log)
 
                 tool_info.block_end.append_node(gcode_analyzer.GCode('M104', {'S' : 0, 'T' : tool_id}))
 
@@ -291,8 +289,21 @@ class TemperatureController:
         self.temp_footer.append_node(gcode_analyzer.GCode('M104', {'S' : 0}))
         self.temp_footer.append_node(gcode_analyzer.GCode('M140', {'S' : 0}))
 
+    # Debug - the inject point and the runtime from it to the tool change
+    # - folded moves (sparse token list) are not serialized, the moves split off by the inject points are not indexed
+    def print_inject_point(self, label, inject_point, tool_change):
+        if inject_point.type == Token.MOVES:
+            print("(DEBUG) TempController: Inject point for {label} is after {moves} moves".format(label = label, moves = inject_point.moves), file = self.log)
+            return
+        acc_time = self.runtime_index.elapsed(inject_point, tool_change) + inject_point.runtime
+        print("(DEBUG) TempController: Inject point for {label} is before \"{token}\" - time diff: {delta:0.2f}s".format(
+            label = label, token = str(inject_point), delta = acc_time), file = self.log)
+
     # Inject the GCode
+    # - the runtimes are queried after the GCode injected by the stages before (prime tower)
     def inject_gcode(self):
+        self.gcode_analyzer.analyze_state()
+        self.runtime_index = self.gcode_analyzer.runtime_index()
         self.gcode_prep_header()
         self.gcode_prep_toolchange()
         self.gcode_prep_deactivation()